@@ -19,20 +19,179 @@ MQTT_BROKER_PORT: int = int(os.environ.get("MQTT_BROKER_PORT", 1883))
 MQTT_PUBLISHER_CLIENT_ID: str = os.environ.get("MQTT_PUBLISHER_CLIENT_ID", "mqtt-sensor-ms-publisher")
 MQTT_SUBSCRIBER_CLIENT_ID: str = os.environ.get("MQTT_SUBSCRIBER_CLIENT_ID", "mqtt-sensor-ms-subscriber")
 
+# multi-worker publisher: PUBLISHER_WORKERS uvicorn worker processes, each claiming a slot (a lock file under
+# PUBLISHER_STATE_DIR) and connecting with the client ID <MQTT_PUBLISHER_CLIENT_ID>-<slot> and its own persistent session
+PUBLISHER_WORKERS: int = int(os.environ.get("PUBLISHER_WORKERS", 1))
+PUBLISHER_STATE_DIR: str = os.environ.get("PUBLISHER_STATE_DIR", "publisher")
+
 DEVICE_EXPORT_TOPIC: str = os.environ.get("DEVICE_EXPORT_TOPIC", "export/#")
 DEVICE_RESPONSE_TOPIC: str = os.environ.get("DEVICE_RESPONSE_TOPIC", "response/#")
 
+# subscriber dispatcher: worker threads, bounded queue and overflow policy (block | drop-oldest | keep-latest | reject)
+# of the telemetry lane. Control messages (responses, latency benchmarks) have their own queue, served first, and
+# SUBSCRIBER_CONTROL_WORKERS reserved workers. A device holds at most SUBSCRIBER_DEVICE_QUEUE_LIMIT queued telemetry
+# messages (0: no limit), its oldest one is shed beyond that
+SUBSCRIBER_WORKERS: int = int(os.environ.get("SUBSCRIBER_WORKERS", 8))
+SUBSCRIBER_QUEUE_SIZE: int = int(os.environ.get("SUBSCRIBER_QUEUE_SIZE", 1000))
+SUBSCRIBER_OVERFLOW_POLICY: str = os.environ.get("SUBSCRIBER_OVERFLOW_POLICY", "block")
+SUBSCRIBER_CONTROL_WORKERS: int = int(os.environ.get("SUBSCRIBER_CONTROL_WORKERS", 1))
+SUBSCRIBER_CONTROL_QUEUE_SIZE: int = int(os.environ.get("SUBSCRIBER_CONTROL_QUEUE_SIZE", 1000))
+SUBSCRIBER_DEVICE_QUEUE_LIMIT: int = int(os.environ.get("SUBSCRIBER_DEVICE_QUEUE_LIMIT", 0))
+SUBSCRIBER_STATS_INTERVAL: float = float(os.environ.get("SUBSCRIBER_STATS_INTERVAL", 60))
+
+# subscriber engine: threaded (paho client + dispatcher worker threads) | asyncio (gmqtt + httpx.AsyncClient)
+SUBSCRIBER_ENGINE: str = os.environ.get("SUBSCRIBER_ENGINE", "threaded")
+# asyncio engine: concurrent export pipelines (and control message pipelines) and threads used to decode messages off the event loop
+ASYNC_SUBSCRIBER_CONCURRENCY: int = int(os.environ.get("ASYNC_SUBSCRIBER_CONCURRENCY", 256))
+ASYNC_SUBSCRIBER_CONTROL_CONCURRENCY: int = int(os.environ.get("ASYNC_SUBSCRIBER_CONTROL_CONCURRENCY", 16))
+ASYNC_SUBSCRIBER_DECODE_WORKERS: int = int(os.environ.get("ASYNC_SUBSCRIBER_DECODE_WORKERS", os.cpu_count() or 4))
+
+# multi-process subscriber: number of subscriber processes and how messages are shared among them
+# shared: broker-side shared subscriptions ($share/<group>/<topic>), requires MQTT v5 or broker support (mosquitto >= 1.6)
+# local: a single receiver fans messages out to the workers, sharded by device name
+SUBSCRIBER_PROCESSES: int = int(os.environ.get("SUBSCRIBER_PROCESSES", 1))
+SUBSCRIBER_SHARDING: str = os.environ.get("SUBSCRIBER_SHARDING", "shared")
+MQTT_SHARED_SUBSCRIPTION_GROUP: str = os.environ.get("MQTT_SHARED_SUBSCRIPTION_GROUP", "mqtt-sensor-ms")
+SUBSCRIBER_RESTART_BACKOFF: float = float(os.environ.get("SUBSCRIBER_RESTART_BACKOFF", 1))
+
 # cmd_topic : command/<device_name>/<property_name>/<method>/<uuid>
-# response_topic : response/<device_name>/<property_name>/<uuid>
+# response_topic : response/<device_name>/<property_name>/<method>/<uuid>
 DEVICE_CMD_TOPIC_TEMPLATE: str = os.environ.get("DEVICE_CMD_TOPIC_TEMPLATE", "command/%s/%s/%s/%s")
+# command fan-out: publishes written before waiting for the MQTT connection to flush them
+COMMAND_PUBLISH_WINDOW: int = max(1, int(os.environ.get("COMMAND_PUBLISH_WINDOW", 64)))
+# command batches: at most COMMAND_BATCH_MAX_COMMANDS commands and COMMAND_BATCH_MAX_TARGETS targets, summed
+# over the commands, per /sensor/command/batch request
+COMMAND_BATCH_MAX_COMMANDS: int = int(os.environ.get("COMMAND_BATCH_MAX_COMMANDS", 1000))
+COMMAND_BATCH_MAX_TARGETS: int = int(os.environ.get("COMMAND_BATCH_MAX_TARGETS", 100000))
+
+# GET command correlation: pending commands are kept COMMAND_CORRELATION_TTL seconds, at most COMMAND_CORRELATION_MAX_ENTRIES
+# (answered ones are evicted first),
+# GET endpoints called with wait=true wait COMMAND_WAIT_TIMEOUT seconds by default, at most COMMAND_WAIT_MAX_TIMEOUT
+COMMAND_CORRELATION_TTL: float = float(os.environ.get("COMMAND_CORRELATION_TTL", 60))
+COMMAND_CORRELATION_MAX_ENTRIES: int = int(os.environ.get("COMMAND_CORRELATION_MAX_ENTRIES", 10000))
+COMMAND_WAIT_TIMEOUT: float = float(os.environ.get("COMMAND_WAIT_TIMEOUT", 5))
+COMMAND_WAIT_MAX_TIMEOUT: float = float(os.environ.get("COMMAND_WAIT_MAX_TIMEOUT", 30))
+
+# device shadow: last known sensor-state, sensor-config and inference-layer of each device, kept in Redis at
+# SHADOW_REDIS_URL (in process if empty or unreachable), shadows not updated for SHADOW_TTL seconds expire
+SHADOW_REDIS_URL: str = os.environ.get("SHADOW_REDIS_URL", "")
+SHADOW_KEY_PREFIX: str = os.environ.get("SHADOW_KEY_PREFIX", "esn:shadow:")
+SHADOW_TTL: float = float(os.environ.get("SHADOW_TTL", 7 * 24 * 3600))
+
+# sensor model distribution: models are stored once under MODEL_STORE_DIR by sha256 and delivered in
+# MODEL_CHUNK_SIZE byte chunks, to at most MODEL_ROLLOUT_CONCURRENCY sensors at a time
+MODEL_STORE_DIR: str = os.environ.get("MODEL_STORE_DIR", "models")
+MODEL_CHUNK_SIZE: int = int(os.environ.get("MODEL_CHUNK_SIZE", 64 * 1024))
+MODEL_MAX_BYTES: int = int(os.environ.get("MODEL_MAX_BYTES", 64 * 1024 * 1024))
+MODEL_ROLLOUT_CONCURRENCY: int = int(os.environ.get("MODEL_ROLLOUT_CONCURRENCY", 16))
 
 SEQUENCE_LENGTH: int = int(os.environ.get("SEQUENCE_LENGTH", 500))
 SAMPLE_SIZE: int = int(os.environ.get("SAMPLE_SIZE", 6))
+# interpretation of the 16-bit words of a reading: signed (int16, two's complement) or unsigned (uint16)
+SENSOR_READING_SIGNED: bool = bool(int(os.environ.get("SENSOR_READING_SIGNED", 1)))
+# preset dictionary shared with the sensors by the zlib-dict reading codecs of binary sensor-data messages (disabled if empty)
+SENSOR_ZLIB_DICTIONARY: str = os.environ.get("SENSOR_ZLIB_DICTIONARY", "")
 
 
 GATEWAY_API_URL: str = os.environ.get("GATEWAY_API_URL", "http://127.0.0.1:8004/api/v1")
 GATEWAY_NAME: str = os.environ.get("GATEWAY_NAME", "gateway_1")
 
+# Gateway API client: connection pool, timeouts (seconds) and retries with exponential backoff
+# HTTP/2 requires the optional h2 package (pip install httpx[http2])
+GATEWAY_API_HTTP2: bool = bool(int(os.environ.get("GATEWAY_API_HTTP2", 0)))
+GATEWAY_API_MAX_CONNECTIONS: int = int(os.environ.get("GATEWAY_API_MAX_CONNECTIONS", 100))
+GATEWAY_API_MAX_KEEPALIVE_CONNECTIONS: int = int(os.environ.get("GATEWAY_API_MAX_KEEPALIVE_CONNECTIONS", 20))
+GATEWAY_API_KEEPALIVE_EXPIRY: float = float(os.environ.get("GATEWAY_API_KEEPALIVE_EXPIRY", 30))
+GATEWAY_API_TIMEOUT: float = float(os.environ.get("GATEWAY_API_TIMEOUT", 10))
+GATEWAY_API_CONNECT_TIMEOUT: float = float(os.environ.get("GATEWAY_API_CONNECT_TIMEOUT", 5))
+GATEWAY_API_RETRIES: int = int(os.environ.get("GATEWAY_API_RETRIES", 3))
+GATEWAY_API_RETRY_BACKOFF: float = float(os.environ.get("GATEWAY_API_RETRY_BACKOFF", 0.5))
+
+# export micro-batching: a batch is flushed as soon as it holds EXPORT_BATCH_MAX_SIZE exports
+# or its oldest export has waited EXPORT_BATCH_MAX_DELAY seconds
+EXPORT_BATCH_ENABLED: bool = bool(int(os.environ.get("EXPORT_BATCH_ENABLED", 0)))
+EXPORT_BATCH_MAX_SIZE: int = int(os.environ.get("EXPORT_BATCH_MAX_SIZE", 50))
+EXPORT_BATCH_MAX_DELAY: float = float(os.environ.get("EXPORT_BATCH_MAX_DELAY", 0.5))
+EXPORT_BATCH_MAX_IN_FLIGHT: int = int(os.environ.get("EXPORT_BATCH_MAX_IN_FLIGHT", 4))
+
+# encoding of SensorReading values sent to the Gateway API: json | float32-b64 | int16-b64
+EXPORT_READING_ENCODING: str = os.environ.get("EXPORT_READING_ENCODING", "json")
+# encoding of export request bodies: json | msgpack (requires the optional msgpack package)
+EXPORT_BODY_ENCODING: str = os.environ.get("EXPORT_BODY_ENCODING", "json")
+EXPORT_GZIP: bool = bool(int(os.environ.get("EXPORT_GZIP", 0)))
+
+# gateway-side feature extraction: sensor-data exports of devices using a feature set carry features computed over
+# each axis instead of the full reading. EXPORT_FEATURE_SETS defines the sets (name=feature,...;name=...), a
+# downsample:<k> item also exports the reading averaged over blocks of k samples. EXPORT_FEATURE_DEFAULT_SET applies
+# to every device (empty: full readings), EXPORT_FEATURE_DEVICES overrides it per device (device=set,..., raw for
+# full readings). FFT band energies use the EXPORT_FEATURE_BANDS bands, in Hz, of readings sampled at SENSOR_SAMPLE_RATE Hz
+EXPORT_FEATURE_SETS: str = os.environ.get("EXPORT_FEATURE_SETS", "summary=mean,rms,peak,kurtosis;vibration=rms,peak,crest,kurtosis,bands;monitoring=mean,rms,peak,kurtosis,bands,downsample:10")
+EXPORT_FEATURE_DEFAULT_SET: str = os.environ.get("EXPORT_FEATURE_DEFAULT_SET", "")
+EXPORT_FEATURE_DEVICES: str = os.environ.get("EXPORT_FEATURE_DEVICES", "")
+EXPORT_FEATURE_BANDS: str = os.environ.get("EXPORT_FEATURE_BANDS", "0-2,2-5,5-10,10-20,20-50")
+SENSOR_SAMPLE_RATE: float = float(os.environ.get("SENSOR_SAMPLE_RATE", 100))
+
+# gateway-layer inference: readings of sensors using GATEWAY_INFERENCE_LAYER are predicted by the INFERENCE_BACKEND
+# model at INFERENCE_MODEL_PATH (disabled if empty) before being exported. Readings of many sensors are predicted
+# together, in batches of at most INFERENCE_BATCH_MAX_SIZE run once the oldest reading has waited
+# INFERENCE_BATCH_MAX_DELAY seconds; at most INFERENCE_MAX_PENDING readings wait, INFERENCE_MAX_IN_FLIGHT exports
+# are sent at a time
+INFERENCE_BACKEND: str = os.environ.get("INFERENCE_BACKEND", "numpy-mlp")
+INFERENCE_MODEL_PATH: str = os.environ.get("INFERENCE_MODEL_PATH", "")
+INFERENCE_BATCH_MAX_SIZE: int = int(os.environ.get("INFERENCE_BATCH_MAX_SIZE", 64))
+INFERENCE_BATCH_MAX_DELAY: float = float(os.environ.get("INFERENCE_BATCH_MAX_DELAY", 0.02))
+INFERENCE_MAX_PENDING: int = int(os.environ.get("INFERENCE_MAX_PENDING", 1024))
+INFERENCE_MAX_IN_FLIGHT: int = int(os.environ.get("INFERENCE_MAX_IN_FLIGHT", 8))
+
+# duplicate suppression: messages whose key (command UUID of responses, payload digest of exports, per device) was
+# already seen within DEDUP_TTL seconds are skipped. At most DEDUP_MAX_ENTRIES keys are kept, the oldest first evicted
+DEDUP_ENABLED: bool = bool(int(os.environ.get("DEDUP_ENABLED", 1)))
+DEDUP_TTL: float = float(os.environ.get("DEDUP_TTL", 300))
+DEDUP_MAX_ENTRIES: int = int(os.environ.get("DEDUP_MAX_ENTRIES", 100000))
+
+# on-disk spool for exports the Gateway API could not take: segmented append-only files under SPOOL_DIR,
+# capped at SPOOL_MAX_BYTES (oldest segments are discarded), replayed in order at up to SPOOL_REPLAY_RATE exports/s
+SPOOL_ENABLED: bool = bool(int(os.environ.get("SPOOL_ENABLED", 0)))
+SPOOL_DIR: str = os.environ.get("SPOOL_DIR", "spool")
+SPOOL_SEGMENT_BYTES: int = int(os.environ.get("SPOOL_SEGMENT_BYTES", 16 * 1024 * 1024))
+SPOOL_MAX_BYTES: int = int(os.environ.get("SPOOL_MAX_BYTES", 1024 * 1024 * 1024))
+SPOOL_REPLAY_RATE: float = float(os.environ.get("SPOOL_REPLAY_RATE", 20))
+SPOOL_RETRY_INTERVAL: float = float(os.environ.get("SPOOL_RETRY_INTERVAL", 5))
+SPOOL_MMAP: bool = bool(int(os.environ.get("SPOOL_MMAP", 1)))
+
+# subscriber metrics: each subscriber process writes a snapshot to METRICS_DIR every METRICS_WRITE_INTERVAL seconds,
+# the publisher serves their sum on /metrics and ignores snapshots older than METRICS_STALE_AFTER seconds
+METRICS_ENABLED: bool = bool(int(os.environ.get("METRICS_ENABLED", 1)))
+METRICS_DIR: str = os.environ.get("METRICS_DIR", "metrics")
+METRICS_WRITE_INTERVAL: float = float(os.environ.get("METRICS_WRITE_INTERVAL", 5))
+METRICS_STALE_AFTER: float = float(os.environ.get("METRICS_STALE_AFTER", 300))
+
+# inference latency aggregation: inference-latency-bench samples are aggregated into mergeable sketches (relative
+# error LATENCY_SKETCH_ACCURACY, at most LATENCY_SKETCH_MAX_BUCKETS buckets) per sensor and inference layer over
+# LATENCY_WINDOW seconds windows. The last LATENCY_WINDOW_RETENTION windows, holding at most LATENCY_MAX_SKETCHES
+# sketches (older windows are dropped first), are queryable on the publisher (through a metrics section), closed windows are exported as summaries if LATENCY_SUMMARY_ENABLED and every sample is
+# still forwarded to the Gateway API if LATENCY_FORWARD_SAMPLES
+LATENCY_SKETCH_ACCURACY: float = float(os.environ.get("LATENCY_SKETCH_ACCURACY", 0.01))
+LATENCY_SKETCH_MAX_BUCKETS: int = int(os.environ.get("LATENCY_SKETCH_MAX_BUCKETS", 2048))
+LATENCY_WINDOW: float = float(os.environ.get("LATENCY_WINDOW", 60))
+LATENCY_WINDOW_RETENTION: int = int(os.environ.get("LATENCY_WINDOW_RETENTION", 60))
+LATENCY_MAX_SKETCHES: int = int(os.environ.get("LATENCY_MAX_SKETCHES", 10000))
+LATENCY_SUMMARY_ENABLED: bool = bool(int(os.environ.get("LATENCY_SUMMARY_ENABLED", 1)))
+LATENCY_FORWARD_SAMPLES: bool = bool(int(os.environ.get("LATENCY_FORWARD_SAMPLES", 1)))
+
+# logging: records are queued (at most LOG_QUEUE_SIZE, extra ones are dropped) and written by a background thread
+# as key=value pairs or JSON lines (LOG_FORMAT=kv | json). LOG_SAMPLE_RATES keeps a fraction of the records of an
+# event (event=rate,...), LOG_RATE_LIMIT caps the records per second of an event for a device (0 disables it),
+# both only apply below WARNING.
+# Devices listed in LOG_DEBUG_DEVICES_FILE, one per line, log every event and their payloads
+LOG_LEVEL: str = os.environ.get("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT: str = os.environ.get("LOG_FORMAT", "kv")
+LOG_QUEUE_SIZE: int = int(os.environ.get("LOG_QUEUE_SIZE", 10000))
+LOG_SAMPLE_RATES: str = os.environ.get("LOG_SAMPLE_RATES", "message.received=0.01,export.flushed=0.1")
+LOG_RATE_LIMIT: float = float(os.environ.get("LOG_RATE_LIMIT", 1))
+LOG_DEBUG_DEVICES_FILE: str = os.environ.get("LOG_DEBUG_DEVICES_FILE", "log-debug-devices")
+LOG_DEBUG_REFRESH_INTERVAL: float = float(os.environ.get("LOG_DEBUG_REFRESH_INTERVAL", 2))
+
 TIMEZONE: str = os.environ.get("TIMEZONE", "Chile/Continental")
 
 ORIGINS: list = [
@@ -0,0 +1,261 @@
+"""
+Mergeable latency sketches over rolling time windows.
+
+A LatencySketch counts values in logarithmic buckets: bucket i holds the values in
+(gamma^(i-1), gamma^i], gamma = (1 + accuracy) / (1 - accuracy), so every quantile is estimated within
+LATENCY_SKETCH_ACCURACY relative error whatever the distribution, with a bounded number of buckets (at
+most LATENCY_SKETCH_MAX_BUCKETS, the lowest buckets are merged beyond that). Values <= 0 (e.g. clock skew
+between a sensor and the gateway) are counted in a zero bucket. Sketches with the same accuracy merge by
+adding their bucket counts, so sketches of several processes, windows or sensors combine exactly.
+
+LatencyWindows keeps one sketch per key (sensor, inference layer) and LATENCY_WINDOW seconds window, for
+the last LATENCY_WINDOW_RETENTION windows, older windows being dropped first while more than
+LATENCY_MAX_SKETCHES sketches are kept. Subscriber processes write their windows to a metrics section
+(see app.core.metrics), which the publisher merges to answer latency queries. Closed windows no longer
+change, they are serialized once.
+"""
+import json
+import math
+import time
+import threading
+from typing import Iterable, Optional
+from app.core.config import (
+    LATENCY_SKETCH_ACCURACY,
+    LATENCY_SKETCH_MAX_BUCKETS,
+    LATENCY_WINDOW,
+    LATENCY_WINDOW_RETENTION,
+    LATENCY_MAX_SKETCHES,
+)
+
+QUANTILES = (0.5, 0.9, 0.99)
+
+
+class LatencySketch:
+    __slots__ = ("accuracy", "max_buckets", "_log_gamma", "buckets", "zero_count", "count", "sum", "min", "max")
+
+    def __init__(self, accuracy: float = LATENCY_SKETCH_ACCURACY, max_buckets: int = LATENCY_SKETCH_MAX_BUCKETS):
+        if not 0 < accuracy < 1:
+            raise ValueError(f"Sketch accuracy must be in (0, 1), got {accuracy}")
+        self.accuracy = accuracy
+        self.max_buckets = max(2, max_buckets)
+        self._log_gamma = math.log((1 + accuracy) / (1 - accuracy))
+        self.buckets: dict[int, int] = {}
+        self.zero_count = 0
+        self.count = 0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add(self, value: float, count: int = 1):
+        if value > 0:
+            index = math.ceil(math.log(value) / self._log_gamma)
+            buckets = self.buckets
+            buckets[index] = buckets.get(index, 0) + count
+            if len(buckets) > self.max_buckets:
+                self._collapse()
+        else:
+            self.zero_count += count
+        self.count += count
+        self.sum += value * count
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def _collapse(self):
+        # the lowest buckets are merged into one, only the accuracy of the smallest values is lost
+        indexes = sorted(self.buckets)
+        excess = len(indexes) - self.max_buckets + 1
+        target = indexes[excess]
+        for index in indexes[:excess]:
+            self.buckets[target] += self.buckets.pop(index)
+
+    def merge(self, other: "LatencySketch"):
+        if other.accuracy != self.accuracy:
+            raise ValueError(f"Cannot merge sketches of accuracy {other.accuracy} into {self.accuracy}")
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        if len(self.buckets) > self.max_buckets:
+            self._collapse()
+        self.zero_count += other.zero_count
+        self.count += other.count
+        self.sum += other.sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def quantile(self, q: float) -> Optional[float]:
+        """
+        Returns the estimated q-quantile (0 <= q <= 1), None if the sketch is empty.
+        """
+        if self.count == 0:
+            return None
+        rank = q * (self.count - 1)
+        seen = self.zero_count
+        if rank < seen:
+            return min(max(0.0, self.min), self.max)
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if rank < seen:
+                gamma_index = math.exp(index * self._log_gamma)
+                # middle of the bucket in relative terms, within accuracy of every value of the bucket
+                estimate = 2 * gamma_index / (1 + math.exp(self._log_gamma))
+                return min(max(estimate, self.min), self.max)
+        return self.max
+
+    def summary(self) -> dict:
+        return {
+            "count": self.count,
+            "min": self.min if self.count else None,
+            "max": self.max if self.count else None,
+            "mean": self.sum / self.count if self.count else None,
+            **{f"p{round(q * 100):d}": self.quantile(q) for q in QUANTILES},
+        }
+
+    def to_dict(self) -> dict:
+        indexes = sorted(self.buckets)
+        return {
+            "accuracy": self.accuracy,
+            "indexes": indexes,
+            "counts": [self.buckets[index] for index in indexes],
+            "zero_count": self.zero_count,
+            "count": self.count,
+            "sum": self.sum,
+            "min": self.min if self.count else None,
+            "max": self.max if self.count else None,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict, max_buckets: int = LATENCY_SKETCH_MAX_BUCKETS) -> "LatencySketch":
+        sketch = cls(data["accuracy"], max_buckets)
+        sketch.buckets = dict(zip(data["indexes"], data["counts"]))
+        sketch.zero_count = data["zero_count"]
+        sketch.count = data["count"]
+        sketch.sum = data["sum"]
+        if sketch.count:
+            sketch.min, sketch.max = data["min"], data["max"]
+        return sketch
+
+
+class LatencyWindows:
+    def __init__(
+        self,
+        window: float = LATENCY_WINDOW,
+        retention: int = LATENCY_WINDOW_RETENTION,
+        accuracy: float = LATENCY_SKETCH_ACCURACY,
+        max_sketches: int = LATENCY_MAX_SKETCHES,
+    ):
+        self.window = window
+        self.retention = max(1, retention)
+        self.accuracy = accuracy
+        self.max_sketches = max(1, max_sketches)
+        self._lock = threading.Lock()
+        # window start -> key -> sketch
+        self._windows: dict[int, dict[tuple, LatencySketch]] = {}
+        # window starts already taken by take_closed
+        self._taken: set[int] = set()
+        # window start -> JSON of a closed window
+        self._serialized: dict[int, str] = {}
+
+    def window_start(self, at: float) -> int:
+        return int(at // self.window * self.window)
+
+    def record(self, key: tuple, value: float, at: float = None):
+        start = self.window_start(time.time() if at is None else at)
+        with self._lock:
+            window = self._windows.get(start)
+            if window is None:
+                window = self._windows[start] = {}
+                self._expire(start)
+            sketch = window.get(key)
+            if sketch is None:
+                sketch = window[key] = LatencySketch(self.accuracy)
+            sketch.add(value)
+            self._serialized.pop(start, None)
+
+    def _expire(self, newest: int):
+        # must be called with self._lock held
+        oldest = newest - (self.retention - 1) * self.window
+        sketches = sum(len(window) for window in self._windows.values())
+        for start in sorted(self._windows):
+            if start >= oldest and (sketches <= self.max_sketches or start == newest):
+                break
+            sketches -= len(self._windows.pop(start))
+            self._taken.discard(start)
+            self._serialized.pop(start, None)
+
+    def take_closed(self, now: float = None, include_open: bool = False) -> list[tuple[int, dict[tuple, LatencySketch]]]:
+        """
+        Returns the windows closed since the previous call, oldest first, as (window start, {key: sketch}).
+        Windows stay queryable until they expire. include_open also takes the current window, e.g. on shutdown.
+        """
+        current = self.window_start(time.time() if now is None else now)
+        with self._lock:
+            starts = sorted(
+                start for start in self._windows
+                if start not in self._taken and (start < current or include_open)
+            )
+            self._taken.update(starts)
+            return [(start, {key: _copy(sketch) for key, sketch in self._windows[start].items()}) for start in starts]
+
+    def snapshot_json(self) -> str:
+        """
+        Returns the windows as a JSON document, {"window": seconds, "windows": [{"start", "sketches"}, ...]}.
+        Sketches are copied under the lock and serialized outside it, closed windows only once.
+        """
+        current = self.window_start(time.time())
+        with self._lock:
+            starts = sorted(self._windows)
+            serialized = {start: self._serialized[start] for start in starts if start in self._serialized}
+            copies = {
+                start: [(key, _copy(sketch)) for key, sketch in self._windows[start].items()]
+                for start in starts if start not in serialized
+            }
+        for start, sketches in copies.items():
+            serialized[start] = json.dumps({
+                "start": start,
+                "sketches": [{"key": list(key), **sketch.to_dict()} for key, sketch in sketches],
+            })
+        with self._lock:
+            for start in copies:
+                if start < current and start in self._windows:
+                    self._serialized.setdefault(start, serialized[start])
+        return f'{{"window": {json.dumps(self.window)}, "windows": [{", ".join(serialized[start] for start in starts)}]}}'
+
+
+def _copy(sketch: LatencySketch) -> LatencySketch:
+    copy = LatencySketch(sketch.accuracy, sketch.max_buckets)
+    copy.merge(sketch)
+    return copy
+
+
+def merge_snapshots(
+    snapshots: Iterable[dict],
+    since: float,
+    group_by: tuple[int, ...],
+    match=lambda key: True,
+) -> dict[tuple, LatencySketch]:
+    """
+    Merges the sketches of LatencyWindows snapshots whose window ends after since, grouping their keys by
+    the key positions of group_by and keeping those for which match(key) is true.
+    """
+    merged: dict[tuple, LatencySketch] = {}
+    for snapshot in snapshots:
+        window = snapshot.get("window", LATENCY_WINDOW)
+        for entry in snapshot.get("windows", []):
+            if entry["start"] + window <= since:
+                continue
+            for data in entry["sketches"]:
+                key = tuple(data["key"])
+                if not match(key):
+                    continue
+                group = tuple(key[i] for i in group_by)
+                sketch = LatencySketch.from_dict(data)
+                if group in merged:
+                    merged[group].merge(sketch)
+                else:
+                    merged[group] = sketch
+    return merged
+
+
+# (sensor_name, inference_layer) -> latency of the inference-latency-bench samples, in ms
+inference_latency = LatencyWindows()
@@ -0,0 +1,330 @@
+"""
+Asynchronous, sampled, structured logging shared by the subscriber and the publisher.
+
+setup_logging() replaces the handlers of the root logger with a queue handler: the thread logging a
+record only puts it in a bounded queue (records are dropped, and counted, when it is full) and a
+background thread formats and writes it to stderr. Records are formatted as key=value pairs
+(LOG_FORMAT=kv) or JSON lines (LOG_FORMAT=json).
+
+Events of the ingest path are logged with EventLogger.event(event, device=..., **fields), which
+decides whether to log before anything is formatted:
+
+    - LOG_SAMPLE_RATES keeps a fraction of the records of an event, e.g. message.received=0.01;
+    - LOG_RATE_LIMIT caps the records per second of each (event, device) pair, the number of records
+      suppressed meanwhile is added to the next record logged for the pair;
+    - devices listed in LOG_DEBUG_DEVICES_FILE (one device name per line, reloaded when it changes)
+      bypass sampling, rate limits and the log level, and have their payloads dumped.
+"""
+import os
+import sys
+import json
+import time
+import queue
+import random
+import atexit
+import logging
+import threading
+import logging.handlers
+from typing import Optional
+from app.core.config import (
+    LOG_LEVEL,
+    LOG_FORMAT,
+    LOG_QUEUE_SIZE,
+    LOG_SAMPLE_RATES,
+    LOG_RATE_LIMIT,
+    LOG_DEBUG_DEVICES_FILE,
+    LOG_DEBUG_REFRESH_INTERVAL,
+)
+
+# libraries logging every request at INFO, they only log warnings unless LOG_LEVEL is DEBUG
+NOISY_LOGGERS = ("httpx", "httpcore")
+# at most this many (event, device) rate limits are tracked, they are reset when exceeded
+MAX_RATE_LIMITED_KEYS = 10000
+# attributes of every LogRecord, the others were passed as extra fields
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+
+def parse_sample_rates(value: str) -> dict[str, float]:
+    """
+    Parses "event=rate,event=rate" into {event: rate}, rates are clamped to [0, 1].
+    """
+    rates = {}
+    for item in value.split(","):
+        if "=" not in item:
+            continue
+        event, rate = item.split("=", 1)
+        rates[event.strip()] = min(1.0, max(0.0, float(rate)))
+    return rates
+
+
+# --- Formatting ---
+
+def _format_value(value) -> str:
+    value = str(value)
+    if not value or any(c in value for c in ' ="\n'):
+        return json.dumps(value)
+    return value
+
+
+class KeyValueFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        timestamp = time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(record.created))
+        parts = [f"{timestamp}.{int(record.msecs):03d}", record.levelname, record.name]
+        event = getattr(record, "event", None)
+        if event is not None:
+            parts.append(f"event={event}")
+        else:
+            parts.append(f"msg={_format_value(record.getMessage())}")
+        for key, value in _extra_fields(record):
+            parts.append(f"{key}={_format_value(value)}")
+        line = " ".join(parts)
+        if record.exc_info:
+            line += "\n" + self.formatException(record.exc_info)
+        return line
+
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        data = {"ts": record.created, "level": record.levelname, "logger": record.name}
+        event = getattr(record, "event", None)
+        if event is not None:
+            data["event"] = event
+        else:
+            data["msg"] = record.getMessage()
+        data.update((key, value if isinstance(value, (int, float, bool)) or value is None else str(value)) for key, value in _extra_fields(record))
+        if record.exc_info:
+            data["exc"] = self.formatException(record.exc_info)
+        return json.dumps(data)
+
+
+def _extra_fields(record: logging.LogRecord):
+    for key, value in record.__dict__.items():
+        if key not in _RECORD_ATTRIBUTES and key != "event":
+            yield key, value
+
+
+# --- Queue handler ---
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queue handler that drops records when the queue is full and leaves all formatting to the writer thread.
+    """
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # the writer thread lives in this process, the record needs neither pickling nor early formatting
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+_listener: logging.handlers.QueueListener = None
+_queue_handler: DroppingQueueHandler = None
+# the writer thread does not survive fork, forked processes set logging up again
+_pid: int = None
+
+
+def setup_logging():
+    """
+    Routes the records of this process through the background writer. Safe to call several times.
+    """
+    global _listener, _queue_handler, _pid
+    if _listener is not None and _pid == os.getpid():
+        return
+    stream_handler = logging.StreamHandler(sys.stderr)
+    stream_handler.setFormatter(JSONFormatter() if LOG_FORMAT == "json" else KeyValueFormatter())
+    log_queue = queue.Queue(maxsize=max(1, LOG_QUEUE_SIZE))
+    _queue_handler = DroppingQueueHandler(log_queue)
+    _listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=False)
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(_queue_handler)
+    root.setLevel(LOG_LEVEL)
+    for name in NOISY_LOGGERS:
+        logging.getLogger(name).setLevel(max(logging.WARNING, root.level))
+    _listener.start()
+    if _pid is None:
+        atexit.register(shutdown_logging)
+    _pid = os.getpid()
+
+
+def shutdown_logging():
+    """
+    Writes the queued records and stops the background writer.
+    """
+    global _listener
+    if _listener is None or _pid != os.getpid():
+        return
+    _listener.stop()
+    _listener = None
+    if _queue_handler.dropped:
+        sys.stderr.write(f"[Logging] {_queue_handler.dropped} records dropped, the log queue was full\n")
+
+
+def logging_stats() -> dict:
+    return {
+        "queue_depth": _queue_handler.queue.qsize() if _queue_handler is not None else 0,
+        "dropped": _queue_handler.dropped if _queue_handler is not None else 0,
+        "suppressed": log_sampler.suppressed_total,
+    }
+
+
+# --- Sampling and rate limits ---
+
+class LogSampler:
+    def __init__(self, sample_rates: dict[str, float], rate_limit: float):
+        self.sample_rates = sample_rates
+        self.rate_limit = rate_limit
+        self.suppressed_total = 0
+        self._lock = threading.Lock()
+        # (event, device) -> [tokens, last refill, suppressed]
+        self._buckets: dict[tuple, list] = {}
+
+    def allow(self, event: str, device: Optional[str]) -> tuple[bool, int]:
+        """
+        Returns whether a record of an event should be logged and, if so, how many were suppressed before it.
+        """
+        rate = self.sample_rates.get(event)
+        with self._lock:
+            # random, rather than every n-th, so that devices sending in turn are sampled alike
+            if rate is not None and random.random() >= rate:
+                self.suppressed_total += 1
+                return False, 0
+            if self.rate_limit <= 0:
+                return True, 0
+
+            key = (event, device)
+            now = time.monotonic()
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                if len(self._buckets) >= MAX_RATE_LIMITED_KEYS:
+                    self._buckets.clear()
+                bucket = self._buckets[key] = [self.rate_limit, now, 0]
+            else:
+                bucket[0] = min(self.rate_limit, bucket[0] + (now - bucket[1]) * self.rate_limit)
+                bucket[1] = now
+            if bucket[0] < 1:
+                bucket[2] += 1
+                self.suppressed_total += 1
+                return False, 0
+            bucket[0] -= 1
+            suppressed, bucket[2] = bucket[2], 0
+            return True, suppressed
+
+
+# --- Per-device debug ---
+
+class DebugDevices:
+    """
+    Devices whose events are always logged and whose payloads are dumped, read from a control file
+    so every process of the service follows the same list.
+    """
+
+    def __init__(self, path: str, refresh_interval: float):
+        self.path = path
+        self.refresh_interval = refresh_interval
+        self._devices: frozenset[str] = frozenset()
+        self._mtime = None
+        self._checked_at = float("-inf")
+
+    def _refresh(self):
+        self._checked_at = time.monotonic()
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            self._devices, self._mtime = frozenset(), None
+            return
+        if mtime == self._mtime:
+            return
+        try:
+            with open(self.path) as f:
+                self._devices = frozenset(line.strip() for line in f if line.strip() and not line.startswith("#"))
+            self._mtime = mtime
+        except OSError:
+            pass
+
+    def devices(self) -> frozenset[str]:
+        if time.monotonic() - self._checked_at > self.refresh_interval:
+            self._refresh()
+        return self._devices
+
+    def enabled(self, device: Optional[str]) -> bool:
+        return device is not None and device in self.devices()
+
+    def write(self, devices: list[str]):
+        """
+        Replaces the debug devices of every process.
+        """
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            f.writelines(f"{device}\n" for device in sorted(set(devices)))
+        os.replace(tmp_path, self.path)
+        self._refresh()
+
+
+# --- Event logger ---
+
+class EventLogger:
+    def __init__(self, name: str):
+        self.logger = logging.getLogger(name)
+
+    def event(self, level: int, event: str, device: str = None, exc_info=None, **fields):
+        """
+        Logs an event with key-value fields, unless it is sampled out or rate limited. Warnings and errors
+        are never sampled nor rate limited. Fields are only formatted by the writer thread.
+        """
+        if debug_devices.enabled(device):
+            level = max(level, logging.INFO)
+        else:
+            if not self.logger.isEnabledFor(level):
+                return
+            if level < logging.WARNING:
+                allowed, suppressed = log_sampler.allow(event, device)
+                if not allowed:
+                    return
+                if suppressed:
+                    fields["suppressed"] = suppressed
+        if device is not None:
+            fields["device"] = device
+        fields["event"] = event
+        self.logger.log(level, event, exc_info=exc_info, extra=fields)
+
+    def debug(self, event: str, device: str = None, **fields):
+        self.event(logging.DEBUG, event, device, **fields)
+
+    def info(self, event: str, device: str = None, **fields):
+        self.event(logging.INFO, event, device, **fields)
+
+    def warning(self, event: str, device: str = None, **fields):
+        self.event(logging.WARNING, event, device, **fields)
+
+    def error(self, event: str, device: str = None, **fields):
+        self.event(logging.ERROR, event, device, **fields)
+
+    def exception(self, event: str, device: str = None, **fields):
+        self.event(logging.ERROR, event, device, exc_info=True, **fields)
+
+    def payload(self, event: str, device: str, **fields):
+        """
+        Dumps a payload, only for debug devices.
+        """
+        if debug_devices.enabled(device):
+            self.event(logging.INFO, event, device, **fields)
+
+
+def get_logger(name: str) -> EventLogger:
+    return EventLogger(name)
+
+
+log_sampler = LogSampler(parse_sample_rates(LOG_SAMPLE_RATES), LOG_RATE_LIMIT)
+debug_devices = DebugDevices(LOG_DEBUG_DEVICES_FILE, LOG_DEBUG_REFRESH_INTERVAL)
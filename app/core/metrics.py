@@ -0,0 +1,363 @@
+"""
+Lightweight metrics shared by the subscriber and the publisher.
+
+The subscriber records per-stage latency histograms and message counters in the process-wide
+`metrics` registry. Subscriber and publisher run as separate processes, so every subscriber process
+periodically writes a JSON snapshot of its registry to METRICS_DIR/<process name>.json (write to a
+temporary file, then rename). The publisher merges the snapshots it finds there and serves them in
+the Prometheus text exposition format on /metrics.
+
+Sections are larger JSON documents (e.g. the latency sketches of app.core.latency) written next to the
+snapshots, to METRICS_DIR/<section name>/<process name>.json, and only read by the endpoints that need them.
+"""
+import os
+import json
+import time
+import bisect
+import logging
+import threading
+from app.core.config import (
+    METRICS_ENABLED,
+    METRICS_DIR,
+    METRICS_WRITE_INTERVAL,
+    METRICS_STALE_AFTER,
+)
+
+logging.basicConfig(level=logging.INFO)
+
+# latency bucket upper bounds, in seconds
+LATENCY_BUCKETS = (
+    0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+    0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+
+# --- Metric definitions: name -> (type, label names, help) ---
+STAGE_SECONDS = "esn_subscriber_stage_seconds"
+UPSTREAM_SECONDS = "esn_subscriber_upstream_seconds"
+MESSAGES_TOTAL = "esn_subscriber_messages_total"
+ERRORS_TOTAL = "esn_subscriber_errors_total"
+DROPPED_TOTAL = "esn_subscriber_dropped_total"
+DUPLICATES_TOTAL = "esn_subscriber_duplicates_total"
+UPSTREAM_ERRORS_TOTAL = "esn_subscriber_upstream_errors_total"
+COMMAND_RTT_SECONDS = "esn_publisher_command_rtt_seconds"
+COMMAND_RESPONSES_TOTAL = "esn_publisher_command_responses_total"
+
+METRICS = {
+    STAGE_SECONDS: ("histogram", ("topic", "stage"), "Time spent in each stage of handling a message."),
+    UPSTREAM_SECONDS: ("histogram", ("endpoint",), "Time spent POSTing to the Gateway API, retries included."),
+    MESSAGES_TOTAL: ("counter", ("topic",), "Messages received."),
+    ERRORS_TOTAL: ("counter", ("topic",), "Messages that could not be handled."),
+    DROPPED_TOTAL: ("counter", ("topic",), "Messages dropped because the subscriber was overloaded."),
+    DUPLICATES_TOTAL: ("counter", ("topic",), "Messages skipped because a copy was already handled."),
+    UPSTREAM_ERRORS_TOTAL: ("counter", ("endpoint",), "Failed POSTs to the Gateway API."),
+    COMMAND_RTT_SECONDS: ("histogram", ("property",), "Time from publishing a GET command to receiving the device response."),
+    COMMAND_RESPONSES_TOTAL: ("counter", ("property", "outcome"), "Device responses by outcome (matched, duplicate, unmatched) and commands expired unanswered."),
+}
+
+
+def topic_type(topic: str) -> str:
+    """
+    Returns the label of a device topic: the export name of export/<device>/<export_name> topics,
+    the first level of any other topic.
+    """
+    levels = topic.split("/")
+    if levels[0] == "export" and len(levels) > 2:
+        return levels[2]
+    return levels[0]
+
+
+class StageTimer:
+    """
+    Times consecutive stages of handling a message, each lap records the time since the previous one.
+    """
+
+    __slots__ = ("_metrics", "_topic", "_last")
+
+    def __init__(self, metrics: "Metrics", topic: str):
+        self._metrics = metrics
+        self._topic = topic
+        self._last = time.perf_counter()
+
+    def lap(self, stage: str):
+        now = time.perf_counter()
+        self._metrics.observe(STAGE_SECONDS, (self._topic, stage), now - self._last)
+        self._last = now
+
+
+class Metrics:
+    def __init__(self, enabled: bool = True, buckets: tuple = LATENCY_BUCKETS):
+        self.enabled = enabled
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        # histograms: name -> labels -> [bucket counts..., +Inf count, sum]
+        self._histograms: dict[str, dict[tuple, list]] = {}
+        self._counters: dict[str, dict[tuple, float]] = {}
+        self._collectors: dict[str, callable] = {}
+        self._sections: dict[str, callable] = {}
+
+    # --- Recording ---
+
+    def observe(self, name: str, labels: tuple, seconds: float):
+        if not self.enabled:
+            return
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            values = series.get(labels)
+            if values is None:
+                values = series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            values[index] += 1
+            values[-1] += seconds
+
+    def inc(self, name: str, labels: tuple, value: float = 1):
+        if not self.enabled:
+            return
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[labels] = series.get(labels, 0) + value
+
+    def stage_timer(self, topic: str) -> StageTimer:
+        return StageTimer(self, topic)
+
+    def register_collector(self, prefix: str, collector):
+        """
+        Registers a function returning a dict of gauges (e.g. Dispatcher.stats), exported as <prefix>_<key>.
+        """
+        self._collectors[prefix] = collector
+
+    def register_section(self, name: str, section):
+        """
+        Registers a function returning a JSON document (str), written to its own file along with each snapshot,
+        e.g. LatencyWindows.snapshot_json.
+        """
+        self._sections[name] = section
+
+    # --- Snapshots ---
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            histograms = {
+                name: [{"labels": list(labels), "values": list(values)} for labels, values in series.items()]
+                for name, series in self._histograms.items()
+            }
+            counters = {
+                name: [{"labels": list(labels), "value": value} for labels, value in series.items()]
+                for name, series in self._counters.items()
+            }
+        gauges = {}
+        for prefix, collector in list(self._collectors.items()):
+            try:
+                for key, value in collector().items():
+                    if isinstance(value, (int, float)):
+                        gauges[f"{prefix}_{key}"] = float(value)
+            except Exception:
+                logging.exception(f"[Metrics] Collector {prefix} failed")
+        return {
+            "buckets": list(self.buckets),
+            "histograms": histograms,
+            "counters": counters,
+            "gauges": gauges,
+            "written_at": time.time(),
+        }
+
+    def write_snapshot(self, path: str):
+        _write_file(path, json.dumps(self.snapshot()))
+
+    def write_sections(self, directory: str, name: str):
+        for section_name, section in list(self._sections.items()):
+            try:
+                content = section()
+            except Exception:
+                logging.exception(f"[Metrics] Section {section_name} failed")
+                continue
+            os.makedirs(os.path.join(directory, section_name), exist_ok=True)
+            _write_file(os.path.join(directory, section_name, f"{name}.json"), content)
+
+
+def _write_file(path: str, content: str):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+
+class SnapshotWriter:
+    """
+    Periodically writes the snapshot of a registry to METRICS_DIR/<name>.json.
+    """
+
+    def __init__(self, registry: Metrics, name: str, directory: str = METRICS_DIR, interval: float = METRICS_WRITE_INTERVAL):
+        self.registry = registry
+        self.name = name
+        self.directory = directory
+        self.path = os.path.join(directory, f"{name}.json")
+        self.interval = interval
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def _write(self):
+        try:
+            self.registry.write_snapshot(self.path)
+            self.registry.write_sections(self.directory, self.name)
+        except OSError as e:
+            logging.warning(f"[Metrics] Could not write {self.path}: {e}")
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self._write()
+
+    def start(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self._thread = threading.Thread(target=self._run, name="metrics-writer", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stopped.set()
+        self._thread.join()
+        self._write()
+
+
+_writer: SnapshotWriter = None
+
+
+def start_metrics_writer(name: str = "subscriber"):
+    """
+    Starts writing the snapshots of this process, if metrics are enabled. Processes running side by
+    side must use different names.
+    """
+    global _writer
+    if not METRICS_ENABLED or _writer is not None:
+        return
+    _writer = SnapshotWriter(metrics, name)
+    _writer.start()
+
+
+def stop_metrics_writer():
+    global _writer
+    if _writer is not None:
+        _writer.stop()
+        _writer = None
+
+
+# --- Prometheus exposition ---
+
+def read_snapshots(directory: str = METRICS_DIR, stale_after: float = METRICS_STALE_AFTER) -> dict[str, dict]:
+    """
+    Returns the snapshots of METRICS_DIR by process name, skipping those of processes that stopped writing.
+    """
+    snapshots = {}
+    oldest = time.time() - stale_after
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return snapshots
+    for file_name in names:
+        if not file_name.endswith(".json"):
+            continue
+        try:
+            with open(os.path.join(directory, file_name)) as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError):
+            continue  # being replaced or removed
+        if snapshot.get("written_at", 0) >= oldest:
+            snapshots[file_name[:-len(".json")]] = snapshot
+    return snapshots
+
+
+def read_sections(name: str, directory: str = METRICS_DIR, stale_after: float = METRICS_STALE_AFTER) -> dict[str, dict]:
+    """
+    Returns a section of every process by process name, skipping those of processes that stopped writing.
+    """
+    sections = {}
+    oldest = time.time() - stale_after
+    directory = os.path.join(directory, name)
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return sections
+    for file_name in names:
+        if not file_name.endswith(".json"):
+            continue
+        path = os.path.join(directory, file_name)
+        try:
+            if os.path.getmtime(path) < oldest:
+                continue
+            with open(path) as f:
+                sections[file_name[:-len(".json")]] = json.load(f)
+        except (OSError, ValueError):
+            continue  # being replaced or removed
+    return sections
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names, values) -> str:
+    pairs = ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+    return "{" + pairs + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+def render_prometheus(snapshots: dict[str, dict]) -> str:
+    """
+    Merges the snapshots of every process (histograms and counters are summed, gauges are labelled
+    with their process) and renders them in the Prometheus text exposition format.
+    """
+    histograms: dict[str, dict[tuple, list]] = {}
+    counters: dict[str, dict[tuple, float]] = {}
+    buckets = LATENCY_BUCKETS
+    for snapshot in snapshots.values():
+        buckets = tuple(snapshot.get("buckets", buckets))
+        for name, series in snapshot.get("histograms", {}).items():
+            merged = histograms.setdefault(name, {})
+            for entry in series:
+                labels = tuple(entry["labels"])
+                if labels in merged:
+                    merged[labels] = [a + b for a, b in zip(merged[labels], entry["values"])]
+                else:
+                    merged[labels] = list(entry["values"])
+        for name, series in snapshot.get("counters", {}).items():
+            merged = counters.setdefault(name, {})
+            for entry in series:
+                labels = tuple(entry["labels"])
+                merged[labels] = merged.get(labels, 0) + entry["value"]
+
+    lines = []
+    for name, series in histograms.items():
+        _, label_names, help_text = METRICS.get(name, ("histogram", (), ""))
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} histogram")
+        for labels, values in sorted(series.items()):
+            cumulative = 0
+            for bound, count in zip(buckets + ("+Inf",), values[:-1]):
+                cumulative += count
+                bucket_labels = _format_labels(label_names + ("le",), labels + (bound,))
+                lines.append(f"{name}_bucket{bucket_labels} {cumulative}")
+            lines.append(f"{name}_sum{_format_labels(label_names, labels)} {_format_value(values[-1])}")
+            lines.append(f"{name}_count{_format_labels(label_names, labels)} {cumulative}")
+    for name, series in counters.items():
+        _, label_names, help_text = METRICS.get(name, ("counter", (), ""))
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} counter")
+        for labels, value in sorted(series.items()):
+            lines.append(f"{name}{_format_labels(label_names, labels)} {_format_value(value)}")
+
+    gauges: dict[str, list] = {}
+    for process, snapshot in sorted(snapshots.items()):
+        for key, value in snapshot.get("gauges", {}).items():
+            gauges.setdefault(f"esn_subscriber_{key}", []).append((process, value))
+        gauges.setdefault("esn_subscriber_snapshot_timestamp_seconds", []).append((process, snapshot.get("written_at", 0)))
+    for name, samples in gauges.items():
+        lines.append(f"# TYPE {name} gauge")
+        for process, value in samples:
+            lines.append(f"{name}{_format_labels(('process',), (process,))} {_format_value(value)}")
+    return "\n".join(lines) + "\n"
+
+
+metrics = Metrics(enabled=METRICS_ENABLED)
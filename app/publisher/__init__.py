@@ -3,6 +3,7 @@ from fastapi.middleware.cors import CORSMiddleware
 from starlette.middleware.sessions import SessionMiddleware
 from app.publisher.api import mqtt_lifespan
 from app.publisher.api.routes import api_router
+from app.publisher.api.metrics import metrics_router
 
 from app.core.config import (
     SECRET_KEY,
@@ -22,3 +23,4 @@ app.add_middleware(
 
 # --- Include API Router ---
 app.include_router(api_router, prefix="/api/v1")
+app.include_router(metrics_router)
@@ -1,16 +1,26 @@
+import json
 from fastapi import APIRouter
 from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi_mqtt.config import MQTTConfig
 from fastapi_mqtt.fastmqtt import FastMQTT
 from gmqtt.mqtt.constants import MQTTv311
+from app.publisher.api.acks import ack_storage
+from app.publisher.api.correlation import correlation_index
+from app.publisher.api.shadow import device_shadow
+from app.publisher.api.workers import publisher_worker
+from app.core.log import get_logger, setup_logging
+from app.core.metrics import start_metrics_writer, stop_metrics_writer
 from app.core.config import (
     MQTT_BROKER_HOST,
     MQTT_BROKER_PORT,
     MQTT_PUBLISHER_CLIENT_ID,
+    DEVICE_RESPONSE_TOPIC,
 )
 
 
+log = get_logger(__name__)
+
 # --- Init FastMQTT ---
 fast_mqtt = FastMQTT(
     config=MQTTConfig(
@@ -19,21 +29,79 @@ fast_mqtt = FastMQTT(
         version=MQTTv311
     ),
     client_id=MQTT_PUBLISHER_CLIENT_ID,
-    clean_session=False
+    clean_session=False,
+    # resolves the broker acknowledgements awaited by command batches
+    persistent_storage=ack_storage,
 )
 
+def set_client_id(client_id: str):
+    """
+    Sets the client ID the publisher connects with. fastapi_mqtt creates its gmqtt client, with its client ID,
+    at import time, before the worker slot is claimed. gmqtt (0.6 to 0.8) exposes no setter, the client ID is
+    its Client._client_id, read when connecting.
+    """
+    client = fast_mqtt.client
+    if not hasattr(client, "_client_id"):
+        raise RuntimeError(f"Cannot set the MQTT client ID of {type(client).__module__}.{type(client).__name__}")
+    client._client_id = client_id
+
+
 @asynccontextmanager
 async def mqtt_lifespan(app: FastAPI):
+    """
+    Connects this worker to the broker and the device shadow. Workers of a multi-worker publisher first
+    claim their slot, which gives them their client ID, and write metrics snapshots like the subscribers.
+    """
+    setup_logging()
+    publisher_worker.claim()
+    set_client_id(publisher_worker.client_id)
+    if publisher_worker.multi_worker:
+        start_metrics_writer(f"publisher-{publisher_worker.slot}")
+    await device_shadow.connect()
     await fast_mqtt.mqtt_startup()
-    yield
-    await fast_mqtt.mqtt_shutdown()
+    try:
+        yield
+    finally:
+        await fast_mqtt.mqtt_shutdown()
+        publisher_worker.set_connected(False)
+        await device_shadow.close()
+        stop_metrics_writer()
+        publisher_worker.release()
 
 
 # --- MQTT Client ---
 @fast_mqtt.on_connect()
 def connect(client, flags, rc, properties):
-    print("Connected: ", client, flags, rc, properties)
+    log.info("mqtt.connected", client_id=publisher_worker.client_id, rc=rc, flags=flags)
+    publisher_worker.set_connected(True)
 
 @fast_mqtt.on_disconnect()
 def disconnect(client, packet, exc=None):
-    print("Disconnected")
+    log.warning("mqtt.disconnected", client_id=publisher_worker.client_id)
+    publisher_worker.set_connected(False)
+
+@fast_mqtt.subscribe(DEVICE_RESPONSE_TOPIC, qos=1)
+async def device_response(client, topic, payload, qos, properties):
+    """
+    Resolves the pending GET command of a device response and updates the device shadow,
+    the subscriber forwards the response upstream.
+    """
+    # response_topic: response/<device_name>/<property_name>/<method>/<uuid>
+    levels = topic.split("/")
+    if len(levels) != 5:
+        return
+    _, device_name, property_name, method, command_uuid = levels
+    # every worker of a multi-worker publisher receives the response, the one that sent the command handles it
+    if not publisher_worker.handles_response(command_uuid):
+        return
+    try:
+        property_value = json.loads(payload)
+    except ValueError:
+        log.warning("response.invalid", device_name, command_uuid=command_uuid, property=property_name)
+        return
+    log.payload("response.payload", device_name, command_uuid=command_uuid, payload=payload.decode(errors="replace"))
+    if isinstance(property_value, dict):
+        property_value = property_value.get(property_name, property_value)
+    correlation_index.resolve(command_uuid, property_value)
+    await device_shadow.update([device_name], property_name, property_value, source="response")
+
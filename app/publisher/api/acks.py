@@ -0,0 +1,61 @@
+"""
+Broker acknowledgements of the commands published by this process.
+
+Commands are published with QoS 1: gmqtt keeps each publish in its persistent storage, under its packet
+identifier (mid), until the broker answers with a PUBACK, and replays the stored publishes in sending order
+after a reconnect. The publisher client is created with an AckStorage, which resolves a future per tracked
+publish once its PUBACK arrives, so that a request can wait for the broker to have taken its commands over.
+A publish dropped from the storage without PUBACK (the broker lost the session, or its mid was reused for
+a new publish) resolves its future with False.
+"""
+import asyncio
+from typing import Optional
+from gmqtt.storage import PersistentStorage
+
+
+class AckStorage(PersistentStorage):
+    def __init__(self):
+        super().__init__()
+        # mid of the last stored publish, read right after publishing
+        self.last_mid: Optional[int] = None
+        self._waiters: dict[int, asyncio.Future] = {}
+
+    def push_message(self, mid, raw_package):
+        # a reused mid replaces a publish that will never be acknowledged on its own
+        self._resolve(self._waiters.pop(mid, None), False)
+        super().push_message(mid, raw_package)
+        self.last_mid = mid
+
+    def remove_message_by_mid(self, mid):
+        super().remove_message_by_mid(mid)
+        self._resolve(self._waiters.pop(mid, None), True)
+
+    def clear(self):
+        super().clear()
+        waiters, self._waiters = self._waiters, {}
+        for waiter in waiters.values():
+            self._resolve(waiter, False)
+
+    @staticmethod
+    def _resolve(waiter: Optional[asyncio.Future], acked: bool):
+        if waiter is not None and not waiter.done():
+            waiter.set_result(acked)
+
+    def track_last(self) -> asyncio.Future:
+        """
+        Returns a future resolved with True once the broker acknowledges the last publish, must be called from
+        the event loop right after publishing.
+        """
+        if self.last_mid in self._waiters:
+            # already tracked, every caller waits on the same future
+            return self._waiters[self.last_mid]
+        waiter = asyncio.get_running_loop().create_future()
+        if self.last_mid is None or self.last_mid not in self._messages:
+            # QoS 0 or already acknowledged
+            waiter.set_result(True)
+        else:
+            self._waiters[self.last_mid] = waiter
+        return waiter
+
+
+ack_storage = AckStorage()
@@ -0,0 +1,130 @@
+"""
+Correlation of GET commands with the responses of the devices.
+
+Every GET command published by this process is registered under its command UUID. The publisher
+subscribes to DEVICE_RESPONSE_TOPIC (response/<device_name>/<property_name>/<method>/<uuid>) and
+resolves the pending command of each response, recording the command round-trip time. Resolved
+commands stay in the index, so their response is found by requests waiting on them, and entries are
+evicted COMMAND_CORRELATION_TTL seconds after the command was sent. Once more than
+COMMAND_CORRELATION_MAX_ENTRIES commands are indexed, the answered ones are evicted first, oldest first.
+Only then are unanswered commands evicted, oldest first, and requests waiting on them report them as
+"evicted" instead of timing out.
+"""
+import time
+import asyncio
+from collections import OrderedDict
+from app.core.metrics import metrics, COMMAND_RTT_SECONDS, COMMAND_RESPONSES_TOTAL
+from app.publisher.api import schemas
+from app.core.config import (
+    COMMAND_CORRELATION_TTL,
+    COMMAND_CORRELATION_MAX_ENTRIES,
+)
+
+
+class PendingCommand:
+    __slots__ = ("target", "property_name", "sent_at", "future")
+
+    def __init__(self, target: str, property_name: str, future: asyncio.Future):
+        self.target = target
+        self.property_name = property_name
+        self.sent_at = time.monotonic()
+        self.future = future
+
+
+class CorrelationIndex:
+    def __init__(self, ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max(1, max_entries)
+        # insertion order is sending order, the oldest command is always first
+        self._pending: OrderedDict[str, PendingCommand] = OrderedDict()
+        # command UUIDs of the answered commands, in answering order
+        self._answered: OrderedDict[str, None] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def _evict(self):
+        oldest = time.monotonic() - self.ttl
+        while self._pending:
+            command_uuid, pending = next(iter(self._pending.items()))
+            if pending.sent_at >= oldest:
+                break
+            del self._pending[command_uuid]
+            self._answered.pop(command_uuid, None)
+            if not pending.future.done():
+                metrics.inc(COMMAND_RESPONSES_TOTAL, (pending.property_name, "expired"))
+        # answered commands go first, their waiters already have the response
+        while len(self._pending) > self.max_entries and self._answered:
+            command_uuid, _ = self._answered.popitem(last=False)
+            self._pending.pop(command_uuid, None)
+        while len(self._pending) > self.max_entries:
+            _, pending = self._pending.popitem(last=False)
+            pending.future.cancel()
+            metrics.inc(COMMAND_RESPONSES_TOTAL, (pending.property_name, "evicted"))
+
+    def register(self, command_uuid: str, target: str, property_name: str) -> PendingCommand:
+        """
+        Registers a command about to be published, must be called from the event loop.
+        """
+        pending = PendingCommand(target, property_name, asyncio.get_running_loop().create_future())
+        self._pending[command_uuid] = pending
+        self._evict()
+        return pending
+
+    def resolve(self, command_uuid: str, property_value) -> bool:
+        """
+        Resolves a pending command with the property value answered by the device.
+        Returns False if the command is unknown, e.g. sent by another publisher or already evicted.
+        """
+        pending = self._pending.get(command_uuid)
+        if pending is None:
+            metrics.inc(COMMAND_RESPONSES_TOTAL, ("unknown", "unmatched"))
+            return False
+        if pending.future.done():
+            metrics.inc(COMMAND_RESPONSES_TOTAL, (pending.property_name, "duplicate"))
+            return True
+        rtt = time.monotonic() - pending.sent_at
+        metrics.observe(COMMAND_RTT_SECONDS, (pending.property_name,), rtt)
+        metrics.inc(COMMAND_RESPONSES_TOTAL, (pending.property_name, "matched"))
+        pending.future.set_result((property_value, rtt))
+        self._answered[command_uuid] = None
+        return True
+
+    async def wait(self, results: list[schemas.PublishResult], timeout: float) -> list[schemas.CommandResponse]:
+        """
+        Waits up to timeout seconds for the responses to the published commands of results. Commands evicted
+        before being answered are reported as "evicted".
+        """
+        futures = {}
+        for result in results:
+            pending = self._pending.get(result.command_uuid)
+            if result.published and pending is not None:
+                futures[result.command_uuid] = pending.future
+        if futures:
+            await asyncio.wait(list(futures.values()), timeout=timeout)
+
+        responses = []
+        for result in results:
+            future = futures.get(result.command_uuid)
+            if not result.published:
+                status = "failed"
+            elif future is None or future.cancelled():
+                # every published command is registered, a missing one was evicted before this wait
+                status = "evicted"
+            elif future.done():
+                property_value, rtt = future.result()
+                responses.append(schemas.CommandResponse(
+                    target=result.target,
+                    command_uuid=result.command_uuid,
+                    status="answered",
+                    property_value=property_value,
+                    rtt_ms=rtt * 1000,
+                ))
+                continue
+            else:
+                status = "timeout"
+            responses.append(schemas.CommandResponse(target=result.target, command_uuid=result.command_uuid, status=status))
+        return responses
+
+
+correlation_index = CorrelationIndex(COMMAND_CORRELATION_TTL, COMMAND_CORRELATION_MAX_ENTRIES)
@@ -0,0 +1,41 @@
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse, JSONResponse
+from app.core.metrics import metrics, read_snapshots, render_prometheus
+from app.publisher.api.workers import publisher_worker
+
+# --- Init FastAPI Router ---
+metrics_router = APIRouter()
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+@metrics_router.get("/metrics", tags=["Monitoring"], response_class=PlainTextResponse)
+def get_metrics():
+    """
+    Subscriber metrics in the Prometheus text exposition format.
+
+    Per-stage latency histograms (validate, b64, zlib, parse, convert, schema, total) by topic, Gateway API POST
+    latencies by endpoint, message, error and drop counters, summed over every subscriber process,
+    plus the dispatcher, pipeline and spool gauges of each process, and the command round-trip times
+    recorded by the publisher workers.
+    """
+    snapshots = read_snapshots()
+    if metrics.enabled:
+        # the snapshot of this worker is fresher than the one it last wrote
+        name = f"publisher-{publisher_worker.slot}" if publisher_worker.multi_worker else "publisher"
+        snapshots[name] = metrics.snapshot()
+    return PlainTextResponse(render_prometheus(snapshots), media_type=PROMETHEUS_CONTENT_TYPE)
+
+
+@metrics_router.get("/ready", tags=["Monitoring"])
+def get_readiness():
+    """
+    Readiness of the publisher: 200 once every worker is running and connected to the broker, 503 otherwise.
+    Reports the slot, client ID and broker connectivity of each worker.
+    """
+    workers = publisher_worker.states()
+    ready = all(worker["alive"] and worker["connected"] for worker in workers)
+    return JSONResponse(
+        {"ready": ready, "slot": publisher_worker.slot, "workers": workers},
+        status_code=200 if ready else 503,
+    )
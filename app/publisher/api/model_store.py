@@ -0,0 +1,387 @@
+"""
+Content-addressed sensor model store and chunked model delivery.
+
+Uploaded models are streamed to MODEL_STORE_DIR/<sha256>.bin, so each model is stored once whatever
+the number of uploads. A model is delivered to a sensor as:
+
+    1. a SET sensor-model-manifest command, a JSON SensorModelManifest (hash, size, chunk size and count);
+    2. one SET sensor-model-chunk command per chunk, with a binary payload made of a CHUNK_HEADER
+       (raw sha256 digest, chunk index, chunk count, all big-endian) followed by at most
+       MODEL_CHUNK_SIZE bytes of the model.
+
+The delivery progress of each sensor is kept in MODEL_STORE_DIR/deliveries.json, or in one
+deliveries-<slot>.json per worker of a multi-worker publisher, merged on read. An interrupted
+delivery resumes from the first chunk that was not published, and pushing a model that was already
+fully delivered to a sensor is a no-op unless forced.
+"""
+import os
+import re
+import glob
+import math
+import json
+import time
+import uuid
+import struct
+import asyncio
+import hashlib
+import tempfile
+from collections import OrderedDict
+from typing import AsyncIterator, Optional
+
+from fastapi_mqtt import FastMQTT
+from pydantic_core import to_json
+from app.publisher.api import schemas
+from app.publisher.api.utils import drain
+from app.publisher.api.workers import PublisherWorker, publisher_worker
+from app.core.log import get_logger
+from app.core.config import (
+    DEVICE_CMD_TOPIC_TEMPLATE,
+    COMMAND_PUBLISH_WINDOW,
+    MODEL_STORE_DIR,
+    MODEL_CHUNK_SIZE,
+    MODEL_MAX_BYTES,
+    MODEL_ROLLOUT_CONCURRENCY,
+)
+
+log = get_logger(__name__)
+
+CHUNK_HEADER = struct.Struct(">32sII")
+SHA256_PATTERN = re.compile(r"[0-9a-f]{64}")
+MODEL_SUFFIX = ".bin"
+DELIVERIES_FILE = "deliveries.json"
+# delivery progress is persisted at most this often while chunks are published
+DELIVERIES_SAVE_INTERVAL = 1.0
+# chunk payloads kept in memory, the targets of a rollout go through the same chunks
+CHUNK_CACHE_ENTRIES = 64
+
+
+class ModelTooLarge(Exception):
+    pass
+
+
+class ModelStore:
+    def __init__(self, directory: str, chunk_size: int, max_bytes: int, cache_entries: int = CHUNK_CACHE_ENTRIES):
+        self.directory = directory
+        self.chunk_size = chunk_size
+        self.max_bytes = max_bytes
+        self.cache_entries = max(1, cache_entries)
+        # (sha256, index) -> chunk payload, least recently used first
+        self._chunks: OrderedDict[tuple[str, int], bytes] = OrderedDict()
+
+    def path(self, sha256: str) -> str:
+        return os.path.join(self.directory, f"{sha256}{MODEL_SUFFIX}")
+
+    def exists(self, sha256: str) -> bool:
+        return SHA256_PATTERN.fullmatch(sha256) is not None and os.path.exists(self.path(sha256))
+
+    def bytesize(self, sha256: str) -> int:
+        return os.path.getsize(self.path(sha256))
+
+    def chunk_count(self, sha256: str) -> int:
+        return max(1, -(-self.bytesize(sha256) // self.chunk_size))
+
+    async def save(self, stream: AsyncIterator[bytes]) -> tuple[str, int, bool]:
+        """
+        Streams an uploaded model to the store, returns its sha256, its size and whether it was already stored.
+        The file is written off the event loop.
+        """
+        digest = hashlib.sha256()
+        bytesize = 0
+        os.makedirs(self.directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                async for data in stream:
+                    bytesize += len(data)
+                    if bytesize > self.max_bytes:
+                        raise ModelTooLarge(f"Models are limited to {self.max_bytes} bytes")
+                    digest.update(data)
+                    await asyncio.to_thread(f.write, data)
+            sha256 = digest.hexdigest()
+            if os.path.exists(self.path(sha256)):
+                os.remove(tmp_path)
+                return sha256, bytesize, True
+            os.replace(tmp_path, self.path(sha256))
+            return sha256, bytesize, False
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def manifest(self, sha256: str, tf_model_bytesize: int) -> schemas.SensorModelManifest:
+        return schemas.SensorModelManifest(
+            sha256=sha256,
+            bytesize=self.bytesize(sha256),
+            chunk_size=self.chunk_size,
+            chunks=self.chunk_count(sha256),
+            tf_model_bytesize=tf_model_bytesize,
+        )
+
+    async def chunks(self, sha256: str, start: int, stop: int) -> list[bytes]:
+        """
+        Returns the MQTT payloads of chunks start to stop (excluded). Targets of a rollout go through the same
+        chunks, the last cache_entries chunks read are cached. Chunks not cached are read off the event loop,
+        in one call.
+        """
+        payloads = {}
+        for index in range(start, stop):
+            key = (sha256, index)
+            payload = self._chunks.get(key)
+            if payload is not None:
+                self._chunks.move_to_end(key)
+                payloads[index] = payload
+        missing = [index for index in range(start, stop) if index not in payloads]
+        if missing:
+            for index, payload in zip(missing, await asyncio.to_thread(self._read_chunks, sha256, missing)):
+                payloads[index] = self._chunks[(sha256, index)] = payload
+            while len(self._chunks) > self.cache_entries:
+                self._chunks.popitem(last=False)
+        return [payloads[index] for index in range(start, stop)]
+
+    def _read_chunks(self, sha256: str, indexes: list[int]) -> list[bytes]:
+        header = bytes.fromhex(sha256)
+        count = self.chunk_count(sha256)
+        with open(self.path(sha256), "rb") as f:
+            return [
+                CHUNK_HEADER.pack(header, index, count) + os.pread(f.fileno(), self.chunk_size, index * self.chunk_size)
+                for index in indexes
+            ]
+
+
+class DeliveryLedger:
+    """
+    Delivery progress of the latest model pushed to each sensor, persisted to JSON files.
+
+    Each worker of a multi-worker publisher saves its own deliveries-<slot>.json and reads the files of the
+    other workers, keeping the latest entry of each sensor, so workers never overwrite each other's progress.
+    """
+
+    def __init__(self, directory: str, worker: PublisherWorker = publisher_worker):
+        self.directory = directory
+        self.worker = worker
+        self._path: Optional[str] = None
+        self._deliveries: dict[str, dict] = {}
+        # path -> (mtime, deliveries) of the files of the other workers
+        self._others: dict[str, tuple[float, dict]] = {}
+        self._saved_at = 0.0
+        # saves are written one at a time, so an older copy never replaces a newer one
+        self._save_lock = asyncio.Lock()
+
+    @property
+    def path(self) -> str:
+        # the worker slot is claimed at startup, after the ledger is created
+        name = f"deliveries-{self.worker.slot}.json" if self.worker.multi_worker else DELIVERIES_FILE
+        return os.path.join(self.directory, name)
+
+    def _own(self) -> dict[str, dict]:
+        path = self.path
+        if path != self._path:
+            self._path = path
+            self._deliveries = _read_deliveries(path) or {}
+        return self._deliveries
+
+    def deliveries(self) -> dict[str, dict]:
+        """
+        Returns the latest delivery of each sensor, across the ledgers of every worker.
+        """
+        own = self._own()
+        if not self.worker.multi_worker:
+            return own
+        merged = {}
+        for path in glob.glob(os.path.join(self.directory, "deliveries*.json")):
+            if path != self._path:
+                for device, delivery in self._read_other(path).items():
+                    if device not in merged or merged[device]["updated_at"] < delivery["updated_at"]:
+                        merged[device] = delivery
+        for device, delivery in own.items():
+            if device not in merged or merged[device]["updated_at"] <= delivery["updated_at"]:
+                merged[device] = delivery
+        return merged
+
+    def _read_other(self, path: str) -> dict[str, dict]:
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            return {}
+        cached = self._others.get(path)
+        if cached is None or cached[0] != mtime:
+            deliveries = _read_deliveries(path)
+            if deliveries is None:
+                # being replaced, the previous read is kept
+                return cached[1] if cached is not None else {}
+            cached = self._others[path] = (mtime, deliveries)
+        return cached[1]
+
+    def get(self, device: str, sha256: str, deliveries: Optional[dict[str, dict]] = None) -> Optional[dict]:
+        delivery = (deliveries if deliveries is not None else self.deliveries()).get(device)
+        if delivery is None or delivery["sha256"] != sha256:
+            return None
+        return delivery
+
+    def record(self, device: str, sha256: str, next_chunk: int, complete: bool = False, active: bool = True):
+        self._own()[device] = {
+            "sha256": sha256,
+            "next_chunk": next_chunk,
+            "complete": complete,
+            # the worker publishing the delivery, for the other workers
+            "slot": self.worker.slot,
+            "active": active and not complete,
+            "updated_at": time.time(),
+        }
+
+    def release(self, device: str, sha256: str):
+        """
+        Records that this worker stopped publishing a delivery, complete or not.
+        """
+        delivery = self._own().get(device)
+        if delivery is not None and delivery["sha256"] == sha256 and delivery["active"]:
+            self.record(device, sha256, delivery["next_chunk"], delivery["complete"], active=False)
+
+    async def update(self, device: str, sha256: str, next_chunk: int, complete: bool = False):
+        self.record(device, sha256, next_chunk, complete)
+        if complete or time.monotonic() - self._saved_at > DELIVERIES_SAVE_INTERVAL:
+            await self.save()
+
+    async def save(self):
+        """
+        Writes the deliveries off the event loop, from a copy taken on it.
+        """
+        path = self.path
+        self._saved_at = time.monotonic()
+        async with self._save_lock:
+            await asyncio.to_thread(self._write, path, dict(self._own()))
+
+    def _write(self, path: str, deliveries: dict):
+        directory = os.path.dirname(path) or "."
+        os.makedirs(directory, exist_ok=True)
+        # concurrent saves each write their own temporary file
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(deliveries, f)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+
+def _read_deliveries(path: str) -> Optional[dict[str, dict]]:
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError):
+        return None
+
+
+class ModelDistributor:
+    def __init__(self, store: ModelStore, ledger: DeliveryLedger, concurrency: int):
+        self.store = store
+        self.ledger = ledger
+        # the workers of a multi-worker publisher share the rollout concurrency
+        self.concurrency = max(1, math.ceil(concurrency / ledger.worker.workers))
+        # shared by every rollout, so concurrent rollouts stay within the concurrency together
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        self._tasks: set[asyncio.Task] = set()
+        # (target, sha256) deliveries being published
+        self._active: set[tuple[str, str]] = set()
+
+    def plan(self, sha256: str, targets: list[str], force: bool = False) -> list[schemas.ModelDeliveryStatus]:
+        """
+        Returns the delivery each target needs: skipped if it already has the model or is receiving it from
+        any worker, resumed otherwise.
+        """
+        chunks = self.store.chunk_count(sha256)
+        deliveries = self.ledger.deliveries()
+        plan = []
+        for target in targets:
+            delivery = self.ledger.get(target, sha256, deliveries)
+            if (target, sha256) in self._active or self._active_elsewhere(delivery):
+                next_chunk = delivery["next_chunk"] if delivery is not None else 0
+                plan.append(schemas.ModelDeliveryStatus(target=target, status="in-progress", next_chunk=next_chunk, chunks=chunks))
+            elif delivery is not None and delivery["complete"] and not force:
+                plan.append(schemas.ModelDeliveryStatus(target=target, status="skipped", next_chunk=chunks, chunks=chunks))
+            else:
+                next_chunk = 0 if delivery is None or force else delivery["next_chunk"]
+                plan.append(schemas.ModelDeliveryStatus(target=target, status="scheduled", next_chunk=next_chunk, chunks=chunks))
+        return plan
+
+    def _active_elsewhere(self, delivery: Optional[dict]) -> bool:
+        worker = self.ledger.worker
+        if delivery is None or not delivery.get("active") or delivery.get("slot", worker.slot) == worker.slot:
+            return False
+        return worker.slot_alive(delivery["slot"])
+
+    async def _deliver(self, fast_mqtt: FastMQTT, manifest: bytes, sha256: str, target: str, next_chunk: int):
+        try:
+            async with self._semaphore:
+                await self._publish_chunks(fast_mqtt, manifest, sha256, target, next_chunk)
+        finally:
+            self._active.discard((target, sha256))
+            self.ledger.release(target, sha256)
+
+    async def _publish_chunks(self, fast_mqtt: FastMQTT, manifest: bytes, sha256: str, target: str, next_chunk: int):
+        # the manifest is sent on resume too, sensors keep the chunks already received for the same sha256
+        topic = DEVICE_CMD_TOPIC_TEMPLATE % (target, "sensor-model-manifest", "set", str(uuid.uuid4()))
+        fast_mqtt.client.publish(topic, manifest, qos=1, retain=False)
+
+        chunks = self.store.chunk_count(sha256)
+        for start in range(next_chunk, chunks, COMMAND_PUBLISH_WINDOW):
+            stop = min(start + COMMAND_PUBLISH_WINDOW, chunks)
+            for payload in await self.store.chunks(sha256, start, stop):
+                topic = DEVICE_CMD_TOPIC_TEMPLATE % (target, "sensor-model-chunk", "set", str(uuid.uuid4()))
+                fast_mqtt.client.publish(topic, payload, qos=1, retain=False)
+            if stop < chunks:
+                await drain(fast_mqtt)
+                await self.ledger.update(target, sha256, stop)
+        await drain(fast_mqtt)
+        await self.ledger.update(target, sha256, chunks, complete=True)
+
+    async def _rollout(self, fast_mqtt: FastMQTT, sha256: str, tf_model_bytesize: int, plan: list[schemas.ModelDeliveryStatus]):
+        manifest = to_json({"sensor-model-manifest": self.store.manifest(sha256, tf_model_bytesize)})
+        scheduled = [delivery for delivery in plan if delivery.status == "scheduled"]
+        for delivery in scheduled:
+            self.ledger.record(delivery.target, sha256, delivery.next_chunk)
+        await self.ledger.save()
+        results = await asyncio.gather(
+            *(self._deliver(fast_mqtt, manifest, sha256, delivery.target, delivery.next_chunk) for delivery in scheduled),
+            return_exceptions=True,
+        )
+        await self.ledger.save()
+        failed = [(delivery.target, result) for delivery, result in zip(scheduled, results) if isinstance(result, Exception)]
+        for target, error in failed:
+            log.warning("model.delivery_interrupted", target, sha256=sha256, error=str(error))
+        log.info("model.rollout_finished", sha256=sha256, delivered=len(scheduled) - len(failed), scheduled=len(scheduled))
+
+    def rollout(self, fast_mqtt: FastMQTT, sha256: str, tf_model_bytesize: int, plan: list[schemas.ModelDeliveryStatus]):
+        """
+        Delivers a model to the scheduled targets of a plan in the background, at most MODEL_ROLLOUT_CONCURRENCY at a
+        time across the workers.
+        """
+        self._active.update((delivery.target, sha256) for delivery in plan if delivery.status == "scheduled")
+        task = asyncio.create_task(self._rollout(fast_mqtt, sha256, tf_model_bytesize, plan))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def status(self, sha256: str, targets: list[str]) -> list[schemas.ModelDeliveryStatus]:
+        chunks = self.store.chunk_count(sha256)
+        deliveries = self.ledger.deliveries()
+        statuses = []
+        for target in targets:
+            delivery = self.ledger.get(target, sha256, deliveries)
+            if delivery is None:
+                statuses.append(schemas.ModelDeliveryStatus(target=target, status="pending", next_chunk=0, chunks=chunks))
+            else:
+                status = "delivered" if delivery["complete"] else "in-progress"
+                statuses.append(schemas.ModelDeliveryStatus(target=target, status=status, next_chunk=delivery["next_chunk"], chunks=chunks))
+        return statuses
+
+
+model_store = ModelStore(MODEL_STORE_DIR, MODEL_CHUNK_SIZE, MODEL_MAX_BYTES)
+model_distributor = ModelDistributor(
+    model_store,
+    DeliveryLedger(MODEL_STORE_DIR),
+    MODEL_ROLLOUT_CONCURRENCY,
+)
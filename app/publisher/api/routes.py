@@ -1,13 +1,45 @@
-from fastapi import HTTPException, status, APIRouter
+import time
+import asyncio
+from typing import Annotated, Literal, Optional
+from fastapi import HTTPException, status, APIRouter, Request, Response, Query
 
-from app.core.config import LATENCY_BENCHMARK
+from app.core.config import LATENCY_BENCHMARK, COMMAND_WAIT_TIMEOUT, COMMAND_WAIT_MAX_TIMEOUT, COMMAND_CORRELATION_MAX_ENTRIES
 from app.publisher.api import schemas
 from app.publisher.api import fast_mqtt
-from app.publisher.api.utils import send_cmd_to_devices
+from app.publisher.api.utils import (
+    send_cmd_to_devices,
+    send_command_batch,
+    command_response,
+    wait_for_responses,
+    wait_for_acks,
+    read_shadow,
+)
+from app.publisher.api.shadow import device_shadow
+from app.core.log import debug_devices
+from app.core.metrics import read_sections
+from app.core.latency import merge_snapshots
+from app.publisher.api.model_store import model_store, model_distributor, ModelTooLarge
 
 # --- Init FastAPI Router ---
 api_router = APIRouter()
 
+# --- Query Parameters of GET Commands ---
+Wait = Annotated[bool, Query(description="Wait for the device responses instead of returning right away")]
+WaitTimeout = Annotated[float, Query(gt=0, le=COMMAND_WAIT_MAX_TIMEOUT, description="Seconds to wait for the device responses")]
+WaitAcks = Annotated[bool, Query(description="Wait for the broker to acknowledge the published commands")]
+
+
+def check_wait_targets(targets: int, wait: bool):
+    """
+    Rejects waiting on more GET commands than the correlation index holds, most of them would be evicted
+    before their response arrives.
+    """
+    if wait and targets > COMMAND_CORRELATION_MAX_ENTRIES:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f"wait=true is limited to {COMMAND_CORRELATION_MAX_ENTRIES} GET targets, got {targets}",
+        )
+
 # --- API Endpoints ---
 
 @api_router.post(
@@ -40,11 +72,8 @@ async def set_sensor_state(command: schemas.SetSensorState):
 
     Note that devices DO NOT publish a response for SET commands.
     """
-    cmd_uuids = send_cmd_to_devices(fast_mqtt, command)
-    return {
-        "message": "SET Sensor State Command sent to devices",
-        "command_uuids": cmd_uuids
-    }
+    results = await send_cmd_to_devices(fast_mqtt, command)
+    return command_response("SET Sensor State Command sent to devices", results)
 
 
 @api_router.post(
@@ -52,20 +81,25 @@ async def set_sensor_state(command: schemas.SetSensorState):
     tags=["Edge Sensor Commands"],
     status_code=status.HTTP_202_ACCEPTED,
 )
-async def get_sensor_state(command: schemas.GetSensorState):
+async def get_sensor_state(
+    command: schemas.GetSensorState,
+    response: Response,
+    wait: Wait = False,
+    timeout: WaitTimeout = COMMAND_WAIT_TIMEOUT,
+):
     """
     GET Sensor State Command
 
     This command is used to get the state of a subset of sensors connected to the edge gateway.
 
     Note that devices DO publish a response for GET commands. Each response will be catched by the device handler
-    and sent to the Gateway API for further processing.
+    and sent to the Gateway API for further processing. With wait=true, the responses are also returned by this
+    endpoint, each target that did not answer within timeout seconds is reported with a timeout status.
     """
-    cmd_uuids = send_cmd_to_devices(fast_mqtt, command)
-    return {
-        "message": "GET Sensor State Command sent to devices",
-        "command_uuids": cmd_uuids
-    }
+    check_wait_targets(len(command.target.target_sensors), wait)
+    results = await send_cmd_to_devices(fast_mqtt, command)
+    responses = await wait_for_responses(results, response, wait, timeout)
+    return command_response("GET Sensor State Command sent to devices", results, responses)
 
 
 @api_router.post(
@@ -83,11 +117,8 @@ async def set_sensor_config(command: schemas.SetSensorConfig):
 
     Note that devices DO NOT publish a response for SET commands.
     """
-    cmd_uuids = send_cmd_to_devices(fast_mqtt, command)
-    return {
-        "message": "SET Sensor Config Command sent to devices",
-        "command_uuids": cmd_uuids
-    }
+    results = await send_cmd_to_devices(fast_mqtt, command)
+    return command_response("SET Sensor Config Command sent to devices", results)
     
 
 @api_router.post(
@@ -95,20 +126,25 @@ async def set_sensor_config(command: schemas.SetSensorConfig):
     tags=["Edge Sensor Commands"],
     status_code=status.HTTP_202_ACCEPTED,
 )
-async def get_sensor_config(command: schemas.GetSensorConfig):
+async def get_sensor_config(
+    command: schemas.GetSensorConfig,
+    response: Response,
+    wait: Wait = False,
+    timeout: WaitTimeout = COMMAND_WAIT_TIMEOUT,
+):
     """
     GET Sensor Config Command
 
     This command is used to get the configuration of a subset of sensors connected to the edge gateway.
 
     Note that devices DO publish a response for GET commands. Each response will be catched by the device handler
-    and sent to the Gateway API for further processing.
+    and sent to the Gateway API for further processing. With wait=true, the responses are also returned by this
+    endpoint, each target that did not answer within timeout seconds is reported with a timeout status.
     """
-    cmd_uuids = send_cmd_to_devices(fast_mqtt, command)
-    return {
-        "message": "GET Sensor Config Command sent to devices",
-        "command_uuids": cmd_uuids,
-    }
+    check_wait_targets(len(command.target.target_sensors), wait)
+    results = await send_cmd_to_devices(fast_mqtt, command)
+    responses = await wait_for_responses(results, response, wait, timeout)
+    return command_response("GET Sensor Config Command sent to devices", results, responses)
 
 
 @api_router.post(
@@ -125,31 +161,70 @@ async def set_sensor_inference_layer(command: schemas.SetInferenceLayer):
 
     Note that devices DO NOT publish a response for SET commands.
     """
-    cmd_uuids = send_cmd_to_devices(fast_mqtt, command)
-    return {
-        "message": "SET Sensor Inference Layer Command sent to devices",
-        "command_uuids": cmd_uuids
-    }
+    results = await send_cmd_to_devices(fast_mqtt, command)
+    return command_response("SET Sensor Inference Layer Command sent to devices", results)
 
 @api_router.post(
     "/sensor/command/get/inference-layer",
     tags=["Edge Sensor Commands"],
     status_code=status.HTTP_202_ACCEPTED,
 )
-async def get_sensor_inference_layer(command: schemas.GetInferenceLayer):
+async def get_sensor_inference_layer(
+    command: schemas.GetInferenceLayer,
+    response: Response,
+    wait: Wait = False,
+    timeout: WaitTimeout = COMMAND_WAIT_TIMEOUT,
+):
     """
     GET Sensor Inference Layer Command
 
     This command is used to get the inference layer of a subset of sensors connected to the edge gateway.
 
     Note that devices DO publish a response for GET commands. Each response will be catched by the device handler
-    and sent to the Gateway API for further processing.
+    and sent to the Gateway API for further processing. With wait=true, the responses are also returned by this
+    endpoint, each target that did not answer within timeout seconds is reported with a timeout status.
     """
-    cmd_uuids = send_cmd_to_devices(fast_mqtt, command)
-    return {
-        "message": "GET Sensor Inference Layer Command sent to devices",
-        "command_uuids": cmd_uuids
-    }
+    check_wait_targets(len(command.target.target_sensors), wait)
+    results = await send_cmd_to_devices(fast_mqtt, command)
+    responses = await wait_for_responses(results, response, wait, timeout)
+    return command_response("GET Sensor Inference Layer Command sent to devices", results, responses)
+
+
+@api_router.get(
+    "/sensor/shadow/{property_name}",
+    tags=["Edge Sensor Shadow"],
+    response_model=list[schemas.ShadowEntry],
+)
+async def get_sensor_shadow(
+    property_name: schemas.ShadowProperty,
+    target_sensors: list[str] = Query(),
+    max_age: Optional[float] = Query(None, ge=0, description="Oldest value accepted from cache, in seconds, any age if omitted"),
+    refresh: bool = Query(False, description="Send a GET command to the sensors without a fresh enough value"),
+    timeout: WaitTimeout = COMMAND_WAIT_TIMEOUT,
+):
+    """
+    Sensor Shadow
+
+    Returns the last known sensor-state, sensor-config or inference-layer of a subset of sensors, without
+    a round trip to the sensors. Shadows are updated by SET commands and by the responses to GET commands.
+    Values at most max_age seconds old are returned with a cached status, older ones with a stale status
+    and unknown ones with a missing status. With refresh=true, a GET command is sent to the stale and missing
+    sensors and their responses are waited for up to timeout seconds, as with the wait parameter of GET commands.
+    """
+    return await read_shadow(fast_mqtt, property_name, target_sensors, max_age, refresh, timeout)
+
+
+@api_router.get(
+    "/sensor/{sensor_name}/shadow",
+    tags=["Edge Sensor Shadow"],
+)
+async def get_sensor_shadow_document(sensor_name: str):
+    """
+    Sensor Shadow Document
+
+    Returns every known property of a sensor with its value, source (set or response) and update time.
+    """
+    return await device_shadow.get_all(sensor_name)
 
 
 @api_router.post(
@@ -166,13 +241,108 @@ async def set_sensor_model(command: schemas.SetSensorModel):
     is the base64 encoded bytes of the compressed model using GZIP, while the second attribute is the size
     of the uncompressed model in bytes.
     """
-    cmd_uuids = send_cmd_to_devices(fast_mqtt, command)
+    results = await send_cmd_to_devices(fast_mqtt, command)
+    return command_response("Upload Sensor Model Command Sent to Devices", results)
+
+
+@api_router.post(
+    "/sensor/model",
+    tags=["Edge Sensor Models"],
+    status_code=status.HTTP_201_CREATED,
+    response_model=schemas.StoredSensorModel,
+)
+async def upload_sensor_model(request: Request):
+    """
+    Upload Sensor Model
+
+    Streams the raw bytes of a GZIP compressed model (Content-Type: application/octet-stream) to the model store,
+    where it is kept once under its sha256. Uploading a model that is already stored is a no-op.
+    The returned sha256 is used to roll the model out with /sensor/command/set/sensor-model/{sha256}.
+    """
+    try:
+        sha256, bytesize, already_stored = await model_store.save(request.stream())
+    except ModelTooLarge as e:
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail=str(e))
+    return schemas.StoredSensorModel(
+        sha256=sha256,
+        bytesize=bytesize,
+        chunks=model_store.chunk_count(sha256),
+        already_stored=already_stored,
+    )
+
+
+@api_router.post(
+    "/sensor/command/set/sensor-model/{sha256}",
+    tags=["Edge Sensor Models"],
+    status_code=status.HTTP_202_ACCEPTED,
+)
+async def rollout_sensor_model(sha256: str, rollout: schemas.SensorModelRollout):
+    """
+    SET Sensor Model Command, chunked
+
+    Delivers a stored model to a subset of sensors as a sensor-model-manifest command followed by numbered
+    sensor-model-chunk commands, see app/publisher/api/model_store.py. Sensors that already received the model
+    are skipped unless force is set, and interrupted deliveries resume from the first chunk not yet published.
+    The rollout runs in the background, its progress is returned by GET /sensor/model/{sha256}/deliveries.
+    """
+    if not model_store.exists(sha256):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Model {sha256} not found")
+    plan = model_distributor.plan(sha256, rollout.target.target_sensors, rollout.force)
+    model_distributor.rollout(fast_mqtt, sha256, rollout.tf_model_bytesize, plan)
     return {
-        "message": "Upload Sensor Model Command Sent to Devices",
-        "command_uuids": cmd_uuids
+        "message": "Sensor Model Rollout Started",
+        "sha256": sha256,
+        "deliveries": plan,
     }
 
 
+@api_router.get(
+    "/sensor/model/{sha256}/deliveries",
+    tags=["Edge Sensor Models"],
+    response_model=list[schemas.ModelDeliveryStatus],
+)
+async def get_sensor_model_deliveries(sha256: str, target_sensors: list[str] = Query()):
+    """
+    Sensor Model Deliveries
+
+    Returns the delivery progress of a stored model to each of the given sensors.
+    """
+    if not model_store.exists(sha256):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Model {sha256} not found")
+    return model_distributor.status(sha256, target_sensors)
+
+
+@api_router.get(
+    "/logging/debug-devices",
+    tags=["Logging"],
+    response_model=schemas.DebugDevices,
+)
+async def get_debug_devices():
+    """
+    Debug Devices
+
+    Returns the devices whose events are always logged, bypassing sampling and rate limits, and whose
+    payloads are dumped, by the publisher and every subscriber process.
+    """
+    return schemas.DebugDevices(devices=sorted(debug_devices.devices()))
+
+
+@api_router.put(
+    "/logging/debug-devices",
+    tags=["Logging"],
+    response_model=schemas.DebugDevices,
+)
+async def set_debug_devices(devices: schemas.DebugDevices):
+    """
+    Set Debug Devices
+
+    Replaces the debug devices. The list is written to LOG_DEBUG_DEVICES_FILE, which every process reloads
+    within LOG_DEBUG_REFRESH_INTERVAL seconds. An empty list turns debug logging off.
+    """
+    debug_devices.write(devices.devices)
+    return schemas.DebugDevices(devices=sorted(debug_devices.devices()))
+
+
 @api_router.post(
     "/sensor/command/set/inf-latency-bench",
     tags=["Edge Sensor Commands"],
@@ -194,13 +364,105 @@ async def inference_latency_benchmark(
     send an Export message containing the payload sent in this command plus the timestamp at which the Export was sent. 
     """
     if LATENCY_BENCHMARK:
-        cmd_uuids = send_cmd_to_devices(fast_mqtt, command)
-        return {
-            "message": "Inference Latency Benchmark Command Sent to Devices",
-            "command_uuids": cmd_uuids,
-        }
+        results = await send_cmd_to_devices(fast_mqtt, command)
+        return command_response("Inference Latency Benchmark Command Sent to Devices", results)
     else:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Latency Benchmarking is disabled",
         )
+
+
+@api_router.post(
+    "/sensor/command/batch",
+    tags=["Edge Sensor Commands"],
+    status_code=status.HTTP_202_ACCEPTED,
+)
+async def command_batch(
+    batch: schemas.CommandBatch,
+    response: Response,
+    wait: Wait = False,
+    wait_acks: WaitAcks = False,
+    timeout: WaitTimeout = COMMAND_WAIT_TIMEOUT,
+):
+    """
+    Batch of Commands
+
+    Sends an ordered list of commands, of any type and each with its own target, in a single request, e.g. to
+    commission sensors: SET sensor-config, SET inference-layer, SET sensor-state, then GET sensor-state.
+    Each command is one of the bodies of the other command endpoints, with its method and property_name,
+    which select its schema. The whole batch is validated before anything is published, and rejected with
+    every error found otherwise.
+
+    Commands are published in batch order, without waiting for the broker in between, so that each device
+    receives its commands in that order. The response lists every command UUID, in publishing order, and the
+    publish results of each command. With wait_acks=true, the request waits up to timeout seconds for the
+    broker to acknowledge the commands, reported by the acked attribute of each result. With wait=true,
+    the responses of the devices to the GET commands of the batch are also waited for and returned.
+    """
+    commands = batch.commands
+    if not LATENCY_BENCHMARK and any(isinstance(command, schemas.InferenceLatencyBenchmarkCommand) for command in commands):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Latency Benchmarking is disabled",
+        )
+    check_wait_targets(sum(len(command.target.target_sensors) for command in commands if command.method == schemas.Method.GET), wait)
+    batch_results, acks = await send_command_batch(fast_mqtt, commands, track_acks=wait_acks)
+    results = [result for batch_result in batch_results for result in batch_result.results]
+    get_results = [
+        result
+        for command, batch_result in zip(commands, batch_results) if command.method == schemas.Method.GET
+        for result in batch_result.results
+    ]
+    _, responses = await asyncio.gather(
+        wait_for_acks(results, acks, timeout) if wait_acks else asyncio.sleep(0),
+        wait_for_responses(get_results, response, wait, timeout),
+    )
+    body = {
+        "message": "Command Batch sent to devices",
+        "command_uuids": [result.command_uuid for result in results],
+        "commands": batch_results,
+    }
+    if responses is not None:
+        body["responses"] = responses
+    return body
+
+
+# key positions of the (sensor_name, inference_layer) latency sketches grouped by each group_by value
+LATENCY_GROUPS = {"layer": (1,), "sensor": (0,), "sensor-layer": (0, 1)}
+
+
+@api_router.get(
+    "/latency/inference",
+    tags=["Latency"],
+    response_model=list[schemas.InferenceLatencyStats],
+)
+async def get_inference_latency(
+    window: Annotated[float, Query(gt=0, description="Seconds of samples summarized, counted back from now")] = 300,
+    group_by: Annotated[Literal["layer", "sensor", "sensor-layer"], Query(description="Statistics per inference layer, sensor or both")] = "layer",
+    inference_layer: Optional[schemas.InferenceLayer] = None,
+    sensor_name: Annotated[Optional[list[str]], Query(description="Only these sensors")] = None,
+):
+    """
+    Inference Latency
+
+    Returns the p50, p90 and p99 inference latencies (ms), plus their count, min, max and mean, of the
+    inference-latency-bench samples received by every subscriber process over the last window seconds.
+    Statistics come from mergeable sketches kept per sensor and inference layer in LATENCY_WINDOW
+    windows, so they cover whole windows and quantiles are within LATENCY_SKETCH_ACCURACY relative error.
+    Requires METRICS_ENABLED, the sketches are shared through the inference_latency metrics section.
+    """
+    sensors = set(sensor_name) if sensor_name else None
+
+    def match(key) -> bool:
+        return (sensors is None or key[0] in sensors) and (inference_layer is None or key[1] == inference_layer)
+
+    group_by_keys = LATENCY_GROUPS[group_by]
+    snapshots = read_sections("inference_latency").values()
+    merged = merge_snapshots(snapshots, time.time() - window, group_by_keys, match)
+    stats = []
+    for group, sketch in sorted(merged.items()):
+        key = dict(zip(group_by_keys, group))
+        stats.append(schemas.InferenceLatencyStats(sensor_name=key.get(0), inference_layer=key.get(1), **sketch.summary()))
+    return stats
+
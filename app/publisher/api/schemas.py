@@ -1,11 +1,17 @@
 import enum
-from pydantic import BaseModel
-from typing import Optional
+from pydantic import BaseModel, Discriminator, Field, Tag, model_validator
+from typing import Annotated, Optional, Union
+from app.core.config import COMMAND_BATCH_MAX_COMMANDS, COMMAND_BATCH_MAX_TARGETS
 
 class Method(str, enum.Enum):
     GET = "get"
     SET = "set"
 
+class ShadowProperty(str, enum.Enum):
+    SENSOR_STATE = "sensor-state"
+    SENSOR_CONFIG = "sensor-config"
+    INFERENCE_LAYER = "inference-layer"
+
 class GatewayAPIWithSensors(BaseModel):
     """
     Schema for the Gateway API
@@ -15,6 +21,48 @@ class GatewayAPIWithSensors(BaseModel):
     url: str = ""
     target_sensors: list[str]
 
+class PublishResult(BaseModel):
+    """
+    Outcome of publishing a command to one target device
+    """
+
+    target: str
+    command_uuid: str
+    topic: str
+    published: bool
+    error: Optional[str] = None
+    acked: Optional[bool] = None # broker acknowledgement, when waited for
+
+class CommandResponse(BaseModel):
+    """
+    Response of a target device to a GET command, see app.publisher.api.correlation
+    """
+
+    target: str
+    command_uuid: str
+    status: str # answered | timeout | evicted | failed
+    property_value: object = None
+    rtt_ms: Optional[float] = None
+
+class ShadowEntry(BaseModel):
+    """
+    Last known property value of a target device, see app.publisher.api.shadow
+    """
+
+    target: str
+    status: str # cached | stale | missing | answered | timeout | failed
+    property_value: object = None
+    source: Optional[str] = None # set | response
+    updated_at: Optional[float] = None
+    age_s: Optional[float] = None
+
+class DebugDevices(BaseModel):
+    """
+    Devices whose events are always logged and whose payloads are dumped, see app.core.log
+    """
+
+    devices: list[str]
+
 class BaseCommand(BaseModel):
     method: Method
     target: GatewayAPIWithSensors
@@ -101,6 +149,32 @@ class SetSensorModel(SensorModelCommand):
     method: Method = Method.SET
     property_value: SensorModel
 
+# --- Property: Sensor Model (chunked delivery, see app.publisher.api.model_store) ---
+
+class SensorModelManifest(BaseModel):
+    sha256: str
+    bytesize: int
+    chunk_size: int
+    chunks: int
+    tf_model_bytesize: int
+
+class StoredSensorModel(BaseModel):
+    sha256: str
+    bytesize: int
+    chunks: int
+    already_stored: bool
+
+class SensorModelRollout(BaseModel):
+    target: GatewayAPIWithSensors
+    tf_model_bytesize: int
+    force: bool = False
+
+class ModelDeliveryStatus(BaseModel):
+    target: str
+    status: str # scheduled | skipped | in-progress | delivered | pending
+    next_chunk: int
+    chunks: int
+
 # --- Property: Inference Latency Benchmark ---
 
 class InferenceLatencyBenchmark(BaseModel):
@@ -114,3 +188,81 @@ class InferenceLatencyBenchmarkCommand(BaseCommand):
     method: Method = Method.SET
     property_value: InferenceLatencyBenchmark
 
+
+class InferenceLatencyStats(BaseModel):
+    """
+    Inference latency statistics, in ms, of a sensor and/or an inference layer over the requested window.
+    """
+
+    sensor_name: Optional[str] = None
+    inference_layer: Optional[InferenceLayer] = None
+    count: int
+    min: Optional[float] = None
+    max: Optional[float] = None
+    mean: Optional[float] = None
+    p50: Optional[float] = None
+    p90: Optional[float] = None
+    p99: Optional[float] = None
+
+
+# --- Batch of Commands ---
+
+# (method, property_name) -> command
+BATCH_COMMANDS = {
+    (command.model_fields["method"].default.value, command.model_fields["property_name"].default): command
+    for command in (
+        SetSensorState,
+        GetSensorState,
+        SetInferenceLayer,
+        GetInferenceLayer,
+        SetSensorConfig,
+        GetSensorConfig,
+        SetSensorModel,
+        InferenceLatencyBenchmarkCommand,
+    )
+}
+
+
+def batch_command_tag(command) -> Optional[str]:
+    """
+    Returns the "<method>:<property_name>" tag of a batch command, a dict before validation.
+    """
+    if isinstance(command, dict):
+        method, property_name = command.get("method"), command.get("property_name")
+    else:
+        method, property_name = getattr(command, "method", None), getattr(command, "property_name", None)
+    if method is None or property_name is None:
+        return None
+    return f"{getattr(method, 'value', method)}:{property_name}"
+
+
+BatchCommand = Annotated[
+    Union[tuple(Annotated[command, Tag(f"{method}:{property_name}")] for (method, property_name), command in BATCH_COMMANDS.items())],
+    Discriminator(batch_command_tag),
+]
+
+
+class CommandBatch(BaseModel):
+    """
+    Ordered commands, each with its own targets. Every command names its method and property_name,
+    which select its schema.
+    """
+
+    commands: list[BatchCommand] = Field(min_length=1, max_length=COMMAND_BATCH_MAX_COMMANDS)
+
+    @model_validator(mode="after")
+    def check_targets(self) -> "CommandBatch":
+        targets = sum(len(command.target.target_sensors) for command in self.commands)
+        if targets > COMMAND_BATCH_MAX_TARGETS:
+            raise ValueError(f"Batch has {targets} targets, at most {COMMAND_BATCH_MAX_TARGETS} are allowed")
+        return self
+
+class BatchCommandResult(BaseModel):
+    """
+    Publish results of one command of a batch, in the order of its targets
+    """
+
+    index: int
+    method: Method
+    property_name: str
+    results: list[PublishResult]
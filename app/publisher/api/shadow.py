@@ -0,0 +1,193 @@
+"""
+Device shadow: the last known sensor-state, sensor-config and inference-layer of each device.
+
+The shadow of a property is updated when the publisher sends a SET command for it (source "set", the
+value the device was asked to take) and when a device answers a GET command (source "response", the
+value the device reported). Each entry carries the time it was updated, so readers can choose how old
+a value they accept instead of sending a GET command to a battery-powered device.
+
+Shadows are kept in Redis, one hash per device (SHADOW_KEY_PREFIX<device_name>, a JSON entry per
+property), so they are shared by every publisher process and survive restarts. Every update renews the
+expiry of the whole hash, so entries older than SHADOW_TTL are skipped on read, as in process. When SHADOW_REDIS_URL
+is empty or Redis cannot be reached at startup, they are kept in this process instead, where expired
+entries are purged every SHADOW_PURGE_INTERVAL seconds. Workers of a multi-worker publisher each keep a
+different in-process shadow, so they need Redis.
+"""
+import time
+import json
+from typing import Optional
+
+import redis.asyncio as redis
+from redis.exceptions import RedisError
+from pydantic_core import to_json
+from app.publisher.api import schemas
+from app.publisher.api.workers import publisher_worker
+from app.core.log import get_logger
+from app.core.config import (
+    SHADOW_REDIS_URL,
+    SHADOW_KEY_PREFIX,
+    SHADOW_TTL,
+)
+
+log = get_logger(__name__)
+
+SHADOW_PROPERTIES = tuple(property_name.value for property_name in schemas.ShadowProperty)
+# the in-process shadow is purged of its expired entries at most this often, on update
+SHADOW_PURGE_INTERVAL = 60.0
+
+
+class MemoryShadowBackend:
+    name = "memory"
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        # device -> property -> entry
+        self._shadows: dict[str, dict[str, dict]] = {}
+        self._purged_at = time.monotonic()
+
+    async def set_many(self, devices: list[str], property_name: str, entry: dict):
+        for device in devices:
+            self._shadows.setdefault(device, {})[property_name] = entry
+        if time.monotonic() - self._purged_at > min(self.ttl, SHADOW_PURGE_INTERVAL):
+            self.purge()
+
+    def purge(self):
+        """
+        Removes the expired entries, and the devices left without any.
+        """
+        self._purged_at = time.monotonic()
+        oldest = time.time() - self.ttl
+        for device, shadow in list(self._shadows.items()):
+            for property_name in [name for name, entry in shadow.items() if entry["updated_at"] < oldest]:
+                del shadow[property_name]
+            if not shadow:
+                del self._shadows[device]
+
+    async def get_many(self, devices: list[str], property_name: str) -> list[Optional[dict]]:
+        oldest = time.time() - self.ttl
+        entries = []
+        for device in devices:
+            entry = self._shadows.get(device, {}).get(property_name)
+            entries.append(entry if entry is not None and entry["updated_at"] >= oldest else None)
+        return entries
+
+    async def get_all(self, device: str) -> dict[str, dict]:
+        oldest = time.time() - self.ttl
+        return {
+            property_name: entry
+            for property_name, entry in self._shadows.get(device, {}).items()
+            if entry["updated_at"] >= oldest
+        }
+
+    async def close(self):
+        pass
+
+
+class RedisShadowBackend:
+    name = "redis"
+
+    def __init__(self, url: str, prefix: str, ttl: float):
+        self.prefix = prefix
+        self.ttl = int(ttl)
+        # the hash expires SHADOW_TTL seconds after the update of any of its properties, entries are filtered on read
+        self._redis = redis.Redis.from_url(url)
+
+    async def ping(self):
+        await self._redis.ping()
+
+    async def set_many(self, devices: list[str], property_name: str, entry: dict):
+        value = to_json(entry)
+        async with self._redis.pipeline(transaction=False) as pipe:
+            for device in devices:
+                pipe.hset(self.prefix + device, property_name, value)
+                pipe.expire(self.prefix + device, self.ttl)
+            await pipe.execute()
+
+    async def get_many(self, devices: list[str], property_name: str) -> list[Optional[dict]]:
+        async with self._redis.pipeline(transaction=False) as pipe:
+            for device in devices:
+                pipe.hget(self.prefix + device, property_name)
+            values = await pipe.execute()
+        oldest = time.time() - self.ttl
+        entries = []
+        for value in values:
+            entry = json.loads(value) if value is not None else None
+            entries.append(entry if entry is not None and entry["updated_at"] >= oldest else None)
+        return entries
+
+    async def get_all(self, device: str) -> dict[str, dict]:
+        values = await self._redis.hgetall(self.prefix + device)
+        oldest = time.time() - self.ttl
+        entries = {property_name.decode(): json.loads(value) for property_name, value in values.items()}
+        return {property_name: entry for property_name, entry in entries.items() if entry["updated_at"] >= oldest}
+
+    async def close(self):
+        await self._redis.aclose()
+
+
+class DeviceShadow:
+    def __init__(self, redis_url: str, prefix: str, ttl: float):
+        self.redis_url = redis_url
+        self.prefix = prefix
+        self.ttl = ttl
+        self.backend = MemoryShadowBackend(ttl)
+
+    async def connect(self):
+        """
+        Switches to Redis if SHADOW_REDIS_URL is set and reachable, the shadow stays in process otherwise.
+        """
+        if not self.redis_url:
+            self._check_memory_backend()
+            return
+        backend = RedisShadowBackend(self.redis_url, self.prefix, self.ttl)
+        try:
+            await backend.ping()
+        except (RedisError, OSError) as e:
+            log.warning("shadow.redis_unreachable", url=self.redis_url, error=str(e), backend="memory")
+            await backend.close()
+            self._check_memory_backend()
+            return
+        self.backend = backend
+
+    def _check_memory_backend(self):
+        if publisher_worker.multi_worker:
+            log.error(
+                "shadow.not_shared",
+                workers=publisher_worker.workers,
+                reason="in-process shadows differ between publisher workers, set SHADOW_REDIS_URL",
+            )
+
+    async def close(self):
+        await self.backend.close()
+
+    async def update(self, devices: list[str], property_name: str, property_value, source: str):
+        """
+        Records the value of a property for devices. Failures are logged, the shadow is a cache.
+        """
+        if property_name not in SHADOW_PROPERTIES or not devices:
+            return
+        entry = {"value": property_value, "updated_at": time.time(), "source": source}
+        try:
+            await self.backend.set_many(devices, property_name, entry)
+        except (RedisError, OSError) as e:
+            log.warning("shadow.update_failed", property=property_name, devices=len(devices), error=str(e))
+
+    async def get(self, devices: list[str], property_name: str) -> list[Optional[dict]]:
+        """
+        Returns the entry of a property for each device, None if it is unknown or cannot be read.
+        """
+        try:
+            return await self.backend.get_many(devices, property_name)
+        except (RedisError, OSError) as e:
+            log.warning("shadow.read_failed", property=property_name, devices=len(devices), error=str(e))
+            return [None] * len(devices)
+
+    async def get_all(self, device: str) -> dict[str, dict]:
+        try:
+            return await self.backend.get_all(device)
+        except (RedisError, OSError) as e:
+            log.warning("shadow.read_failed", device, error=str(e))
+            return {}
+
+
+device_shadow = DeviceShadow(SHADOW_REDIS_URL, SHADOW_KEY_PREFIX, SHADOW_TTL)
@@ -1,25 +1,228 @@
-import uuid
-import json
+import time
+import asyncio
 
+from fastapi import Response, status
 from fastapi_mqtt import FastMQTT
+from pydantic_core import to_json
 from app.publisher.api import schemas as schemas
-from app.core.config import DEVICE_CMD_TOPIC_TEMPLATE
+from app.publisher.api.acks import ack_storage
+from app.publisher.api.correlation import correlation_index
+from app.publisher.api.shadow import device_shadow, SHADOW_PROPERTIES
+from app.publisher.api.workers import publisher_worker
+from app.core.log import get_logger
+from app.core.config import DEVICE_CMD_TOPIC_TEMPLATE, COMMAND_PUBLISH_WINDOW, GATEWAY_NAME
 
-def send_cmd_to_devices(fast_mqtt: FastMQTT, command: schemas.BaseCommand):
-    target = command.target.target_sensors
-    cmd_uuids = [str(uuid.uuid4()) for _ in target]
-    for cmd_uuid, cmd_target in zip(cmd_uuids, target):
-        cmd_method = command.method.value
-        cmd_property_name = command.property_name
-        cmd_payload = command.to_mqtt()
-               
-        # create command topic
-        # cmd_topic : command/<device_name>/<property_name>/<method>/<uuid>
-        cmd_topic = DEVICE_CMD_TOPIC_TEMPLATE % (cmd_target, cmd_property_name, cmd_method, cmd_uuid)
-        cmd_payload = json.dumps(cmd_payload)
-
-        # publish command to broker
-        print(f"[MQTT Publisher] Command sent to topic {cmd_topic}")
+log = get_logger(__name__)
+
+def serialize_command(command: schemas.BaseCommand) -> bytes:
+    """
+    Returns the MQTT payload of a command, the same for every target device.
+    """
+    return to_json(command.to_mqtt())
+
+_transport_warned = False
+
+def mqtt_transport(fast_mqtt: FastMQTT):
+    """
+    Returns the asyncio transport of the MQTT connection, None while there is no connection.
+    gmqtt does not expose flow control, the transport is private to its MQTTConnection (client._connection._transport
+    as of gmqtt 0.8). If an upgrade moves it, a warning is logged once and writes are no longer bounded.
+    """
+    global _transport_warned
+    connection = getattr(fast_mqtt.client, "_connection", None)
+    if connection is None:
+        return None
+    transport = getattr(connection, "_transport", None)
+    if transport is None or not hasattr(transport, "get_write_buffer_size"):
+        if not _transport_warned:
+            _transport_warned = True
+            log.warning("mqtt.transport_unavailable", connection=type(connection).__name__, gmqtt_attribute="_connection._transport")
+        return None
+    return transport
+
+async def drain(fast_mqtt: FastMQTT):
+    """
+    Waits until the MQTT connection has handed its buffered writes to the socket.
+    """
+    transport = mqtt_transport(fast_mqtt)
+    await asyncio.sleep(0)
+    while transport is not None and not transport.is_closing() and transport.get_write_buffer_size() > 0:
+        await asyncio.sleep(0.001)
+
+def publish_command(fast_mqtt: FastMQTT, cmd_target: str, cmd_method: str, cmd_property_name: str, cmd_payload: bytes, correlate: bool) -> schemas.PublishResult:
+    """
+    Publishes a serialized command to one target device, registering GET commands for correlation first
+    so that a fast response is not missed.
+    """
+    cmd_uuid = publisher_worker.command_uuid()
+    # create command topic
+    # cmd_topic : command/<device_name>/<property_name>/<method>/<uuid>
+    cmd_topic = DEVICE_CMD_TOPIC_TEMPLATE % (cmd_target, cmd_property_name, cmd_method, cmd_uuid)
+
+    if correlate:
+        correlation_index.register(cmd_uuid, cmd_target, cmd_property_name)
+    try:
         fast_mqtt.client.publish(cmd_topic, cmd_payload, qos=1, retain=False)
-    
-    return cmd_uuids
\ No newline at end of file
+    except Exception as e:
+        return schemas.PublishResult.model_construct(target=cmd_target, command_uuid=cmd_uuid, topic=cmd_topic, published=False, error=str(e), acked=None)
+    log.payload("command.payload", cmd_target, topic=cmd_topic, payload=cmd_payload.decode(errors="replace"))
+    return schemas.PublishResult.model_construct(target=cmd_target, command_uuid=cmd_uuid, topic=cmd_topic, published=True, error=None, acked=None)
+
+async def update_shadow(command: schemas.BaseCommand, results: list[schemas.PublishResult]) -> list[str]:
+    """
+    Updates the device shadow of the devices a SET command was published to, returns those devices.
+    """
+    published = [result.target for result in results if result.published]
+    if command.method == schemas.Method.SET and command.property_name in SHADOW_PROPERTIES:
+        property_value = command.model_dump(mode="json")["property_value"]
+        await device_shadow.update(published, command.property_name, property_value, source="set")
+    return published
+
+async def send_cmd_to_devices(fast_mqtt: FastMQTT, command: schemas.BaseCommand) -> list[schemas.PublishResult]:
+    """
+    Publishes a command to every target device and returns the publish result of each one.
+    SET commands update the device shadow of the devices they were published to.
+    The payload is serialized once, off the event loop, and at most COMMAND_PUBLISH_WINDOW publishes are
+    written before waiting for the connection to flush them, which bounds the memory buffered for large
+    payloads and lets the event loop serve other requests meanwhile.
+    """
+    cmd_payload = await asyncio.to_thread(serialize_command, command)
+    cmd_method = command.method.value
+    # devices only answer GET commands
+    correlate = command.method == schemas.Method.GET
+
+    results = []
+    for i, cmd_target in enumerate(command.target.target_sensors):
+        results.append(publish_command(fast_mqtt, cmd_target, cmd_method, command.property_name, cmd_payload, correlate))
+        if (i + 1) % COMMAND_PUBLISH_WINDOW == 0:
+            await drain(fast_mqtt)
+
+    published = await update_shadow(command, results)
+    log.info("command.published", method=cmd_method, property=command.property_name, published=len(published), targets=len(results), bytes=len(cmd_payload))
+    return results
+
+async def send_command_batch(fast_mqtt: FastMQTT, commands: list[schemas.BaseCommand], track_acks: bool = False) -> tuple[list[schemas.BatchCommandResult], dict[str, asyncio.Future]]:
+    """
+    Publishes a batch of commands, in their order and each to every of its targets, and returns the publish
+    results of each command. Every payload is serialized once, in a single pass off the event loop, then
+    publishes are pipelined on the MQTT connection, COMMAND_PUBLISH_WINDOW at a time, without waiting for
+    the broker in between. A device thus receives its commands in batch order: they are written to one
+    connection in that order, the broker forwards the QoS 1 messages of a client in order, and gmqtt replays
+    unacknowledged ones in sending order after a reconnect.
+    With track_acks, also returns the broker acknowledgement future of each published command, by command UUID.
+    """
+    payloads = await asyncio.to_thread(lambda: [serialize_command(command) for command in commands])
+
+    batch_results = []
+    acks = {}
+    publishes = 0
+    for index, (command, cmd_payload) in enumerate(zip(commands, payloads)):
+        cmd_method = command.method.value
+        correlate = command.method == schemas.Method.GET
+        results = []
+        for cmd_target in command.target.target_sensors:
+            result = publish_command(fast_mqtt, cmd_target, cmd_method, command.property_name, cmd_payload, correlate)
+            if track_acks and result.published:
+                acks[result.command_uuid] = ack_storage.track_last()
+            results.append(result)
+            publishes += 1
+            if publishes % COMMAND_PUBLISH_WINDOW == 0:
+                await drain(fast_mqtt)
+        batch_results.append(schemas.BatchCommandResult.model_construct(
+            index=index,
+            method=command.method,
+            property_name=command.property_name,
+            results=results,
+        ))
+
+    # in batch order, a later SET of the same property wins
+    published = 0
+    for command, batch_result in zip(commands, batch_results):
+        published += len(await update_shadow(command, batch_result.results))
+    log.info("command.batch_published", commands=len(commands), published=published, targets=publishes, bytes=sum(len(payload) for payload in payloads))
+    return batch_results, acks
+
+async def wait_for_acks(results: list[schemas.PublishResult], acks: dict[str, asyncio.Future], timeout: float):
+    """
+    Waits up to timeout seconds for the broker to acknowledge the published commands of results,
+    and sets their acked attribute.
+    """
+    pending = [ack for ack in acks.values() if not ack.done()]
+    if pending:
+        await asyncio.wait(pending, timeout=timeout)
+    for result in results:
+        ack = acks.get(result.command_uuid)
+        result.acked = ack is not None and ack.done() and ack.result()
+
+def command_response(message: str, results: list[schemas.PublishResult], responses: list[schemas.CommandResponse] = None) -> dict:
+    response = {
+        "message": message,
+        "command_uuids": [result.command_uuid for result in results],
+        "results": results,
+    }
+    if responses is not None:
+        response["responses"] = responses
+    return response
+
+async def wait_for_responses(results: list[schemas.PublishResult], response: Response, wait: bool, timeout: float) -> list[schemas.CommandResponse]:
+    """
+    With wait, waits up to timeout seconds for the device responses to GET commands and answers 200 instead of 202.
+    """
+    if not wait:
+        return None
+    response.status_code = status.HTTP_200_OK
+    return await correlation_index.wait(results, timeout)
+
+SHADOW_GET_COMMANDS = {
+    schemas.ShadowProperty.SENSOR_STATE: schemas.GetSensorState,
+    schemas.ShadowProperty.SENSOR_CONFIG: schemas.GetSensorConfig,
+    schemas.ShadowProperty.INFERENCE_LAYER: schemas.GetInferenceLayer,
+}
+
+async def read_shadow(fast_mqtt: FastMQTT, property_name: schemas.ShadowProperty, targets: list[str], max_age: float, refresh: bool, timeout: float) -> list[schemas.ShadowEntry]:
+    """
+    Returns the shadow of a property for each target, served from cache when it is at most max_age seconds old.
+    With refresh, a GET command is sent to the other targets and their responses are waited for up to timeout seconds.
+    """
+    now = time.time()
+    entries = await device_shadow.get(targets, property_name.value)
+    shadow = {}
+    outdated = []
+    for target, entry in zip(targets, entries):
+        if entry is None:
+            shadow[target] = schemas.ShadowEntry(target=target, status="missing")
+            outdated.append(target)
+            continue
+        age = now - entry["updated_at"]
+        fresh = max_age is None or age <= max_age
+        shadow[target] = schemas.ShadowEntry(
+            target=target,
+            status="cached" if fresh else "stale",
+            property_value=entry["value"],
+            source=entry["source"],
+            updated_at=entry["updated_at"],
+            age_s=age,
+        )
+        if not fresh:
+            outdated.append(target)
+
+    if refresh and outdated:
+        command = SHADOW_GET_COMMANDS[property_name](
+            target=schemas.GatewayAPIWithSensors(gateway_name=GATEWAY_NAME, target_sensors=outdated)
+        )
+        results = await send_cmd_to_devices(fast_mqtt, command)
+        for response in await correlation_index.wait(results, timeout):
+            if response.status == "answered":
+                # the response handler has updated the shadow meanwhile
+                shadow[response.target] = schemas.ShadowEntry(
+                    target=response.target,
+                    status="answered",
+                    property_value=response.property_value,
+                    source="response",
+                    updated_at=time.time(),
+                    age_s=0.0,
+                )
+            else:
+                # keeps the outdated value, if any
+                shadow[response.target] = shadow[response.target].model_copy(update={"status": response.status})
+    return [shadow[target] for target in targets]
@@ -0,0 +1,188 @@
+"""
+Worker slots of the multi-worker publisher.
+
+With PUBLISHER_WORKERS > 1 the publisher runs as several uvicorn worker processes. On startup (see
+mqtt_lifespan) each worker claims the first free slot among 0 .. PUBLISHER_WORKERS - 1 by locking
+PUBLISHER_STATE_DIR/slot-<slot>.lock, and connects to the broker with the client ID
+<MQTT_PUBLISHER_CLIENT_ID>-<slot>. A restarted worker claims the slot freed by the one it replaces, so it
+resumes the persistent session of that client ID instead of taking over the session of a running worker.
+
+Every worker receives every device response. The command UUIDs of a worker carry its slot in their
+first 16 bits, so the response to a GET command is handled by the worker that sent it, and responses to
+commands of other publishers by slot 0.
+
+Each worker writes its broker connectivity to PUBLISHER_STATE_DIR/slot-<slot>.json, read by the readiness
+endpoint of any worker. A worker is alive while the lock of its slot is held, which the system releases
+whatever the way the process ended. A single worker publisher keeps MQTT_PUBLISHER_CLIENT_ID and claims no slot.
+"""
+import os
+import json
+import time
+import uuid
+import fcntl
+from typing import Optional
+from app.core.log import get_logger
+from app.core.config import (
+    MQTT_PUBLISHER_CLIENT_ID,
+    PUBLISHER_WORKERS,
+    PUBLISHER_STATE_DIR,
+)
+
+log = get_logger(__name__)
+
+SLOT_BITS = 16
+# a slot whose lock is briefly held by a liveness check is tried again after this many seconds
+CLAIM_RETRY_DELAY = 0.01
+SLOT_SHIFT = 128 - SLOT_BITS
+
+
+class PublisherWorker:
+    def __init__(self, workers: int = PUBLISHER_WORKERS, directory: str = PUBLISHER_STATE_DIR):
+        self.workers = max(1, workers)
+        self.directory = directory
+        self.slot = 0
+        self.connected = False
+        self.connected_at: Optional[float] = None
+        self._lock_file = None
+
+    @property
+    def multi_worker(self) -> bool:
+        return self.workers > 1
+
+    @property
+    def client_id(self) -> str:
+        return f"{MQTT_PUBLISHER_CLIENT_ID}-{self.slot}" if self.multi_worker else MQTT_PUBLISHER_CLIENT_ID
+
+    def _path(self, slot: int, extension: str) -> str:
+        return os.path.join(self.directory, f"slot-{slot}.{extension}")
+
+    # --- Lifecycle ---
+
+    def claim(self) -> int:
+        """
+        Claims the first free worker slot, held until release or the end of the process.
+        """
+        if not self.multi_worker or self._lock_file is not None:
+            return self.slot
+        os.makedirs(self.directory, exist_ok=True)
+        for slot in range(self.workers):
+            lock_file = open(self._path(slot, "lock"), "a")
+            if not _try_lock(lock_file, fcntl.LOCK_EX):
+                time.sleep(CLAIM_RETRY_DELAY)
+                if not _try_lock(lock_file, fcntl.LOCK_EX):
+                    lock_file.close()
+                    continue
+            self.slot, self._lock_file = slot, lock_file
+            self._write_state()
+            log.info("worker.claimed", pid=os.getpid(), slot=slot, client_id=self.client_id)
+            return slot
+        raise RuntimeError(f"Every publisher worker slot of {self.directory} is taken, PUBLISHER_WORKERS is {self.workers}")
+
+    def release(self):
+        if self._lock_file is None:
+            return
+        try:
+            os.remove(self._path(self.slot, "json"))
+        except FileNotFoundError:
+            pass
+        fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+        self._lock_file.close()
+        self._lock_file = None
+
+    def set_connected(self, connected: bool):
+        self.connected = connected
+        self.connected_at = time.time() if connected else None
+        if self._lock_file is not None:
+            self._write_state()
+
+    def _state(self) -> dict:
+        return {
+            "slot": self.slot,
+            "client_id": self.client_id,
+            "pid": os.getpid(),
+            "connected": self.connected,
+            "connected_at": self.connected_at,
+            "updated_at": time.time(),
+        }
+
+    def _write_state(self):
+        path = self._path(self.slot, "json")
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self._state(), f)
+        os.replace(tmp_path, path)
+
+    # --- Command ownership ---
+
+    def command_uuid(self) -> str:
+        """
+        Returns a new command UUID, carrying the slot of this worker in multi-worker mode.
+        """
+        command_uuid = uuid.uuid4()
+        if not self.multi_worker:
+            return str(command_uuid)
+        mask = (1 << SLOT_SHIFT) - 1
+        return str(uuid.UUID(int=(command_uuid.int & mask) | (self.slot << SLOT_SHIFT)))
+
+    def handles_response(self, command_uuid: str) -> bool:
+        """
+        Returns whether this worker handles the response to a command: its own commands, and the commands
+        of no worker for slot 0.
+        """
+        if not self.multi_worker:
+            return True
+        try:
+            owner = uuid.UUID(command_uuid).int >> SLOT_SHIFT
+        except ValueError:
+            owner = None
+        if owner is None or owner >= self.workers:
+            return self.slot == 0
+        return owner == self.slot
+
+    # --- Readiness ---
+
+    def slot_alive(self, slot: int) -> bool:
+        """
+        Returns whether a worker holds the lock of a slot.
+        """
+        if slot == self.slot and self._lock_file is not None:
+            return True
+        try:
+            with open(self._path(slot, "lock"), "a") as lock_file:
+                if not _try_lock(lock_file, fcntl.LOCK_SH):
+                    return True
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+                return False
+        except OSError:
+            return False
+
+    def states(self) -> list[dict]:
+        """
+        Returns the state of every worker slot, "alive" telling whether a worker holds the slot. The state
+        left by a worker that did not stop cleanly is reported as not connected.
+        """
+        if not self.multi_worker:
+            return [{**self._state(), "alive": True}]
+        states = []
+        for slot in range(self.workers):
+            alive = self.slot_alive(slot)
+            try:
+                with open(self._path(slot, "json")) as f:
+                    state = json.load(f)
+            except (FileNotFoundError, ValueError):
+                state = {"slot": slot, "client_id": f"{MQTT_PUBLISHER_CLIENT_ID}-{slot}", "connected": False}
+            state["alive"] = alive
+            state["connected"] = alive and state["connected"]
+            states.append(state)
+        return states
+
+
+def _try_lock(lock_file, operation: int) -> bool:
+    try:
+        fcntl.flock(lock_file, operation | fcntl.LOCK_NB)
+    except BlockingIOError:
+        return False
+    return True
+
+
+publisher_worker = PublisherWorker()
@@ -1,5 +1,13 @@
+import os
 import uvicorn
 from app.publisher import app
+from app.core.config import PUBLISHER_WORKERS
 
-def run_publisher_process(publisher_host, publisher_port):
-    uvicorn.run(app=app, host=publisher_host, port=publisher_port)
+def run_publisher_process(publisher_host, publisher_port, workers: int = PUBLISHER_WORKERS):
+    if workers > 1:
+        # worker processes read their configuration again, they must agree on the number of slots
+        os.environ["PUBLISHER_WORKERS"] = str(workers)
+        # every worker process imports the app and runs its own mqtt_lifespan, see app/publisher/api/workers.py
+        uvicorn.run("app.publisher:app", host=publisher_host, port=publisher_port, workers=workers)
+    else:
+        uvicorn.run(app=app, host=publisher_host, port=publisher_port)
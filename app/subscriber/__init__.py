@@ -1,14 +1,11 @@
-import threading
 import logging
 import zlib
 import paho.mqtt.client as mqtt
 from app.core.config import (
-    DEVICE_EXPORT_TOPIC,
-    DEVICE_RESPONSE_TOPIC,
     MQTT_SUBSCRIBER_CLIENT_ID,
 )
-from app.subscriber.export import export_handler
-from app.subscriber.response import response_handler
+# the mqtt_client attribute is rebound to the paho client below, the submodule stays importable by name
+from app.subscriber.mqtt_client import dispatch_message, subscribe_routes
 
 logging.basicConfig(level=logging.INFO)
 
@@ -17,17 +14,10 @@ def on_connect(client, userdata, flags, rc):
     logging.info(f"[MQTT Subscriber] Connected to broker with result code {rc}")
     
     # subscribe to topics
-    client.subscribe(DEVICE_EXPORT_TOPIC, qos=0)
-    client.subscribe(DEVICE_RESPONSE_TOPIC, qos=1)
+    subscribe_routes(client)
 
 def on_message(client, userdata, msg):
-    logging.info(f"[MQTT Subscriber] Received message on topic {msg.topic}")
-    if msg.topic.startswith(DEVICE_EXPORT_TOPIC[:-1]): # removes the wildcard
-        threading.Thread(target=export_handler.handle, args=(msg.topic, msg.payload)).start()
-    elif msg.topic.startswith(DEVICE_RESPONSE_TOPIC[:-1]): # removes the wildcard
-        threading.Thread(target=response_handler.handle, args=(msg.topic, msg.payload)).start()
-    else:
-        logging.info(f"[MQTT Subscriber] Unknown topic {msg.topic}")
+    dispatch_message(msg.topic, msg.payload)
 
 logging.info("[MQTT Subscriber] Starting MQTT Subscriber")
 mqtt_client = mqtt.Client(
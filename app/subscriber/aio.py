@@ -0,0 +1,363 @@
+"""
+Asyncio subscriber engine.
+
+An alternative to the paho + worker threads subscriber, selected with SUBSCRIBER_ENGINE=asyncio.
+Messages are received by a gmqtt client and queued in a bounded queue consumed by
+ASYNC_SUBSCRIBER_CONCURRENCY pipeline coroutines. Each pipeline decodes a message with the
+build step of its topic route on a thread pool, so CPU-bound work stays off the event loop,
+and then uploads the result with an httpx.AsyncClient. In-flight uploads therefore
+cost coroutines instead of OS threads.
+
+As with the dispatcher of the threaded engine (app.subscriber.dispatcher), control messages have a
+lane of their own: a SUBSCRIBER_CONTROL_QUEUE_SIZE queue consumed by ASYNC_SUBSCRIBER_CONTROL_CONCURRENCY
+pipelines, decoded on SUBSCRIBER_CONTROL_WORKERS threads of their own. Telemetry is queued per device
+and served round-robin, with the SUBSCRIBER_DEVICE_QUEUE_LIMIT and the drop-oldest and keep-latest
+overflow policies of the dispatcher.
+
+The client does not acknowledge QoS 1 messages optimistically: the PUBACK of a message is only sent once
+it has been queued. Control messages, and QoS 1 telemetry with the block policy, wait for room in their
+full queue instead of being dropped, which holds their PUBACK, so the broker stops sending once its
+in-flight window is used up and redelivers what was not acknowledged after a reconnect. The reject policy
+holds QoS 1 telemetry the same way: the client speaks MQTT 3.1.1, whose PUBACK carries no reason code, so
+a message cannot be refused without the broker taking it as delivered. QoS 0 telemetry cannot be held
+back and is dropped when its queue is full.
+"""
+import time
+import signal
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from pydantic import BaseModel
+from gmqtt import Client as MQTTClient
+from gmqtt.mqtt.constants import MQTTv311, PubRecReasonCode
+from app.subscriber.router import Route
+from app.subscriber.dispatcher import (
+    FairQueue,
+    LANES,
+    LANE_CONTROL,
+    LANE_BULK,
+    OVERFLOW_BLOCK,
+    OVERFLOW_DROP_OLDEST,
+    OVERFLOW_KEEP_LATEST,
+    OVERFLOW_REJECT,
+)
+from app.subscriber.routes import topic_router
+from app.subscriber.export.batcher import export_batcher
+from app.subscriber.export.encoding import encode_export, falls_back_to_json
+from app.subscriber.export.inference import inference_batcher
+from app.subscriber.dedup import dedup_index
+from app.subscriber.export.latency import start_latency_summaries, stop_latency_summaries
+from app.core.latency import inference_latency
+from app.subscriber.mqtt_client import subscribe_routes
+from app.subscriber.spool import export_spool, open_export_spool, close_export_spool, is_permanent_failure
+from app.core.log import get_logger, setup_logging, logging_stats
+from app.core.metrics import (
+    metrics,
+    topic_type,
+    start_metrics_writer,
+    stop_metrics_writer,
+    STAGE_SECONDS,
+    MESSAGES_TOTAL,
+    ERRORS_TOTAL,
+    DROPPED_TOTAL,
+)
+from app.subscriber.utils import (
+    GatewayAPIError,
+    create_async_gateway_client,
+    async_post_to_gateway_api,
+)
+from app.core.config import (
+    SUBSCRIBER_QUEUE_SIZE,
+    SUBSCRIBER_OVERFLOW_POLICY,
+    SUBSCRIBER_CONTROL_WORKERS,
+    SUBSCRIBER_CONTROL_QUEUE_SIZE,
+    SUBSCRIBER_DEVICE_QUEUE_LIMIT,
+    ASYNC_SUBSCRIBER_CONCURRENCY,
+    ASYNC_SUBSCRIBER_CONTROL_CONCURRENCY,
+    ASYNC_SUBSCRIBER_DECODE_WORKERS,
+)
+
+logging.basicConfig(level=logging.INFO)
+log = get_logger(__name__)
+
+
+class FairAsyncQueue(asyncio.Queue):
+    """
+    asyncio queue of (enqueued_at, topic, route, params, payload) messages, served round-robin between devices.
+    """
+
+    def _init(self, maxsize):
+        self._queue = FairQueue()
+
+    def _put(self, item):
+        self._queue.append(item[3].get("device_name"), item)
+
+    def _get(self):
+        return self._queue.popleft()
+
+    def queued(self, device_name: str) -> int:
+        return self._queue.queued(device_name)
+
+    def shed(self, device_name: str = None):
+        """
+        Removes the oldest message of a device, or of the device served next, see FairQueue.shed.
+        """
+        item = self._queue.shed(device_name)
+        self.task_done()
+        return item
+
+
+class AsyncSubscriber:
+    def __init__(
+        self,
+        mqtt_client_id: str,
+        shared_group: str = None,
+        concurrency: int = ASYNC_SUBSCRIBER_CONCURRENCY,
+        decode_workers: int = ASYNC_SUBSCRIBER_DECODE_WORKERS,
+        queue_size: int = SUBSCRIBER_QUEUE_SIZE,
+        name: str = None,
+        control_concurrency: int = ASYNC_SUBSCRIBER_CONTROL_CONCURRENCY,
+        control_queue_size: int = SUBSCRIBER_CONTROL_QUEUE_SIZE,
+        device_queue_limit: int = SUBSCRIBER_DEVICE_QUEUE_LIMIT,
+        overflow_policy: str = SUBSCRIBER_OVERFLOW_POLICY,
+    ):
+        self.mqtt_client_id = mqtt_client_id
+        self.name = name
+        self.shared_group = shared_group
+        self.concurrency = max(1, concurrency)
+        self.decode_workers = max(1, decode_workers)
+        self.queue_size = max(1, queue_size)
+        self.control_concurrency = max(1, control_concurrency)
+        self.control_queue_size = max(1, control_queue_size)
+        self.device_queue_limit = max(0, device_queue_limit)
+        self.overflow_policy = overflow_policy
+
+        # lane -> its queue and the executor its messages are decoded on
+        self._queues: dict[str, asyncio.Queue] = {}
+        self._executors: dict[str, ThreadPoolExecutor] = {}
+        self._http = None
+        self._executor: ThreadPoolExecutor = None
+
+        # --- Stats ---
+        self._received = dict.fromkeys(LANES, 0)
+        self._dropped = dict.fromkeys(LANES, 0)
+        self._shed = dict.fromkeys(LANES, 0)
+        self._rejected = dict.fromkeys(LANES, 0)
+        self._blocked = dict.fromkeys(LANES, 0)
+        self._errors = 0
+        self._wait_total = dict.fromkeys(LANES, 0.0)
+        self._wait_max = dict.fromkeys(LANES, 0.0)
+        self._dequeued = dict.fromkeys(LANES, 0)
+
+    # --- MQTT callback functions ---
+
+    def _on_connect(self, client, flags, rc, properties):
+        logging.info(f"[MQTT Subscriber] Connected to broker with result code {rc}")
+        subscribe_routes(client, self.shared_group)
+
+    async def _on_message(self, client, topic, payload, qos, properties):
+        """
+        Queues a message on the lane of its route, its PUBACK is sent once this returns.
+        """
+        match = topic_router.match(topic)
+        if match is None:
+            metrics.inc(MESSAGES_TOTAL, (topic_type(topic),))
+            log.info("message.unrouted", topic=topic)
+            return PubRecReasonCode.SUCCESS
+        route, params = match
+        metrics.inc(MESSAGES_TOTAL, (route.label,))
+        log.info("message.received", params.get("device_name"), topic=topic, bytes=len(payload))
+        lane = route.concurrency
+        queue = self._queues[lane]
+        device_name = params.get("device_name")
+        if lane == LANE_BULK and self.device_queue_limit and queue.queued(device_name) >= self.device_queue_limit:
+            self._shed_message(queue.shed(device_name), "device queue limit")
+        item = (time.monotonic(), topic, route, params, payload)
+        if lane == LANE_CONTROL or (qos > 0 and self.overflow_policy in (OVERFLOW_BLOCK, OVERFLOW_REJECT)):
+            # holds the PUBACK until there is room in the queue
+            if queue.full():
+                self._blocked[lane] += 1
+            await queue.put(item)
+            self._received[lane] += 1
+            return PubRecReasonCode.SUCCESS
+
+        if queue.full() and self.overflow_policy == OVERFLOW_DROP_OLDEST:
+            self._shed_message(queue.shed(), "pipeline queue full, oldest message")
+        elif queue.full() and self.overflow_policy == OVERFLOW_KEEP_LATEST:
+            self._shed_message(queue.shed(device_name), "pipeline queue full, older message of the device")
+        try:
+            queue.put_nowait(item)
+            self._received[lane] += 1
+        except asyncio.QueueFull:
+            metrics.inc(DROPPED_TOTAL, (route.label,))
+            if self.overflow_policy == OVERFLOW_REJECT:
+                self._rejected[lane] += 1
+            else:
+                self._dropped[lane] += 1
+            log.warning("message.dropped", device_name, topic=topic, reason="pipeline queue full")
+        return PubRecReasonCode.SUCCESS
+
+    def _shed_message(self, item: tuple, reason: str):
+        _, topic, route, params, _ = item
+        self._shed[route.concurrency] += 1
+        metrics.inc(DROPPED_TOTAL, (route.label,))
+        log.warning("message.dropped", params.get("device_name"), topic=topic, reason=reason)
+
+    def _on_disconnect(self, client, packet, exc=None):
+        logging.info("[MQTT Subscriber] Disconnected from broker")
+
+    # --- Pipeline ---
+
+    def _build(self, route: Route, params: dict, payload: bytes) -> list[tuple[str, bytes, dict, bool, BaseModel]]:
+        """
+        Runs on the decode thread pool, returns the serialized (endpoint, content, headers, spoolable, model) uploads
+        of a message.
+        """
+        uploads = []
+        for endpoint, model in route.build(params, payload):
+            body = route.sink.serialize(endpoint, model)
+            if body is not None:
+                uploads.append((endpoint, *body, model))
+        return uploads
+
+    async def _upload(self, endpoint: str, content: bytes, headers: dict, spoolable: bool, model: BaseModel):
+        """
+        POSTs an upload to the Gateway API. Exports go through the export spool if it is enabled, and are re-sent
+        as plain JSON if the Gateway API does not accept their body encoding, as post_export does.
+        """
+        loop = asyncio.get_running_loop()
+        spool = export_spool if spoolable else None
+        if spool is not None and spool.should_defer():
+            await loop.run_in_executor(self._executor, spool.append, endpoint, content, headers)
+            return
+        try:
+            try:
+                await async_post_to_gateway_api(self._http, endpoint, content, headers)
+            except GatewayAPIError as e:
+                if not spoolable or not falls_back_to_json(endpoint, headers, e):
+                    raise
+                content, headers = await loop.run_in_executor(self._executor, encode_export, endpoint, model)
+                await async_post_to_gateway_api(self._http, endpoint, content, headers)
+        except GatewayAPIError as e:
+            if spool is None or is_permanent_failure(e):
+                raise
+            log.warning("export.spooled", endpoint=endpoint, error=str(e))
+            await loop.run_in_executor(self._executor, spool.append, endpoint, content, headers)
+
+    async def _pipeline(self, lane: str):
+        loop = asyncio.get_running_loop()
+        queue = self._queues[lane]
+        executor = self._executors[lane]
+        while True:
+            enqueued_at, topic, route, params, payload = await queue.get()
+            wait = time.monotonic() - enqueued_at
+            self._dequeued[lane] += 1
+            self._wait_total[lane] += wait
+            self._wait_max[lane] = max(self._wait_max[lane], wait)
+            label = route.label
+            started_at = time.perf_counter()
+            try:
+                uploads = await loop.run_in_executor(executor, self._build, route, params, payload)
+                for upload in uploads:
+                    await self._upload(*upload)
+            except Exception:
+                self._errors += 1
+                metrics.inc(ERRORS_TOTAL, (label,))
+                log.exception("message.failed", params.get("device_name"), topic=topic)
+            finally:
+                metrics.observe(STAGE_SECONDS, (label, "total"), time.perf_counter() - started_at)
+                queue.task_done()
+
+    def stats(self) -> dict:
+        dequeued = sum(self._dequeued.values())
+        stats = {
+            "queue_depth": sum(queue.qsize() for queue in self._queues.values()),
+            "received": sum(self._received.values()),
+            "dropped": sum(self._dropped.values()) + sum(self._shed.values()) + sum(self._rejected.values()),
+            "errors": self._errors,
+            "wait_avg_ms": (sum(self._wait_total.values()) / dequeued * 1000) if dequeued else 0.0,
+            "wait_max_ms": max(self._wait_max.values()) * 1000,
+        }
+        for lane in LANES:
+            queue = self._queues.get(lane)
+            stats.update({
+                f"{lane}_queue_depth": queue.qsize() if queue is not None else 0,
+                f"{lane}_received": self._received[lane],
+                f"{lane}_shed": self._shed[lane],
+                f"{lane}_dropped": self._dropped[lane],
+                f"{lane}_rejected": self._rejected[lane],
+                f"{lane}_blocked": self._blocked[lane],
+                f"{lane}_wait_avg_ms": (self._wait_total[lane] / self._dequeued[lane] * 1000) if self._dequeued[lane] else 0.0,
+                f"{lane}_wait_max_ms": self._wait_max[lane] * 1000,
+            })
+        return stats
+
+    # --- Lifecycle ---
+
+    async def run(self, mqtt_broker_host, mqtt_broker_port):
+        """
+        Runs the subscriber until SIGTERM/SIGINT, then drains the queued messages and shuts down.
+        """
+        loop = asyncio.get_running_loop()
+        stop = asyncio.Event()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, stop.set)
+
+        setup_logging()
+        self._queues = {
+            LANE_CONTROL: asyncio.Queue(maxsize=self.control_queue_size),
+            LANE_BULK: FairAsyncQueue(maxsize=self.queue_size),
+        }
+        self._http = create_async_gateway_client()
+        self._executor = ThreadPoolExecutor(max_workers=self.decode_workers, thread_name_prefix="subscriber-decode")
+        control_executor = ThreadPoolExecutor(max_workers=max(1, SUBSCRIBER_CONTROL_WORKERS), thread_name_prefix="subscriber-control")
+        self._executors = {LANE_CONTROL: control_executor, LANE_BULK: self._executor}
+        open_export_spool(self.name)
+        metrics.register_collector("async_pipeline", self.stats)
+        metrics.register_collector("logging", logging_stats)
+        if export_spool is not None:
+            metrics.register_collector("spool", export_spool.stats)
+        if inference_batcher is not None:
+            metrics.register_collector("inference", inference_batcher.stats)
+        if dedup_index is not None:
+            metrics.register_collector("dedup", dedup_index.stats)
+        metrics.register_section("inference_latency", inference_latency.snapshot_json)
+        start_metrics_writer(self.name or "subscriber")
+        start_latency_summaries()
+
+        # PUBACKs are sent once _on_message has queued the message
+        client = MQTTClient(self.mqtt_client_id, clean_session=True, optimistic_acknowledgement=False)
+        client.on_connect = self._on_connect
+        client.on_message = self._on_message
+        client.on_disconnect = self._on_disconnect
+
+        logging.info(
+            f"[MQTT Subscriber] Starting asyncio MQTT Subscriber with {self.concurrency} pipelines "
+            f"({self.control_concurrency} more for control) and {self.decode_workers} decode workers"
+        )
+        await client.connect(mqtt_broker_host, mqtt_broker_port, version=MQTTv311)
+        pipelines = [asyncio.create_task(self._pipeline(LANE_BULK)) for _ in range(self.concurrency)]
+        pipelines += [asyncio.create_task(self._pipeline(LANE_CONTROL)) for _ in range(self.control_concurrency)]
+        try:
+            await stop.wait()
+        finally:
+            await client.disconnect()
+            for queue in self._queues.values():
+                await queue.join()
+            for pipeline in pipelines:
+                pipeline.cancel()
+            await asyncio.gather(*pipelines, return_exceptions=True)
+            await self._http.aclose()
+            self._executor.shutdown(wait=True)
+            control_executor.shutdown(wait=True)
+            stop_latency_summaries()
+            if inference_batcher is not None:
+                inference_batcher.close()
+            export_batcher.close()
+            close_export_spool()
+            stop_metrics_writer()
+            logging.info(f"[MQTT Subscriber] Asyncio MQTT Subscriber stopped: {self.stats()}")
+
+
+def run_async_subscriber(mqtt_broker_host, mqtt_broker_port, mqtt_client_id, shared_group=None, name=None):
+    asyncio.run(AsyncSubscriber(mqtt_client_id, shared_group, name=name).run(mqtt_broker_host, mqtt_broker_port))
@@ -0,0 +1,142 @@
+"""
+Duplicate suppression and idempotency keys of the subscriber.
+
+Responses are subscribed with QoS 1, so the broker redelivers them after a reconnect or a failover, and
+sensors may send an export twice. Routes registered with a dedup key function look the key of each
+message up in the dedup index before decoding it, and only the first copy seen within DEDUP_TTL seconds
+is handled:
+
+    - response/<device_name>/<property_name>/<method>/<uuid>: keyed by the command UUID;
+    - export/<device_name>/<export_name>: keyed by a digest of the payload, per device.
+
+Keys are 16-byte digests and the index holds at most DEDUP_MAX_ENTRIES of them, the oldest being evicted
+first, so its memory is bounded whatever the number of devices. The index is per process: a copy
+redelivered to another subscriber process is handled again, the Gateway API then recognizes it by the
+Idempotency-Key header of the upstream request:
+
+    - responses: the command UUID;
+    - sensor-data exports: the reading UUID, derived from the device, send timestamp and reading;
+    - batches: a digest of the keys of their exports;
+    - other bodies: a digest of the body, stable across retries and spool replays.
+"""
+import time
+import uuid
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Optional
+from app.core.config import (
+    GATEWAY_NAME,
+    DEDUP_ENABLED,
+    DEDUP_TTL,
+    DEDUP_MAX_ENTRIES,
+)
+
+IDEMPOTENCY_HEADER = "Idempotency-Key"
+DIGEST_SIZE = 16
+
+# namespace of the reading UUIDs of this gateway
+READING_NAMESPACE = uuid.uuid5(uuid.NAMESPACE_URL, f"esn-gateway:{GATEWAY_NAME}:sensor-data")
+
+
+class DedupIndex:
+    def __init__(self, ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max(1, max_entries)
+        self._lock = threading.Lock()
+        # key -> expiry, insertion order is expiry order as every key lives ttl seconds
+        self._seen: OrderedDict[bytes, float] = OrderedDict()
+        self.duplicates = 0
+        self.evicted = 0
+
+    def __len__(self) -> int:
+        return len(self._seen)
+
+    def first(self, key: bytes) -> bool:
+        """
+        Records a message key, returns False if the key was already seen within ttl seconds.
+        """
+        now = time.monotonic()
+        with self._lock:
+            expiry = self._seen.get(key)
+            if expiry is not None and expiry > now:
+                self.duplicates += 1
+                return False
+            seen = self._seen
+            while seen:
+                oldest_key, oldest_expiry = next(iter(seen.items()))
+                if oldest_expiry > now and len(seen) < self.max_entries:
+                    break
+                seen.popitem(last=False)
+                if oldest_expiry > now:
+                    self.evicted += 1
+            seen.pop(key, None)
+            seen[key] = now + self.ttl
+            return True
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._seen),
+            "duplicates": self.duplicates,
+            "evicted": self.evicted,
+        }
+
+
+# --- Dedup keys: key(params, payload) -> digest ---
+
+def command_key(params: dict, payload: bytes) -> bytes:
+    return hashlib.blake2b(params["command_uuid"].encode(), digest_size=DIGEST_SIZE, person=b"command").digest()
+
+
+def content_key(params: dict, payload: bytes) -> bytes:
+    digest = hashlib.blake2b(params["device_name"].encode(), digest_size=DIGEST_SIZE, person=b"content")
+    digest.update(b"/")
+    digest.update(payload)
+    return digest.digest()
+
+
+# --- Idempotency keys ---
+
+def reading_uuid(sensor_name: str, reading: bytes, send_timestamp: Optional[int]) -> str:
+    """
+    Returns the UUID of a reading, the same for every copy of the sensor-data message carrying it.
+    """
+    digest = hashlib.blake2b(reading, digest_size=DIGEST_SIZE).hexdigest()
+    return str(uuid.uuid5(READING_NAMESPACE, f"{sensor_name}/{send_timestamp}/{digest}"))
+
+
+def _model_key(model) -> Optional[str]:
+    command_uuid = getattr(getattr(model, "metadata", None), "command_uuid", None)
+    if command_uuid is not None:
+        return command_uuid
+    return getattr(getattr(getattr(model, "export_value", None), "reading", None), "uuid", None)
+
+
+def idempotency_key(data, content: bytes) -> str:
+    """
+    Returns the idempotency key of an upstream request body, data being the model or batch envelope
+    serialized into content.
+    """
+    if isinstance(data, dict) and "exports" in data:
+        keys = [_model_key(export) for export in data["exports"]]
+        if all(keys):
+            digest = hashlib.blake2b(digest_size=DIGEST_SIZE, person=b"batch")
+            for key in keys:
+                digest.update(key.encode())
+                digest.update(b"\n")
+            return digest.hexdigest()
+    else:
+        key = _model_key(data)
+        if key is not None:
+            return key
+    return hashlib.blake2b(content, digest_size=DIGEST_SIZE, person=b"body").hexdigest()
+
+
+def idempotency_headers(headers: dict, data, content: bytes) -> dict:
+    """
+    Returns headers with the idempotency key of a request body.
+    """
+    return {**headers, IDEMPOTENCY_HEADER: idempotency_key(data, content)}
+
+
+dedup_index = DedupIndex(DEDUP_TTL, DEDUP_MAX_ENTRIES) if DEDUP_ENABLED else None
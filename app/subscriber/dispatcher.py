@@ -0,0 +1,350 @@
+"""
+Bounded worker pool used by the MQTT subscriber to process incoming messages.
+
+Messages are queued by the paho network loop into the lane of their route concurrency class and processed
+by a fixed number of worker threads:
+
+    - control: device responses and latency benchmarks. Its queue (SUBSCRIBER_CONTROL_QUEUE_SIZE) is
+      reserved, it is served first by every worker and SUBSCRIBER_CONTROL_WORKERS more workers serve
+      only it, so control messages never wait behind telemetry. Control messages are never dropped,
+      the caller blocks while the lane is full.
+    - bulk: telemetry (sensor-data exports). Its tasks are queued per device and the devices are served
+      round-robin, so a device sending bursts does not delay the others. A device holds at most
+      SUBSCRIBER_DEVICE_QUEUE_LIMIT queued tasks (0: no limit), its oldest task is shed beyond that.
+
+When the bulk lane is full the configured overflow policy is applied:
+
+    - block: the caller (i.e. the paho network loop) waits until there is room in the queue.
+    - drop-oldest: the oldest task of the device served next is discarded to make room.
+    - keep-latest: the oldest task of the same device is discarded, so every device keeps its newest
+      readings; drop-oldest applies if the device has no queued task.
+    - reject: the new task is discarded.
+"""
+import time
+import logging
+import threading
+from collections import deque
+from app.core.log import get_logger
+from app.subscriber.router import CONCURRENCY_BULK, CONCURRENCY_CONTROL
+from app.core.config import (
+    SUBSCRIBER_WORKERS,
+    SUBSCRIBER_QUEUE_SIZE,
+    SUBSCRIBER_OVERFLOW_POLICY,
+    SUBSCRIBER_STATS_INTERVAL,
+    SUBSCRIBER_CONTROL_WORKERS,
+    SUBSCRIBER_CONTROL_QUEUE_SIZE,
+    SUBSCRIBER_DEVICE_QUEUE_LIMIT,
+)
+
+logging.basicConfig(level=logging.INFO)
+log = get_logger(__name__)
+
+OVERFLOW_BLOCK = "block"
+OVERFLOW_DROP_OLDEST = "drop-oldest"
+OVERFLOW_KEEP_LATEST = "keep-latest"
+OVERFLOW_REJECT = "reject"
+OVERFLOW_POLICIES = (OVERFLOW_BLOCK, OVERFLOW_DROP_OLDEST, OVERFLOW_KEEP_LATEST, OVERFLOW_REJECT)
+
+# lanes are named after the route concurrency classes, in the order workers serve them
+LANE_CONTROL = CONCURRENCY_CONTROL
+LANE_BULK = CONCURRENCY_BULK
+LANES = (LANE_CONTROL, LANE_BULK)
+
+
+class FairQueue:
+    """
+    Queue of items grouped by key (device), served round-robin between the keys and in order within a key.
+    """
+
+    def __init__(self):
+        # key -> its queued items, keys waiting in the rotation may have none left
+        self._items: dict[object, deque] = {}
+        # keys in serving order, each key appears at most once
+        self._rotation: deque = deque()
+        self._size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def queued(self, key) -> int:
+        items = self._items.get(key)
+        return len(items) if items is not None else 0
+
+    def keys(self) -> int:
+        return sum(1 for items in self._items.values() if items)
+
+    def append(self, key, item):
+        items = self._items.get(key)
+        if items is None:
+            items = self._items[key] = deque()
+            self._rotation.append(key)
+        items.append(item)
+        self._size += 1
+
+    def _next_key(self):
+        while True:
+            key = self._rotation[0]
+            if self._items[key]:
+                return key
+            self._rotation.popleft()
+            del self._items[key]
+
+    def popleft(self):
+        """
+        Returns the oldest item of the next key, which goes back to the end of the rotation.
+        """
+        key = self._next_key()
+        self._rotation.popleft()
+        items = self._items[key]
+        item = items.popleft()
+        if items:
+            self._rotation.append(key)
+        else:
+            del self._items[key]
+        self._size -= 1
+        return item
+
+    def shed(self, key=None):
+        """
+        Removes and returns the oldest item of key, or of the next key if key has no queued item.
+        """
+        items = self._items.get(key)
+        if not items:
+            items = self._items[self._next_key()]
+        self._size -= 1
+        return items.popleft()
+
+
+class _Task:
+    __slots__ = ("func", "args", "lane", "key", "enqueued_at")
+
+    def __init__(self, func, args, lane, key):
+        self.func = func
+        self.args = args
+        self.lane = lane
+        self.key = key
+        self.enqueued_at = time.monotonic()
+
+
+class _LaneStats:
+    __slots__ = ("submitted", "processed", "shed", "rejected", "max_depth", "dequeued", "wait_total", "wait_max")
+
+    def __init__(self):
+        self.submitted = 0
+        self.processed = 0
+        self.shed = 0
+        self.rejected = 0
+        self.max_depth = 0
+        self.dequeued = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+
+class Dispatcher:
+    def __init__(
+        self,
+        workers: int,
+        queue_size: int,
+        overflow_policy: str,
+        stats_interval: float = 0,
+        control_workers: int = SUBSCRIBER_CONTROL_WORKERS,
+        control_queue_size: int = SUBSCRIBER_CONTROL_QUEUE_SIZE,
+        device_queue_limit: int = SUBSCRIBER_DEVICE_QUEUE_LIMIT,
+    ):
+        if overflow_policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy {overflow_policy}, expected one of {OVERFLOW_POLICIES}")
+        self.workers = max(1, workers)
+        self.control_workers = max(0, control_workers)
+        self.queue_size = max(1, queue_size)
+        self.control_queue_size = max(1, control_queue_size)
+        self.device_queue_limit = max(0, device_queue_limit)
+        self.overflow_policy = overflow_policy
+        self.stats_interval = stats_interval
+        # called with (func, args) of every task that is dropped or rejected
+        self.on_drop = None
+
+        self._queues = {LANE_CONTROL: deque(), LANE_BULK: FairQueue()}
+        self._sizes = {LANE_CONTROL: self.control_queue_size, LANE_BULK: self.queue_size}
+        self._cond = threading.Condition()
+        self._threads: list[threading.Thread] = []
+        self._running = False
+        self._stopped = threading.Event()
+
+        # --- Stats ---
+        self._lane_stats = {lane: _LaneStats() for lane in LANES}
+        self._errors = 0
+
+    # --- Lifecycle ---
+
+    def start(self):
+        """
+        Starts the worker threads. Calling start on a running dispatcher has no effect.
+        """
+        with self._cond:
+            if self._running:
+                return
+            self._running = True
+            self._stopped.clear()
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._work, args=(LANES,), name=f"dispatcher-worker-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+            for i in range(self.control_workers):
+                thread = threading.Thread(target=self._work, args=((LANE_CONTROL,),), name=f"dispatcher-control-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+            if self.stats_interval > 0:
+                thread = threading.Thread(target=self._report, name="dispatcher-stats", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+        logging.info(
+            f"[MQTT Subscriber] Dispatcher started with {self.workers} workers ({self.control_workers} more for control), "
+            f"queue size {self.queue_size} ({self.control_queue_size} for control) and overflow policy {self.overflow_policy}"
+        )
+
+    def stop(self, timeout: float = None):
+        """
+        Stops accepting tasks and waits for the queued ones to be processed.
+        """
+        with self._cond:
+            if not self._running:
+                return
+            self._running = False
+            self._cond.notify_all()
+        self._stopped.set()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for thread in self._threads:
+            thread.join(None if deadline is None else max(0, deadline - time.monotonic()))
+        self._threads = []
+        logging.info(f"[MQTT Subscriber] Dispatcher stopped: {self.stats()}")
+
+    # --- Producer side ---
+
+    def submit(self, func, *args, lane: str = LANE_CONTROL, key=None) -> bool:
+        """
+        Queues func(*args) in a lane to be run by a worker, key being the device of bulk tasks.
+        Returns False if the task was rejected.
+        """
+        if not self._running:
+            self.start()
+
+        task = _Task(func, args, lane, key)
+        queue = self._queues[lane]
+        stats = self._lane_stats[lane]
+        with self._cond:
+            if lane == LANE_BULK and self.device_queue_limit and queue.queued(key) >= self.device_queue_limit:
+                self._shed(queue.shed(key), "device queue limit")
+            while len(queue) >= self._sizes[lane]:
+                if lane == LANE_BULK and self.overflow_policy == OVERFLOW_REJECT:
+                    stats.rejected += 1
+                    log.warning("message.rejected", key, reason="dispatch queue full")
+                    self._notify_drop(task)
+                    return False
+                if lane == LANE_BULK and self.overflow_policy == OVERFLOW_DROP_OLDEST:
+                    self._shed(queue.shed(), "dispatch queue full, oldest message")
+                    break
+                if lane == LANE_BULK and self.overflow_policy == OVERFLOW_KEEP_LATEST:
+                    self._shed(queue.shed(key), "dispatch queue full, older message of the device")
+                    break
+                self._cond.wait()
+                if not self._running:
+                    stats.rejected += 1
+                    self._notify_drop(task)
+                    return False
+
+            if lane == LANE_BULK:
+                queue.append(key, task)
+            else:
+                queue.append(task)
+            stats.submitted += 1
+            stats.max_depth = max(stats.max_depth, len(queue))
+            self._cond.notify_all()
+        return True
+
+    def _shed(self, task: _Task, reason: str):
+        # must be called with self._cond held
+        self._lane_stats[task.lane].shed += 1
+        log.warning("message.dropped", task.key, reason=reason)
+        self._notify_drop(task)
+
+    def _notify_drop(self, task: _Task):
+        if self.on_drop is not None:
+            self.on_drop(task.func, task.args)
+
+    # --- Consumer side ---
+
+    def _take(self, lanes: tuple) -> _Task:
+        # must be called with self._cond held, returns None if every lane is empty
+        for lane in lanes:
+            queue = self._queues[lane]
+            if queue:
+                return queue.popleft()
+        return None
+
+    def _work(self, lanes: tuple):
+        while True:
+            with self._cond:
+                task = self._take(lanes)
+                while task is None and self._running:
+                    self._cond.wait()
+                    task = self._take(lanes)
+                if task is None:
+                    return
+                stats = self._lane_stats[task.lane]
+                wait = time.monotonic() - task.enqueued_at
+                stats.dequeued += 1
+                stats.wait_total += wait
+                stats.wait_max = max(stats.wait_max, wait)
+                self._cond.notify_all()
+
+            try:
+                task.func(*task.args)
+            except Exception:
+                with self._cond:
+                    self._errors += 1
+                log.exception("message.failed", handler=getattr(task.func, "__name__", task.func))
+            with self._cond:
+                stats.processed += 1
+
+    def _report(self):
+        while not self._stopped.wait(self.stats_interval):
+            logging.info(f"[MQTT Subscriber] Dispatcher stats: {self.stats()}")
+
+    # --- Stats ---
+
+    def stats(self) -> dict:
+        with self._cond:
+            lanes = self._lane_stats.values()
+            dequeued = sum(stats.dequeued for stats in lanes)
+            totals = {
+                "queue_depth": sum(len(queue) for queue in self._queues.values()),
+                "queue_max_depth": max(stats.max_depth for stats in lanes),
+                "submitted": sum(stats.submitted for stats in lanes),
+                "processed": sum(stats.processed for stats in lanes),
+                "dropped": sum(stats.shed for stats in lanes),
+                "rejected": sum(stats.rejected for stats in lanes),
+                "errors": self._errors,
+                "wait_avg_ms": sum(stats.wait_total for stats in lanes) / dequeued * 1000 if dequeued else 0.0,
+                "wait_max_ms": max(stats.wait_max for stats in lanes) * 1000,
+                "bulk_devices_queued": self._queues[LANE_BULK].keys(),
+            }
+            for lane, stats in self._lane_stats.items():
+                totals.update({
+                    f"{lane}_queue_depth": len(self._queues[lane]),
+                    f"{lane}_queue_max_depth": stats.max_depth,
+                    f"{lane}_submitted": stats.submitted,
+                    f"{lane}_processed": stats.processed,
+                    f"{lane}_shed": stats.shed,
+                    f"{lane}_rejected": stats.rejected,
+                    f"{lane}_wait_avg_ms": stats.wait_total / stats.dequeued * 1000 if stats.dequeued else 0.0,
+                    f"{lane}_wait_max_ms": stats.wait_max * 1000,
+                })
+            return totals
+
+
+dispatcher = Dispatcher(
+    workers=SUBSCRIBER_WORKERS,
+    queue_size=SUBSCRIBER_QUEUE_SIZE,
+    overflow_policy=SUBSCRIBER_OVERFLOW_POLICY,
+    stats_interval=SUBSCRIBER_STATS_INTERVAL,
+)
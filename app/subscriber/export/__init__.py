@@ -1,111 +1,208 @@
-import json
-import uuid
 import logging
-import zlib
 import base64
+from typing import Optional
+from functools import lru_cache
+from pydantic import BaseModel
+from app.core.log import get_logger
+from app.core.metrics import metrics, StageTimer
+from app.core.latency import inference_latency
 from app.subscriber.export import schemas
-from app.subscriber.utils import post_to_gateway_api
+from app.subscriber.export.batcher import export_batcher
+from app.subscriber.export.codecs import SensorDataFrame, decode_binary_payload, json_reading_codec
+from app.subscriber.export.decoder import parse_reading, convert_reading
+from app.subscriber.export.encoding import encode_reading_values, encode_export, post_export
+from app.subscriber.export.features import feature_selector
+from app.subscriber.export.inference import inference_batcher
+from app.subscriber.dedup import content_key, reading_uuid
+from app.subscriber.router import TopicRouter, json_decoder, CONCURRENCY_BULK, CONCURRENCY_CONTROL
 from app.core.config import (
     GATEWAY_NAME,
     SENSOR_INFERENCE_LAYER,
-    SEQUENCE_LENGTH,
-    SAMPLE_SIZE,
+    GATEWAY_INFERENCE_LAYER,
+    EXPORT_BATCH_ENABLED,
+    LATENCY_FORWARD_SAMPLES,
 )
 
 logging.basicConfig(level=logging.INFO)
+log = get_logger(__name__)
+
+
+@lru_cache(maxsize=4096)
+def get_metadata(sensor_name: str) -> schemas.Metadata:
+    """
+    Returns the shared Metadata instance of a sensor of this gateway.
+    """
+    return schemas.Metadata.model_construct(gateway_name=GATEWAY_NAME, sensor_name=sensor_name)
+
 
 class ExportHandler:
-    def _handle_mqtt_sensor_data(self, sensor_name: str, payload: dict):
+    def _export(self, endpoint: str, export: BaseModel):
+        """
+        Sends an export to the Gateway API, through the export batcher if batching is enabled.
+        """
+        if EXPORT_BATCH_ENABLED:
+            export_batcher.add(endpoint, export)
+        else:
+            post_export(endpoint, export)
+
+    def _handle_mqtt_sensor_data(self, sensor_name: str, payload: schemas.SensorDataPayload, timer: StageTimer = None):
         """
         This method handles the MQTT sensor-data export message.
         Note that the inference latency benchmark is exported to the Gateway API if the inference layer is SENSOR_INFERENCE_LAYER
         as the prediction comes with the sensor-data message since it was performed on the sensor.
+        Only the sensor-supplied fields of the payload are validated, the export models are built from data
+        produced here and are therefore constructed without validation.
         """
+        timer = timer or metrics.stage_timer("sensor-data")
 
         # --- Decode and Decompress Raw Reading ---
-        raw_reading = payload["reading"]
-        logging.info(f"Raw Reading: {raw_reading}")
+        raw_reading = payload.reading
+        log.payload("export.payload", sensor_name, reading=raw_reading)
         decoded_reading = base64.b64decode(raw_reading)
-        decompressed_reading = zlib.decompress(decoded_reading)
-
-        # --- Parse Decompressed Reading ---
-        combine_bytes = lambda msb, lsb: (msb << 8) | lsb
-        byte_array = bytearray(decompressed_reading)
-        _raw_reading = [
-            [
-                combine_bytes(byte_array[i], byte_array[i + 1])
-                for i in range(j * SAMPLE_SIZE * 2, (j + 1) * SAMPLE_SIZE * 2, 2)
-            ]
-            for j in range(SEQUENCE_LENGTH)
-        ]
-
-        # --- Accelerometer Constants ---
-        G_MS2 = 9.80665
-        MAX_INT_VALUE_SENSOR = 32768.0
-        ACC_RAW_TO_MS2 = (G_MS2 / MAX_INT_VALUE_SENSOR)
-        SENSOR_ACC_RANGE = 2 # 8g
-
-        # --- Gyroscope Constants ---
-        SENSOR_GYR_RANGE = 250.0
-        PI = 3.14159265359
-        GYR_RAW_TO_RADS = (PI / 180.0) / MAX_INT_VALUE_SENSOR
-
-        # --- Converters ---
-        convert_raw_acc_to_ms2 = lambda raw: (pow(2, SENSOR_ACC_RANGE + 1) * ACC_RAW_TO_MS2) * raw
-        convert_raw_gyr_to_rads = lambda raw: SENSOR_GYR_RANGE * GYR_RAW_TO_RADS * raw
-
-        # --- Convert Raw Reading to Physical Values ---
-        reading = [
-            [
-                convert_raw_acc_to_ms2(sample[i]) if i < 3 else convert_raw_gyr_to_rads(sample[i])
-                for i in range(len(sample))
-            ]
-            for sample in _raw_reading
-        ]
+        timer.lap("b64")
+        decompressed_reading = json_reading_codec.decode(decoded_reading)
+        timer.lap("zlib")
+        return self._export_sensor_data(sensor_name, decompressed_reading, payload.low_battery, payload.inference_descriptor, timer)
+
+    def _handle_mqtt_binary_sensor_data(self, sensor_name: str, frame: SensorDataFrame, timer: StageTimer = None):
+        """
+        This method handles the binary MQTT sensor-data export message, whose reading is encoded with the
+        codec picked by the sensor, see app.subscriber.export.codecs.
+        """
+        timer = timer or metrics.stage_timer("sensor-data")
+        log.payload("export.payload", sensor_name, codec=frame.codec.name, reading=base64.b64encode(frame.reading).decode())
+        decompressed_reading = frame.codec.decode(frame.reading)
+        timer.lap(frame.codec.name)
+        return self._export_sensor_data(sensor_name, decompressed_reading, frame.low_battery, frame.inference_descriptor, timer)
+
+    def _export_sensor_data(
+        self,
+        sensor_name: str,
+        decompressed_reading: bytes,
+        low_battery: bool,
+        inference_descriptor: schemas.InferenceDescriptor,
+        timer: StageTimer,
+    ):
+        # --- Parse and Convert Reading to Physical Values ---
+        words = parse_reading(decompressed_reading)
+        timer.lap("parse")
+        reading = convert_reading(words)
+        timer.lap("convert")
+
+        # --- Extract Features, for devices using a feature set ---
+        feature_set = feature_selector.for_device(sensor_name)
+        if feature_set is not None:
+            reading_fields = feature_set.extract(reading)
+            timer.lap("features")
+        else:
+            reading_fields = encode_reading_values(decompressed_reading, reading)
 
         # --- Prepare Export Value ---
-        _reading = {"uuid": str(uuid.uuid4()), "values": reading}
-        _low_battery = payload["low_battery"]
-        _inference_descriptor = payload["inference_descriptor"]
-        sensor_data = schemas.SensorData(
-            reading=schemas.SensorReading(**_reading),
-            low_battery=_low_battery,
-            inference_descriptor=schemas.InferenceDescriptor(**_inference_descriptor)
+        sensor_data = schemas.SensorData.model_construct(
+            reading=schemas.SensorReading.model_construct(
+                uuid=reading_uuid(sensor_name, decompressed_reading, inference_descriptor.send_timestamp),
+                **reading_fields
+            ),
+            low_battery=low_battery,
+            inference_descriptor=inference_descriptor
         )
 
-        # --- Prepare Metadata ---
-        metadata = schemas.Metadata(gateway_name=GATEWAY_NAME, sensor_name=sensor_name)
-
         # Step 1: Export Sensor Data to Gateway API
-        sensor_data_export = schemas.SensorDataExport(
-            metadata=metadata,
+        sensor_data_export = schemas.SensorDataExport.model_construct(
+            metadata=get_metadata(sensor_name),
             export_value=sensor_data
         )
-        post_to_gateway_api("/export/sensor-data", sensor_data_export.model_dump())
-        
-    def _handle_mqtt_inference_latency_benchmark(self, device_name: str, payload: dict):
+        timer.lap("schema")
+
+        # --- Predict, for sensors relying on gateway-layer inference ---
+        if inference_batcher is not None and inference_descriptor.inference_layer == GATEWAY_INFERENCE_LAYER:
+            # the export is sent by the inference batcher once the prediction is made
+            inference_batcher.add(reading, "/export/sensor-data", sensor_data_export, self._export)
+            return None
+        return "/export/sensor-data", sensor_data_export
+
+    def _handle_mqtt_inference_latency_benchmark(self, device_name: str, payload: schemas.InferenceLatencyBenchmark):
         """
         This method handles the MQTT inference-latency-benchmark export message.
         Note this export is only made once a sensor receives an inference-latency-benchmark command message,
         which only happens when the inference layer is CLOUD_INFERENCE_LAYER or GATEWAY_INFERENCE_LAYER.
         """
-        payload = schemas.InferenceLatencyBenchmark(**payload)
-        metadata = schemas.Metadata(gateway_name=GATEWAY_NAME, sensor_name=device_name)
-        inference_latency_benchmark = schemas.InferenceLatencyBenchmarkExport(
-            metadata=metadata,
+        inference_latency_benchmark = schemas.InferenceLatencyBenchmarkExport.model_construct(
+            metadata=get_metadata(device_name),
             export_value=payload
         )
-        post_to_gateway_api("/export/inference-latency-benchmark", inference_latency_benchmark.model_dump())
-    
-    def handle(self, topic: str, payload: str):
-        # export_topic: export/<device_name>/<export_name>
-        _, device_name, export_name = topic.split("/")
-        payload = json.loads(payload)
-        logging.info(f"[MQTT Subscriber] Export from {device_name} for {export_name}")
-        if export_name == "sensor-data":
-            self._handle_mqtt_sensor_data(device_name, payload)
-        elif export_name == "inf-latency-bench":
-            payload = schemas.InferenceLatencyBenchmark(**payload)
-            self._handle_mqtt_inference_latency_benchmark(device_name, payload)
+        return "/export/inference-latency-benchmark", inference_latency_benchmark
+
+    # --- Routes: handler(params, message, timer) -> [(endpoint, export)] ---
+
+    def sensor_data(self, params: dict, payload: schemas.SensorDataPayload, timer: StageTimer) -> list[tuple[str, BaseModel]]:
+        export = self._handle_mqtt_sensor_data(params["device_name"], payload, timer)
+        return [export] if export is not None else []
+
+    def binary_sensor_data(self, params: dict, frame: SensorDataFrame, timer: StageTimer) -> list[tuple[str, BaseModel]]:
+        export = self._handle_mqtt_binary_sensor_data(params["device_name"], frame, timer)
+        return [export] if export is not None else []
+
+    def inference_latency_benchmark(self, params: dict, payload: schemas.InferenceLatencyBenchmark, timer: StageTimer) -> list[tuple[str, BaseModel]]:
+        # aggregated for the latency summaries, see app.subscriber.export.latency
+        inference_latency.record((params["device_name"], int(payload.inference_layer)), payload.inference_latency)
+        if not LATENCY_FORWARD_SAMPLES:
+            return []
+        export = self._handle_mqtt_inference_latency_benchmark(params["device_name"], payload)
+        timer.lap("schema")
+        return [export]
+
+    def register_routes(self, router: TopicRouter, prefix: str):
+        """
+        Registers the export routes, export/<device_name>/<export_name>. Payloads come from the sensors,
+        they are parsed and validated in a single strict pass. sensor-data-bin carries the same export as
+        sensor-data in the binary format of app.subscriber.export.codecs. Copies of a payload sent again by
+        a device are skipped, see app.subscriber.dedup.
+        """
+        router.add(
+            f"{prefix}/{{device_name}}/sensor-data",
+            self.sensor_data,
+            decoder=json_decoder(schemas.SensorDataPayload),
+            sink=self,
+            qos=0,
+            concurrency=CONCURRENCY_BULK,
+            label="sensor-data",
+            dedup=content_key,
+        )
+        router.add(
+            f"{prefix}/{{device_name}}/sensor-data-bin",
+            self.binary_sensor_data,
+            decoder=decode_binary_payload,
+            sink=self,
+            qos=0,
+            concurrency=CONCURRENCY_BULK,
+            label="sensor-data",
+            dedup=content_key,
+        )
+        router.add(
+            f"{prefix}/{{device_name}}/inf-latency-bench",
+            self.inference_latency_benchmark,
+            decoder=json_decoder(schemas.InferenceLatencyBenchmark),
+            sink=self,
+            qos=0,
+            concurrency=CONCURRENCY_CONTROL,
+            label="inf-latency-bench",
+            dedup=content_key,
+        )
+
+    # --- Sink ---
+
+    def send(self, endpoint: str, export: BaseModel):
+        self._export(endpoint, export)
+
+    def serialize(self, endpoint: str, export: BaseModel) -> Optional[tuple[bytes, dict, bool]]:
+        """
+        Returns the (content, headers, spoolable) body of an export, None if the export batcher took it.
+        """
+        if EXPORT_BATCH_ENABLED:
+            export_batcher.add(endpoint, export)
+            return None
+        content, headers = encode_export(endpoint, export)
+        return content, headers, True
 
 export_handler = ExportHandler()
@@ -0,0 +1,144 @@
+"""
+Micro-batching of exports sent to the Gateway API.
+
+Exports are collected per endpoint and flushed as a single bulk request to <endpoint>/batch
+when the batch reaches EXPORT_BATCH_MAX_SIZE exports or its oldest export has waited
+EXPORT_BATCH_MAX_DELAY seconds, whichever happens first.
+
+Batch envelope, e.g. POST /export/sensor-data/batch:
+
+    {
+        "batch_uuid": "<uuid4>",
+        "count": 2,
+        "exports": [<SensorDataExport>, <SensorDataExport>]
+    }
+
+Each item of "exports" is exactly the body that would have been POSTed to <endpoint> on its own,
+in the order the exports were produced.
+"""
+import time
+import uuid
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from app.core.log import get_logger
+from app.subscriber.export.encoding import post_export
+from app.core.config import (
+    EXPORT_BATCH_MAX_SIZE,
+    EXPORT_BATCH_MAX_DELAY,
+    EXPORT_BATCH_MAX_IN_FLIGHT,
+)
+
+logging.basicConfig(level=logging.INFO)
+log = get_logger(__name__)
+
+BATCH_ENDPOINT_SUFFIX = "/batch"
+
+
+def batch_envelope(exports: list) -> dict:
+    return {
+        "batch_uuid": str(uuid.uuid4()),
+        "count": len(exports),
+        "exports": exports,
+    }
+
+
+class ExportBatcher:
+    def __init__(self, max_size: int, max_delay: float, max_in_flight: int):
+        self.max_size = max(1, max_size)
+        self.max_delay = max_delay
+        self.max_in_flight = max(1, max_in_flight)
+
+        self._lock = threading.Lock()
+        self._batches: dict[str, list] = {}
+        self._opened_at: dict[str, float] = {}
+        self._in_flight = threading.BoundedSemaphore(self.max_in_flight)
+        self._executor: ThreadPoolExecutor = None
+        self._timer: threading.Thread = None
+        self._closed = threading.Event()
+
+    def _ensure_started(self):
+        if self._executor is not None:
+            return
+        with self._lock:
+            if self._executor is not None:
+                return
+            self._closed.clear()
+            self._executor = ThreadPoolExecutor(max_workers=self.max_in_flight, thread_name_prefix="export-batcher")
+            self._timer = threading.Thread(target=self._flush_expired, name="export-batcher-timer", daemon=True)
+            self._timer.start()
+
+    def add(self, endpoint: str, export):
+        """
+        Adds an export to the batch of endpoint, flushing the batch if it is full.
+        """
+        self._ensure_started()
+        with self._lock:
+            batch = self._batches.setdefault(endpoint, [])
+            if not batch:
+                self._opened_at[endpoint] = time.monotonic()
+            batch.append(export)
+            full = len(batch) >= self.max_size
+            if full:
+                batch = self._take(endpoint)
+        if full:
+            self._flush(endpoint, batch)
+
+    def _take(self, endpoint: str) -> list:
+        # must be called with self._lock held
+        self._opened_at.pop(endpoint, None)
+        return self._batches.pop(endpoint, [])
+
+    def _flush(self, endpoint: str, batch: list):
+        if not batch:
+            return
+        # blocks the producer while EXPORT_BATCH_MAX_IN_FLIGHT batches are being uploaded
+        self._in_flight.acquire()
+        try:
+            self._executor.submit(self._upload, endpoint, batch)
+        except Exception:
+            self._in_flight.release()
+            raise
+
+    def _upload(self, endpoint: str, batch: list):
+        try:
+            post_export(f"{endpoint}{BATCH_ENDPOINT_SUFFIX}", batch_envelope(batch))
+            log.info("export.flushed", endpoint=endpoint, exports=len(batch))
+        except Exception:
+            log.exception("export.flush_failed", endpoint=endpoint, exports=len(batch))
+        finally:
+            self._in_flight.release()
+
+    def _flush_expired(self):
+        while not self._closed.wait(self.max_delay / 2):
+            now = time.monotonic()
+            with self._lock:
+                expired = [
+                    (endpoint, self._take(endpoint))
+                    for endpoint, opened_at in list(self._opened_at.items())
+                    if now - opened_at >= self.max_delay
+                ]
+            for endpoint, batch in expired:
+                self._flush(endpoint, batch)
+
+    def close(self):
+        """
+        Flushes every pending batch and waits for the in-flight uploads to finish.
+        """
+        if self._executor is None:
+            return
+        self._closed.set()
+        self._timer.join()
+        with self._lock:
+            pending = [(endpoint, self._take(endpoint)) for endpoint in list(self._batches)]
+        for endpoint, batch in pending:
+            self._flush(endpoint, batch)
+        self._executor.shutdown(wait=True)
+        self._executor = None
+
+
+export_batcher = ExportBatcher(
+    max_size=EXPORT_BATCH_MAX_SIZE,
+    max_delay=EXPORT_BATCH_MAX_DELAY,
+    max_in_flight=EXPORT_BATCH_MAX_IN_FLIGHT,
+)
@@ -0,0 +1,249 @@
+"""
+Codecs of the sensor-data export messages.
+
+Two message formats are accepted:
+
+    - JSON, on export/<device_name>/sensor-data: a SensorDataPayload whose reading is the base64
+      encoded, zlib compressed reading (the original format).
+    - binary, on export/<device_name>/sensor-data-bin: a BINARY_HEADER followed by the encoded reading,
+      with no JSON nor base64. The header holds, big-endian:
+
+          version (uint8, BINARY_VERSION)
+          flags (uint8): low_battery, then whether send_timestamp, recv_timestamp and prediction are set
+          reading codec id (uint8), see below
+          inference layer (uint8)
+          send_timestamp (int64), recv_timestamp (int64), prediction (int32), 0 when not set
+
+Reading codecs turn the encoded reading back into the SEQUENCE_LENGTH x SAMPLE_SIZE big-endian 16-bit
+words expected by app.subscriber.export.decoder. Each device picks its codec in the header of every
+message:
+
+    0 raw              the words themselves
+    1 zlib             zlib compressed words
+    2 zlib-dict        zlib compressed with the preset dictionary of SENSOR_ZLIB_DICTIONARY
+    3 zlib-delta       zlib compressed, samples delta encoded
+    4 zlib-dict-delta  zlib compressed with the preset dictionary, samples delta encoded
+
+Delta encoded samples hold, for every column, the difference with the previous sample modulo 2^16
+(the first sample is kept as is). Readings change slowly between samples, so the differences are
+small and compress much better. Sensors and gateway must share the same preset dictionary, zlib
+checks its Adler-32 checksum when decompressing.
+"""
+import zlib
+import struct
+from typing import Optional
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover - NumPy is optional
+    np = None
+
+from app.subscriber.export import schemas
+from app.subscriber.export.decoder import READING_BYTESIZE
+from app.core.config import (
+    SAMPLE_SIZE,
+    SENSOR_ZLIB_DICTIONARY,
+)
+
+BINARY_VERSION = 1
+BINARY_HEADER = struct.Struct(">BBBBqqi")
+
+FLAG_LOW_BATTERY = 0x01
+FLAG_SEND_TIMESTAMP = 0x02
+FLAG_RECV_TIMESTAMP = 0x04
+FLAG_PREDICTION = 0x08
+
+
+# --- Delta encoding ---
+
+def delta_encode(words: bytes) -> bytes:
+    """
+    Replaces every sample of a reading by its difference with the previous one, column by column, modulo 2^16.
+    """
+    if np is not None:
+        samples = np.frombuffer(words, dtype=">u2").reshape(-1, SAMPLE_SIZE).astype(np.uint16)
+        deltas = samples.copy()
+        deltas[1:] -= samples[:-1]
+        return deltas.astype(">u2").tobytes()
+    values = struct.unpack(f">{len(words) // 2}H", words)
+    deltas = list(values[:SAMPLE_SIZE]) + [
+        (values[i] - values[i - SAMPLE_SIZE]) & 0xFFFF for i in range(SAMPLE_SIZE, len(values))
+    ]
+    return struct.pack(f">{len(deltas)}H", *deltas)
+
+
+def delta_decode(deltas: bytes) -> bytes:
+    """
+    Inverse of delta_encode.
+    """
+    if np is not None:
+        samples = np.frombuffer(deltas, dtype=">u2").reshape(-1, SAMPLE_SIZE)
+        return np.cumsum(samples, axis=0, dtype=np.uint16).astype(">u2").tobytes()
+    values = list(struct.unpack(f">{len(deltas) // 2}H", deltas))
+    for i in range(SAMPLE_SIZE, len(values)):
+        values[i] = (values[i] + values[i - SAMPLE_SIZE]) & 0xFFFF
+    return struct.pack(f">{len(values)}H", *values)
+
+
+# --- Reading codecs ---
+
+def load_zlib_dictionary(path: str) -> Optional[bytes]:
+    if not path:
+        return None
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def build_zlib_dictionary(readings: list[bytes], size: int = 4096, delta: bool = True) -> bytes:
+    """
+    Builds a preset dictionary from representative readings (raw words), the last size bytes of the
+    readings are kept. zlib uses at most 32 KiB of it, and a larger dictionary costs more to load per message.
+    """
+    data = b"".join(delta_encode(reading) if delta else reading for reading in readings)
+    return data[-size:]
+
+
+class ReadingCodec:
+    __slots__ = ("codec_id", "name", "compressed", "zdict", "delta", "_decompressor")
+
+    def __init__(self, codec_id: int, name: str, compressed: bool, zdict: bytes = None, delta: bool = False):
+        self.codec_id = codec_id
+        self.name = name
+        self.compressed = compressed
+        self.zdict = zdict
+        self.delta = delta
+        # decompressors are copied from this one, the preset dictionary is only loaded once
+        self._decompressor = zlib.decompressobj(zdict=zdict) if zdict is not None else zlib.decompressobj()
+
+    def decode(self, data: bytes) -> bytes:
+        """
+        Returns the big-endian 16-bit words of an encoded reading, which must be READING_BYTESIZE bytes long.
+        At most READING_BYTESIZE + 1 bytes are decompressed, whatever the compression ratio of the payload.
+        """
+        if self.compressed:
+            decompressor = self._decompressor.copy()
+            data = decompressor.decompress(data, READING_BYTESIZE + 1)
+            if not decompressor.eof:
+                raise ValueError(f"Truncated or oversized {self.name} reading")
+        if len(data) != READING_BYTESIZE:
+            raise ValueError(f"{self.name} reading has {len(data)} bytes, expected {READING_BYTESIZE}")
+        if self.delta:
+            return delta_decode(data)
+        return bytes(data)
+
+    def encode(self, words: bytes, level: int = 9) -> bytes:
+        """
+        Encodes a reading, as done by the sensors.
+        """
+        if self.delta:
+            words = delta_encode(words)
+        if not self.compressed:
+            return words
+        compressor = zlib.compressobj(level, zdict=self.zdict) if self.zdict is not None else zlib.compressobj(level)
+        return compressor.compress(words) + compressor.flush()
+
+
+class CodecRegistry:
+    def __init__(self):
+        self._codecs: dict[int, ReadingCodec] = {}
+        self._by_name: dict[str, ReadingCodec] = {}
+
+    def register(self, codec: ReadingCodec):
+        if codec.codec_id in self._codecs:
+            raise ValueError(f"Reading codec id {codec.codec_id} is already registered")
+        self._codecs[codec.codec_id] = codec
+        self._by_name[codec.name] = codec
+
+    def get(self, codec_id: int) -> ReadingCodec:
+        codec = self._codecs.get(codec_id)
+        if codec is None:
+            raise ValueError(f"Unknown or unavailable reading codec {codec_id}")
+        return codec
+
+    def by_name(self, name: str) -> ReadingCodec:
+        codec = self._by_name.get(name)
+        if codec is None:
+            raise ValueError(f"Unknown or unavailable reading codec {name}, expected one of {sorted(self._by_name)}")
+        return codec
+
+    def names(self) -> list[str]:
+        return list(self._by_name)
+
+
+def create_codec_registry(zdict: bytes = None) -> CodecRegistry:
+    """
+    Returns the registry of the reading codecs, the preset dictionary codecs are only registered with a dictionary.
+    """
+    registry = CodecRegistry()
+    registry.register(ReadingCodec(0, "raw", compressed=False))
+    registry.register(ReadingCodec(1, "zlib", compressed=True))
+    registry.register(ReadingCodec(3, "zlib-delta", compressed=True, delta=True))
+    if zdict is not None:
+        registry.register(ReadingCodec(2, "zlib-dict", compressed=True, zdict=zdict))
+        registry.register(ReadingCodec(4, "zlib-dict-delta", compressed=True, zdict=zdict, delta=True))
+    return registry
+
+
+reading_codecs = create_codec_registry(load_zlib_dictionary(SENSOR_ZLIB_DICTIONARY))
+json_reading_codec = reading_codecs.by_name("zlib")
+
+
+# --- Binary sensor-data messages ---
+
+class SensorDataFrame:
+    """
+    A binary sensor-data message, its reading is decoded by the export handler.
+    """
+
+    __slots__ = ("low_battery", "inference_descriptor", "codec", "reading")
+
+    def __init__(self, low_battery: bool, inference_descriptor: schemas.InferenceDescriptor, codec: ReadingCodec, reading: memoryview):
+        self.low_battery = low_battery
+        self.inference_descriptor = inference_descriptor
+        self.codec = codec
+        self.reading = reading
+
+
+def decode_binary_payload(payload: bytes, registry: CodecRegistry = reading_codecs) -> SensorDataFrame:
+    if len(payload) < BINARY_HEADER.size:
+        raise ValueError(f"Binary sensor-data message has {len(payload)} bytes, shorter than its {BINARY_HEADER.size} bytes header")
+    version, flags, codec_id, inference_layer, send_timestamp, recv_timestamp, prediction = BINARY_HEADER.unpack_from(payload)
+    if version != BINARY_VERSION:
+        raise ValueError(f"Unsupported binary sensor-data version {version}")
+    inference_descriptor = schemas.InferenceDescriptor.model_construct(
+        inference_layer=schemas.InferenceLayer(inference_layer),
+        send_timestamp=send_timestamp if flags & FLAG_SEND_TIMESTAMP else None,
+        recv_timestamp=recv_timestamp if flags & FLAG_RECV_TIMESTAMP else None,
+        prediction=prediction if flags & FLAG_PREDICTION else None,
+    )
+    return SensorDataFrame(
+        low_battery=bool(flags & FLAG_LOW_BATTERY),
+        inference_descriptor=inference_descriptor,
+        codec=registry.get(codec_id),
+        reading=memoryview(payload)[BINARY_HEADER.size:],
+    )
+
+
+def binary_header(
+    codec: ReadingCodec,
+    low_battery: bool,
+    inference_layer: int,
+    send_timestamp: int = None,
+    recv_timestamp: int = None,
+    prediction: int = None,
+) -> bytes:
+    flags = FLAG_LOW_BATTERY if low_battery else 0
+    flags |= FLAG_SEND_TIMESTAMP if send_timestamp is not None else 0
+    flags |= FLAG_RECV_TIMESTAMP if recv_timestamp is not None else 0
+    flags |= FLAG_PREDICTION if prediction is not None else 0
+    return BINARY_HEADER.pack(
+        BINARY_VERSION, flags, codec.codec_id, inference_layer,
+        send_timestamp or 0, recv_timestamp or 0, prediction or 0,
+    )
+
+
+def encode_binary_payload(words: bytes, codec: ReadingCodec, low_battery: bool, inference_layer: int, **timestamps) -> bytes:
+    """
+    Builds a binary sensor-data message, as done by the sensors.
+    """
+    return binary_header(codec, low_battery, inference_layer, **timestamps) + codec.encode(words)
@@ -0,0 +1,110 @@
+"""
+Decoding of the readings carried by sensor-data exports.
+
+A decompressed reading is a SEQUENCE_LENGTH x SAMPLE_SIZE matrix of big-endian 16-bit words.
+The first ACC_AXES columns of each sample are accelerometer axes and the remaining ones are
+gyroscope axes. The NumPy engine is used when NumPy is installed, otherwise the pure-Python
+engine is used. Both engines produce the same values.
+"""
+import struct
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover - NumPy is optional
+    np = None
+
+from app.core.config import (
+    SEQUENCE_LENGTH,
+    SAMPLE_SIZE,
+    SENSOR_READING_SIGNED,
+)
+
+# --- Accelerometer Constants ---
+G_MS2 = 9.80665
+MAX_INT_VALUE_SENSOR = 32768.0
+ACC_RAW_TO_MS2 = (G_MS2 / MAX_INT_VALUE_SENSOR)
+SENSOR_ACC_RANGE = 2 # 8g
+ACC_AXES = 3
+
+# --- Gyroscope Constants ---
+SENSOR_GYR_RANGE = 250.0
+PI = 3.14159265359
+GYR_RAW_TO_RADS = (PI / 180.0) / MAX_INT_VALUE_SENSOR
+
+# --- Scale Factors ---
+ACC_SCALE = pow(2, SENSOR_ACC_RANGE + 1) * ACC_RAW_TO_MS2
+GYR_SCALE = SENSOR_GYR_RANGE * GYR_RAW_TO_RADS
+COLUMN_SCALES = [ACC_SCALE if i < ACC_AXES else GYR_SCALE for i in range(SAMPLE_SIZE)]
+
+READING_WORDS = SEQUENCE_LENGTH * SAMPLE_SIZE
+READING_BYTESIZE = READING_WORDS * 2
+
+_WORD_FORMAT = "h" if SENSOR_READING_SIGNED else "H"
+_STRUCT_READING = struct.Struct(f">{READING_WORDS}{_WORD_FORMAT}")
+
+if np is not None:
+    _NP_WORD_DTYPE = np.dtype(">i2" if SENSOR_READING_SIGNED else ">u2")
+    _NP_COLUMN_SCALES = np.array(COLUMN_SCALES, dtype=np.float64)
+
+
+def _check_bytesize(data: bytes):
+    if len(data) < READING_BYTESIZE:
+        raise ValueError(
+            f"Reading has {len(data)} bytes, expected {READING_BYTESIZE} "
+            f"({SEQUENCE_LENGTH} samples of {SAMPLE_SIZE} 16-bit words)"
+        )
+
+
+# --- NumPy Engine ---
+
+def _parse_reading_numpy(data: bytes):
+    """
+    Returns a read-only (SEQUENCE_LENGTH, SAMPLE_SIZE) view over data, no copy is made.
+    """
+    _check_bytesize(data)
+    return np.frombuffer(data, dtype=_NP_WORD_DTYPE, count=READING_WORDS).reshape(SEQUENCE_LENGTH, SAMPLE_SIZE)
+
+
+def _convert_reading_numpy(raw_reading):
+    """
+    Applies the per-column scale factors in a single broadcasted multiply.
+    """
+    return raw_reading * _NP_COLUMN_SCALES
+
+
+# --- Pure-Python Engine ---
+
+def _parse_reading_python(data: bytes) -> list[list[int]]:
+    _check_bytesize(data)
+    words = _STRUCT_READING.unpack_from(data)
+    return [list(words[i:i + SAMPLE_SIZE]) for i in range(0, READING_WORDS, SAMPLE_SIZE)]
+
+
+def _convert_reading_python(raw_reading: list[list[int]]) -> list[list[float]]:
+    return [
+        [scale * raw for scale, raw in zip(COLUMN_SCALES, sample)]
+        for sample in raw_reading
+    ]
+
+
+if np is not None:
+    parse_reading = _parse_reading_numpy
+    convert_reading = _convert_reading_numpy
+else:
+    parse_reading = _parse_reading_python
+    convert_reading = _convert_reading_python
+
+
+def to_list(reading) -> list:
+    """
+    Converts a reading returned by either engine into nested Python lists.
+    """
+    return reading.tolist() if hasattr(reading, "tolist") else reading
+
+
+def decode_reading(data: bytes) -> list[list[float]]:
+    """
+    Decodes a decompressed reading into physical values: m/s^2 for the accelerometer
+    columns and rad/s for the gyroscope columns.
+    """
+    return to_list(convert_reading(parse_reading(data)))
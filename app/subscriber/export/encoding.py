@@ -0,0 +1,176 @@
+"""
+Encodings used to send exports to the Gateway API.
+
+Reading encodings (EXPORT_READING_ENCODING) decide how SensorReading values are carried:
+
+    - json: "values" holds the SEQUENCE_LENGTH x SAMPLE_SIZE physical values as nested lists (default).
+    - float32-b64: "packed_values" holds the physical values as little-endian float32, base64 encoded.
+    - int16-b64: "packed_values" holds the raw big-endian 16-bit words sent by the sensor, base64 encoded,
+      together with the per-column scale factors that convert them into physical values.
+
+Body encodings (EXPORT_BODY_ENCODING) decide how the request body is serialized:
+
+    - json: application/json (default).
+    - msgpack: application/msgpack.
+
+If EXPORT_GZIP is set the body is also gzip compressed (Content-Encoding: gzip). A Gateway API
+that does not accept a body encoding answers 415 Unsupported Media Type, in which case the export
+is re-sent as plain JSON and plain JSON is used for that endpoint from then on.
+
+Every export request carries an Idempotency-Key header, see app.subscriber.dedup.
+"""
+import gzip
+import base64
+import struct
+import logging
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover - msgpack is optional
+    msgpack = None
+
+from pydantic_core import to_json, to_jsonable_python
+from app.subscriber.export import decoder
+from app.subscriber.export import schemas
+from app.subscriber.spool import export_spool
+from app.subscriber.dedup import idempotency_headers
+from app.subscriber.utils import post_to_gateway_api, GatewayAPIError, JSON_HEADERS
+from app.core.config import (
+    SENSOR_READING_SIGNED,
+    EXPORT_READING_ENCODING,
+    EXPORT_BODY_ENCODING,
+    EXPORT_GZIP,
+)
+
+logging.basicConfig(level=logging.INFO)
+
+READING_ENCODING_JSON = "json"
+READING_ENCODING_FLOAT32_B64 = "float32-b64"
+READING_ENCODING_INT16_B64 = "int16-b64"
+READING_ENCODINGS = (READING_ENCODING_JSON, READING_ENCODING_FLOAT32_B64, READING_ENCODING_INT16_B64)
+
+BODY_ENCODING_JSON = "json"
+BODY_ENCODING_MSGPACK = "msgpack"
+BODY_ENCODINGS = (BODY_ENCODING_JSON, BODY_ENCODING_MSGPACK)
+
+CONTENT_TYPES = {
+    BODY_ENCODING_JSON: "application/json",
+    BODY_ENCODING_MSGPACK: "application/msgpack",
+}
+
+if EXPORT_READING_ENCODING not in READING_ENCODINGS:
+    raise ValueError(f"Unknown EXPORT_READING_ENCODING {EXPORT_READING_ENCODING}, expected one of {READING_ENCODINGS}")
+if EXPORT_BODY_ENCODING not in BODY_ENCODINGS:
+    raise ValueError(f"Unknown EXPORT_BODY_ENCODING {EXPORT_BODY_ENCODING}, expected one of {BODY_ENCODINGS}")
+
+body_encoding = EXPORT_BODY_ENCODING
+if body_encoding == BODY_ENCODING_MSGPACK and msgpack is None:
+    logging.warning("[MQTT Subscriber] msgpack is not installed, exports are sent as JSON")
+    body_encoding = BODY_ENCODING_JSON
+
+# endpoints whose Gateway API rejected the configured body encoding
+_json_only_endpoints: set[str] = set()
+
+
+# --- Reading Encoding ---
+
+def _pack_float32(values) -> bytes:
+    if hasattr(values, "astype"):
+        return values.astype("<f4").tobytes()
+    flat = [value for sample in values for value in sample]
+    return struct.pack(f"<{len(flat)}f", *flat)
+
+
+def encode_reading_values(raw_bytes: bytes, values) -> dict:
+    """
+    Returns the SensorReading fields carrying a reading, raw_bytes being the decompressed reading
+    and values the physical values returned by decoder.convert_reading.
+    """
+    if EXPORT_READING_ENCODING == READING_ENCODING_JSON:
+        return {"values": decoder.to_list(values)}
+
+    shape = [decoder.SEQUENCE_LENGTH, decoder.SAMPLE_SIZE]
+    if EXPORT_READING_ENCODING == READING_ENCODING_FLOAT32_B64:
+        packed_values = schemas.PackedValues.model_construct(
+            encoding=READING_ENCODING_FLOAT32_B64,
+            dtype="<f4",
+            shape=shape,
+            data=base64.b64encode(_pack_float32(values)).decode(),
+        )
+    else:
+        packed_values = schemas.PackedValues.model_construct(
+            encoding=READING_ENCODING_INT16_B64,
+            dtype=">i2" if SENSOR_READING_SIGNED else ">u2",
+            shape=shape,
+            data=base64.b64encode(raw_bytes[:decoder.READING_BYTESIZE]).decode(),
+            scales=decoder.COLUMN_SCALES,
+        )
+    return {"packed_values": packed_values}
+
+
+# --- Body Encoding ---
+
+def encode_body(data, plain: bool = False) -> tuple[bytes, dict]:
+    """
+    Serializes an export body, a pydantic model or a dict that may contain pydantic models,
+    returning the content and the headers to send it with. plain forces uncompressed JSON.
+    """
+    if plain or (body_encoding == BODY_ENCODING_JSON and not EXPORT_GZIP):
+        return to_json(data), JSON_HEADERS
+
+    if body_encoding == BODY_ENCODING_MSGPACK:
+        content = msgpack.packb(to_jsonable_python(data))
+    else:
+        content = to_json(data)
+
+    headers = {"Content-Type": CONTENT_TYPES[body_encoding]}
+    if EXPORT_GZIP:
+        content = gzip.compress(content, compresslevel=6)
+        headers["Content-Encoding"] = "gzip"
+    return content, headers
+
+
+def send_export(endpoint: str, content: bytes, headers: dict):
+    """
+    POSTs a serialized export to the Gateway API, through the export spool if it is enabled.
+    """
+    if export_spool is not None:
+        export_spool.send(endpoint, content, headers)
+    else:
+        post_to_gateway_api(endpoint, content=content, headers=headers)
+
+
+def encode_export(endpoint: str, data) -> tuple[bytes, dict]:
+    """
+    Serializes an export body for an endpoint, with its idempotency key. Endpoints that rejected the
+    configured body encoding get plain JSON.
+    """
+    content, headers = encode_body(data, plain=endpoint in _json_only_endpoints)
+    return content, idempotency_headers(headers, data, content)
+
+
+def falls_back_to_json(endpoint: str, headers: dict, error: GatewayAPIError) -> bool:
+    """
+    Returns whether a failed export must be re-sent as plain JSON, the Gateway API having answered 415 to
+    its body encoding. The endpoint gets plain JSON from then on.
+    """
+    if error.response is None or error.response.status_code != 415:
+        return False
+    if headers.get("Content-Type") == JSON_HEADERS["Content-Type"] and "Content-Encoding" not in headers:
+        return False
+    logging.warning(f"[MQTT Subscriber] Gateway API does not accept {headers} on {endpoint}, falling back to JSON")
+    _json_only_endpoints.add(endpoint)
+    return True
+
+
+def post_export(endpoint: str, data):
+    """
+    POSTs an export body to the Gateway API using the configured body encoding.
+    """
+    content, headers = encode_export(endpoint, data)
+    try:
+        send_export(endpoint, content, headers)
+    except GatewayAPIError as e:
+        if not falls_back_to_json(endpoint, headers, e):
+            raise
+        send_export(endpoint, *encode_export(endpoint, data))
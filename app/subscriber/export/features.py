@@ -0,0 +1,248 @@
+"""
+Gateway-side feature extraction of sensor-data readings.
+
+Devices using a feature set export, instead of their SEQUENCE_LENGTH x SAMPLE_SIZE reading, a few
+features computed over the window of each axis (column), in the same physical units as the reading:
+
+    - mean, std, rms, peak (largest absolute value), peak_to_peak;
+    - crest (peak / rms), skewness, kurtosis (excess kurtosis, 0 for a normal distribution);
+    - bands: the power of each EXPORT_FEATURE_BANDS frequency band, from the FFT of the window without
+      its mean. The bands of a window sum up to its variance when they cover 0 Hz to SENSOR_SAMPLE_RATE / 2.
+
+A downsample:<k> item of a feature set also exports the reading averaged over blocks of k samples.
+Feature sets are named in EXPORT_FEATURE_SETS and picked per device with EXPORT_FEATURE_DEFAULT_SET and
+EXPORT_FEATURE_DEVICES. Features are computed with NumPy, devices export full readings without it.
+"""
+import logging
+from functools import cached_property
+from typing import Callable, Optional
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover - NumPy is optional
+    np = None
+
+from app.subscriber.export.decoder import SEQUENCE_LENGTH
+from app.core.config import (
+    EXPORT_FEATURE_SETS,
+    EXPORT_FEATURE_DEFAULT_SET,
+    EXPORT_FEATURE_DEVICES,
+    EXPORT_FEATURE_BANDS,
+    SENSOR_SAMPLE_RATE,
+)
+
+logging.basicConfig(level=logging.INFO)
+
+# feature set of devices exporting full readings
+RAW_FEATURE_SET = "raw"
+DOWNSAMPLE_ITEM = "downsample:"
+
+
+def parse_bands(value: str) -> list[tuple[float, float]]:
+    """
+    Parses "low-high,low-high" into [(low, high)] frequency bands in Hz.
+    """
+    bands = []
+    for item in value.split(","):
+        if not item.strip():
+            continue
+        low, high = (float(edge) for edge in item.split("-", 1))
+        if not 0 <= low < high:
+            raise ValueError(f"Invalid frequency band {item.strip()}, expected <low>-<high> Hz")
+        bands.append((low, high))
+    return bands
+
+
+def band_name(band: tuple[float, float]) -> str:
+    return "band_{:g}_{:g}hz".format(*band).replace(".", "_")
+
+
+class Window:
+    """
+    The (samples, axes) window of a reading, statistics shared by several features are computed once.
+    """
+
+    def __init__(self, values, bands: list[tuple[float, float]], sample_rate: float):
+        self.values = values
+        self.bands = bands
+        self.sample_rate = sample_rate
+
+    # sums over the samples use einsum, several times faster than mean() on windows this small
+    @cached_property
+    def mean(self):
+        return np.einsum("ij->j", self.values) / len(self.values)
+
+    @cached_property
+    def centered(self):
+        return self.values - self.mean
+
+    @cached_property
+    def squared(self):
+        return self.centered * self.centered
+
+    @cached_property
+    def variance(self):
+        return np.einsum("ij->j", self.squared) / len(self.values)
+
+    @cached_property
+    def std(self):
+        return np.sqrt(self.variance)
+
+    @cached_property
+    def rms(self):
+        return np.sqrt(np.einsum("ij,ij->j", self.values, self.values) / len(self.values))
+
+    @cached_property
+    def peak(self):
+        return np.maximum(self.values.max(axis=0), -self.values.min(axis=0))
+
+    def standardized_moment(self, order: int):
+        """
+        Returns the third or fourth standardized moment of each axis, 0 for constant axes.
+        """
+        other = self.centered if order == 3 else self.squared
+        moment = np.einsum("ij,ij->j", self.squared, other) / len(self.values)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.where(self.variance > 0, moment / self.variance ** (order / 2), 0.0)
+
+    def band_powers(self):
+        """
+        Returns the (bands, axes) power of the frequency bands.
+        """
+        power = np.abs(np.fft.rfft(self.centered, axis=0)) ** 2
+        return _band_weights(len(self.values), tuple(self.bands), self.sample_rate) @ power
+
+
+_band_weights_cache: dict[tuple, object] = {}
+
+
+def _band_weights(samples: int, bands: tuple, sample_rate: float):
+    """
+    Returns the (bands, frequency bins) matrix summing the one-sided power spectrum of a window into
+    band powers, scaled so that the bins of a window sum up to its variance.
+    """
+    key = (samples, bands, sample_rate)
+    weights = _band_weights_cache.get(key)
+    if weights is None:
+        frequencies = np.fft.rfftfreq(samples, d=1.0 / sample_rate)
+        scale = np.full(len(frequencies), 2.0 / samples ** 2)
+        scale[0] /= 2
+        if samples % 2 == 0:
+            scale[-1] /= 2
+        weights = np.array([(frequencies >= low) & (frequencies < high) for low, high in bands], dtype=float) * scale
+        _band_weights_cache[key] = weights
+    return weights
+
+
+def _bands(window: Window) -> dict:
+    return dict(zip((band_name(band) for band in window.bands), window.band_powers()))
+
+
+# feature name -> function returning {name: per-axis values} of a window
+FEATURES: dict[str, Callable[[Window], dict]] = {
+    "mean": lambda window: {"mean": window.mean},
+    "std": lambda window: {"std": window.std},
+    "rms": lambda window: {"rms": window.rms},
+    "peak": lambda window: {"peak": window.peak},
+    "peak_to_peak": lambda window: {"peak_to_peak": np.ptp(window.values, axis=0)},
+    "crest": lambda window: {"crest": np.divide(window.peak, window.rms, out=np.zeros_like(window.rms), where=window.rms > 0)},
+    "skewness": lambda window: {"skewness": window.standardized_moment(3)},
+    "kurtosis": lambda window: {"kurtosis": window.standardized_moment(4) - 3.0},
+    "bands": _bands,
+}
+
+
+class FeatureSet:
+    def __init__(self, name: str, features: list[str], downsample: int = 0, bands: list[tuple[float, float]] = None, sample_rate: float = SENSOR_SAMPLE_RATE):
+        unknown = [feature for feature in features if feature not in FEATURES]
+        if unknown:
+            raise ValueError(f"Unknown features {unknown} in feature set {name}, expected some of {list(FEATURES)}")
+        if downsample < 0 or (downsample and SEQUENCE_LENGTH % downsample):
+            raise ValueError(f"Feature set {name} downsamples by {downsample}, which does not divide SEQUENCE_LENGTH {SEQUENCE_LENGTH}")
+        self.name = name
+        self.features = features
+        self.downsample = downsample
+        self.bands = bands if bands is not None else parse_bands(EXPORT_FEATURE_BANDS)
+        self.sample_rate = sample_rate
+
+    def extract(self, values) -> dict:
+        """
+        Returns the SensorReading fields carrying the features of a reading, values being the physical
+        values returned by decoder.convert_reading.
+        """
+        values = np.asarray(values, dtype=float)
+        window = Window(values, self.bands, self.sample_rate)
+        features = {}
+        for feature in self.features:
+            for name, axes in FEATURES[feature](window).items():
+                features[name] = axes.tolist()
+        fields = {"features": features}
+        if self.downsample:
+            fields["values"] = values.reshape(-1, self.downsample, values.shape[1]).mean(axis=1).tolist()
+            fields["downsample"] = self.downsample
+        return fields
+
+    def __repr__(self) -> str:
+        return f"FeatureSet({self.name!r}, {self.features}, downsample={self.downsample})"
+
+
+def parse_feature_sets(value: str) -> dict[str, FeatureSet]:
+    """
+    Parses "name=feature,...,downsample:<k>;name=..." into {name: FeatureSet}.
+    """
+    feature_sets = {}
+    for item in value.split(";"):
+        if "=" not in item:
+            continue
+        name, spec = (part.strip() for part in item.split("=", 1))
+        features, downsample = [], 0
+        for feature in (feature.strip() for feature in spec.split(",")):
+            if feature.startswith(DOWNSAMPLE_ITEM):
+                downsample = int(feature[len(DOWNSAMPLE_ITEM):])
+            elif feature:
+                features.append(feature)
+        feature_sets[name] = FeatureSet(name, features, downsample)
+    return feature_sets
+
+
+class FeatureSelector:
+    """
+    Picks the feature set of each device.
+    """
+
+    def __init__(self, feature_sets: dict[str, FeatureSet], default_set: str, device_sets: dict[str, str]):
+        for set_name in [default_set, *device_sets.values()]:
+            if set_name and set_name != RAW_FEATURE_SET and set_name not in feature_sets:
+                raise ValueError(f"Unknown feature set {set_name}, expected one of {[RAW_FEATURE_SET, *feature_sets]}")
+        self.feature_sets = feature_sets
+        self.default = feature_sets.get(default_set)
+        self.devices = {device: feature_sets.get(set_name) for device, set_name in device_sets.items()}
+        if np is None and (self.default is not None or any(self.devices.values())):
+            logging.warning("[MQTT Subscriber] NumPy is not installed, sensor-data exports carry full readings")
+            self.default, self.devices = None, {}
+
+    def for_device(self, device_name: str) -> Optional[FeatureSet]:
+        """
+        Returns the feature set of a device, None if it exports full readings.
+        """
+        return self.devices.get(device_name, self.default)
+
+
+def parse_device_sets(value: str) -> dict[str, str]:
+    """
+    Parses "device=set,device=set" into {device: set}.
+    """
+    device_sets = {}
+    for item in value.split(","):
+        if "=" not in item:
+            continue
+        device, set_name = item.split("=", 1)
+        device_sets[device.strip()] = set_name.strip()
+    return device_sets
+
+
+feature_selector = FeatureSelector(
+    parse_feature_sets(EXPORT_FEATURE_SETS),
+    EXPORT_FEATURE_DEFAULT_SET,
+    parse_device_sets(EXPORT_FEATURE_DEVICES),
+)
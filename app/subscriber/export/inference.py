@@ -0,0 +1,278 @@
+"""
+Gateway-layer inference of sensor-data readings.
+
+Sensors configured for GATEWAY_INFERENCE_LAYER send their readings without a prediction. When a model
+is configured (INFERENCE_MODEL_PATH), their sensor-data exports are held by the inference batcher,
+which stacks the readings of many sensors into one (batch, SEQUENCE_LENGTH, SAMPLE_SIZE) array and runs
+a single model call per batch. A batch runs as soon as it holds INFERENCE_BATCH_MAX_SIZE readings or its
+oldest reading has waited INFERENCE_BATCH_MAX_DELAY seconds, the latency budget of a prediction. The
+prediction and recv_timestamp (when the prediction was made, in ms) are then filled into the inference
+descriptor and the exports are sent. If the model fails, the exports are sent without a prediction.
+
+Backends (INFERENCE_BACKEND) load a model file and predict an integer class per reading:
+
+    - numpy-mlp: a multilayer perceptron stored as a NumPy .npz file, see NumpyMLP. It runs on CPU
+      with NumPy only.
+"""
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover - NumPy is optional
+    np = None
+
+from app.core.log import get_logger
+from app.core.metrics import metrics, STAGE_SECONDS
+from app.subscriber.export import schemas
+from app.subscriber.export.decoder import SEQUENCE_LENGTH, SAMPLE_SIZE
+from app.core.config import (
+    INFERENCE_BACKEND,
+    INFERENCE_MODEL_PATH,
+    INFERENCE_BATCH_MAX_SIZE,
+    INFERENCE_BATCH_MAX_DELAY,
+    INFERENCE_MAX_PENDING,
+    INFERENCE_MAX_IN_FLIGHT,
+)
+
+logging.basicConfig(level=logging.INFO)
+log = get_logger(__name__)
+
+ACTIVATIONS = {
+    "relu": lambda x: np.maximum(x, 0, out=x),
+    "tanh": lambda x: np.tanh(x, out=x),
+    "identity": lambda x: x,
+}
+
+
+# --- Backends ---
+
+class NumpyMLP:
+    """
+    Multilayer perceptron over the flattened SEQUENCE_LENGTH x SAMPLE_SIZE reading, in physical units.
+
+    Model file (.npz): weights W0, W1, ... of shape (inputs, outputs) and biases b0, b1, ...; optionally
+    "activation" (relu, tanh or identity, applied between layers, relu by default) and "input_mean" /
+    "input_std", broadcastable to the flattened reading, standardizing it. The prediction is the index of
+    the largest output, or whether the output is positive for single-output models.
+    """
+
+    def __init__(self, weights: list, biases: list, activation: str = "relu", input_mean=None, input_std=None):
+        if activation not in ACTIVATIONS:
+            raise ValueError(f"Unknown activation {activation}, expected one of {list(ACTIVATIONS)}")
+        if not weights or len(weights) != len(biases):
+            raise ValueError("An MLP needs as many biases as weights, and at least one layer")
+        if weights[0].shape[0] != SEQUENCE_LENGTH * SAMPLE_SIZE:
+            raise ValueError(f"Model expects {weights[0].shape[0]} inputs, readings have {SEQUENCE_LENGTH * SAMPLE_SIZE} values")
+        self.weights = [np.asarray(w, dtype=np.float32) for w in weights]
+        self.biases = [np.asarray(b, dtype=np.float32) for b in biases]
+        self.activation = activation
+        self.input_mean = None if input_mean is None else np.asarray(input_mean, dtype=np.float32).reshape(-1)
+        self.input_scale = None if input_std is None else (1.0 / np.asarray(input_std, dtype=np.float32)).reshape(-1)
+
+    @classmethod
+    def load(cls, path: str) -> "NumpyMLP":
+        with np.load(path, allow_pickle=False) as model:
+            layers = sum(1 for key in model.files if key.startswith("W"))
+            return cls(
+                weights=[model[f"W{i}"] for i in range(layers)],
+                biases=[model[f"b{i}"] for i in range(layers)],
+                activation=str(model["activation"]) if "activation" in model.files else "relu",
+                input_mean=model["input_mean"] if "input_mean" in model.files else None,
+                input_std=model["input_std"] if "input_std" in model.files else None,
+            )
+
+    def save(self, path: str):
+        arrays = {f"W{i}": w for i, w in enumerate(self.weights)}
+        arrays.update((f"b{i}", b) for i, b in enumerate(self.biases))
+        arrays["activation"] = np.array(self.activation)
+        if self.input_mean is not None:
+            arrays["input_mean"] = self.input_mean
+        if self.input_scale is not None:
+            arrays["input_std"] = 1.0 / self.input_scale
+        np.savez(path, **arrays)
+
+    def predict(self, readings) -> list[int]:
+        """
+        Returns the prediction of each reading of a (batch, SEQUENCE_LENGTH, SAMPLE_SIZE) array.
+        """
+        x = np.asarray(readings, dtype=np.float32).reshape(len(readings), -1)
+        if self.input_mean is not None:
+            x = x - self.input_mean
+        if self.input_scale is not None:
+            x = x * self.input_scale
+        activation = ACTIVATIONS[self.activation]
+        last = len(self.weights) - 1
+        for i, (w, b) in enumerate(zip(self.weights, self.biases)):
+            x = x @ w
+            x += b
+            if i < last:
+                x = activation(x)
+        if x.shape[1] == 1:
+            return (x[:, 0] > 0).astype(int).tolist()
+        return x.argmax(axis=1).tolist()
+
+
+# backend name -> function loading a model file
+INFERENCE_BACKENDS: dict[str, Callable] = {
+    "numpy-mlp": NumpyMLP.load,
+}
+
+
+# --- Batcher ---
+
+class InferenceBatcher:
+    def __init__(self, model, max_size: int, max_delay: float, max_pending: int, max_in_flight: int):
+        self.model = model
+        self.max_size = max(1, max_size)
+        self.max_delay = max_delay
+        self.max_pending = max(self.max_size, max_pending)
+        self.max_in_flight = max(1, max_in_flight)
+
+        self._condition = threading.Condition()
+        # (reading, added_at, endpoint, export, send)
+        self._pending: list[tuple] = []
+        self._in_flight = threading.BoundedSemaphore(self.max_in_flight)
+        self._executor: ThreadPoolExecutor = None
+        self._thread: threading.Thread = None
+        self._closed = False
+
+        self.batches = 0
+        self.predictions = 0
+        self.failures = 0
+
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._condition:
+            if self._thread is not None:
+                return
+            self._closed = False
+            self._executor = ThreadPoolExecutor(max_workers=self.max_in_flight, thread_name_prefix="inference-export")
+            self._thread = threading.Thread(target=self._run, name="inference-batcher", daemon=True)
+            self._thread.start()
+
+    def add(self, reading, endpoint: str, export: schemas.SensorDataExport, send: Callable[[str, object], None]):
+        """
+        Holds an export until the prediction of its reading is made, then sends it with send(endpoint, export).
+        Blocks while INFERENCE_MAX_PENDING readings are waiting.
+        """
+        self._ensure_started()
+        with self._condition:
+            while len(self._pending) >= self.max_pending and not self._closed:
+                self._condition.wait()
+            self._pending.append((reading, time.monotonic(), endpoint, export, send))
+            if len(self._pending) == 1 or len(self._pending) >= self.max_size:
+                self._condition.notify_all()
+
+    def _take(self) -> Optional[list]:
+        """
+        Waits for the next batch to be due, returns None once closed and drained.
+        """
+        with self._condition:
+            while True:
+                if self._pending:
+                    wait = self._pending[0][1] + self.max_delay - time.monotonic()
+                    if len(self._pending) >= self.max_size or wait <= 0 or self._closed:
+                        batch, self._pending = self._pending[:self.max_size], self._pending[self.max_size:]
+                        self._condition.notify_all()
+                        return batch
+                    self._condition.wait(wait)
+                elif self._closed:
+                    return None
+                else:
+                    self._condition.wait()
+
+    def _run(self):
+        while True:
+            batch = self._take()
+            if batch is None:
+                return
+            self._predict(batch)
+
+    def _predict(self, batch: list):
+        started_at = time.perf_counter()
+        waited = time.monotonic() - batch[0][1]
+        try:
+            predictions = self.model.predict(np.stack([item[0] for item in batch]))
+        except Exception:
+            self.failures += 1
+            predictions = [None] * len(batch)
+            log.exception("inference.failed", readings=len(batch))
+        recv_timestamp = time.time_ns() // 1_000_000
+        metrics.observe(STAGE_SECONDS, ("sensor-data", "inference-wait"), waited)
+        metrics.observe(STAGE_SECONDS, ("sensor-data", "inference"), time.perf_counter() - started_at)
+        self.batches += 1
+        self.predictions += len(batch)
+
+        for (_, _, endpoint, export, send), prediction in zip(batch, predictions):
+            if prediction is not None:
+                sensor_data = export.export_value
+                descriptor = sensor_data.inference_descriptor
+                sensor_data.inference_descriptor = schemas.InferenceDescriptor.model_construct(
+                    inference_layer=descriptor.inference_layer,
+                    send_timestamp=descriptor.send_timestamp,
+                    recv_timestamp=recv_timestamp,
+                    prediction=int(prediction),
+                )
+            # blocks the batcher while INFERENCE_MAX_IN_FLIGHT exports are being sent
+            self._in_flight.acquire()
+            self._executor.submit(self._send, send, endpoint, export)
+
+    def _send(self, send: Callable, endpoint: str, export):
+        try:
+            send(endpoint, export)
+        except Exception:
+            log.exception("export.failed", export.metadata.sensor_name, endpoint=endpoint)
+        finally:
+            self._in_flight.release()
+
+    def stats(self) -> dict:
+        return {
+            "pending": len(self._pending),
+            "batches": self.batches,
+            "predictions": self.predictions,
+            "failures": self.failures,
+            "batch_size_avg": self.predictions / self.batches if self.batches else 0.0,
+        }
+
+    def close(self):
+        """
+        Predicts the pending readings and waits for their exports to be sent.
+        """
+        if self._thread is None:
+            return
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join()
+        self._thread = None
+        self._executor.shutdown(wait=True)
+        self._executor = None
+
+
+def create_inference_batcher() -> Optional[InferenceBatcher]:
+    """
+    Returns the inference batcher, None if no model is configured.
+    """
+    if not INFERENCE_MODEL_PATH:
+        return None
+    if np is None:
+        logging.warning("[MQTT Subscriber] NumPy is not installed, gateway-layer inference is disabled")
+        return None
+    if INFERENCE_BACKEND not in INFERENCE_BACKENDS:
+        raise ValueError(f"Unknown INFERENCE_BACKEND {INFERENCE_BACKEND}, expected one of {list(INFERENCE_BACKENDS)}")
+    model = INFERENCE_BACKENDS[INFERENCE_BACKEND](INFERENCE_MODEL_PATH)
+    return InferenceBatcher(
+        model,
+        max_size=INFERENCE_BATCH_MAX_SIZE,
+        max_delay=INFERENCE_BATCH_MAX_DELAY,
+        max_pending=INFERENCE_MAX_PENDING,
+        max_in_flight=INFERENCE_MAX_IN_FLIGHT,
+    )
+
+
+inference_batcher = create_inference_batcher()
@@ -0,0 +1,124 @@
+"""
+Upstream summaries of the inference latency windows.
+
+The inference-latency-bench samples of the subscriber are aggregated per sensor and inference layer
+into the windows of app.core.latency.inference_latency. Once a window closes, its summaries are POSTed
+to the Gateway API, in bulk, as InferenceLatencySummaryExport items of the batch envelope of
+app.subscriber.export.batcher:
+
+    POST /export/inference-latency-summary/batch
+
+Each subscriber process sends the summaries of the samples it received. When the samples of a sensor
+are shared among several processes, the Gateway API merges their sketches (see LatencySummary.sketch).
+Batches the Gateway API did not take are sent again on the next flush, until their window expires.
+"""
+import time
+import logging
+import threading
+from app.core.log import get_logger
+from app.core.latency import LatencyWindows, inference_latency
+from app.subscriber.export import schemas
+from app.subscriber.export.batcher import batch_envelope, BATCH_ENDPOINT_SUFFIX
+from app.subscriber.export.encoding import post_export
+from app.core.config import (
+    GATEWAY_NAME,
+    EXPORT_BATCH_MAX_SIZE,
+    LATENCY_SUMMARY_ENABLED,
+)
+
+logging.basicConfig(level=logging.INFO)
+log = get_logger(__name__)
+
+SUMMARY_ENDPOINT = "/export/inference-latency-summary"
+
+
+def summary_exports(window_start: int, window_end: int, sketches: dict) -> list[schemas.InferenceLatencySummaryExport]:
+    """
+    Returns the summary export of each sensor of a window, sketches being {(sensor_name, inference_layer): sketch}.
+    """
+    layers: dict[str, list] = {}
+    for (sensor_name, inference_layer), sketch in sorted(sketches.items()):
+        layers.setdefault(sensor_name, []).append(schemas.LatencySummary.model_construct(
+            inference_layer=schemas.InferenceLayer(inference_layer),
+            sketch=sketch.to_dict(),
+            **sketch.summary(),
+        ))
+    return [
+        schemas.InferenceLatencySummaryExport.model_construct(
+            metadata=schemas.Metadata.model_construct(gateway_name=GATEWAY_NAME, sensor_name=sensor_name),
+            export_value=schemas.InferenceLatencySummary.model_construct(
+                window_start=window_start,
+                window_end=window_end,
+                layers=sensor_layers,
+            ),
+        )
+        for sensor_name, sensor_layers in layers.items()
+    ]
+
+
+class LatencySummaryFlusher:
+    def __init__(self, windows: LatencyWindows, batch_size: int = EXPORT_BATCH_MAX_SIZE):
+        self.windows = windows
+        self.batch_size = max(1, batch_size)
+        # closed windows are looked for a few times per window
+        self.interval = min(5.0, windows.window / 4)
+        self._stopped = threading.Event()
+        self._thread: threading.Thread = None
+        # (window start, summaries) batches to send again
+        self._retry: list[tuple[int, list]] = []
+
+    def flush(self, include_open: bool = False):
+        batches, self._retry = self._retry, []
+        for window_start, sketches in self.windows.take_closed(include_open=include_open):
+            exports = summary_exports(window_start, int(window_start + self.windows.window), sketches)
+            batches += [(window_start, exports[i:i + self.batch_size]) for i in range(0, len(exports), self.batch_size)]
+
+        # batches are kept for retry as long as their window would be
+        oldest = self.windows.window_start(time.time()) - self.windows.retention * self.windows.window
+        for window_start, batch in batches:
+            if window_start < oldest:
+                log.warning("latency.flush_expired", window_start=window_start, summaries=len(batch))
+                continue
+            try:
+                post_export(f"{SUMMARY_ENDPOINT}{BATCH_ENDPOINT_SUFFIX}", batch_envelope(batch))
+                log.info("latency.flushed", window_start=window_start, summaries=len(batch))
+            except Exception:
+                log.exception("latency.flush_failed", window_start=window_start, summaries=len(batch))
+                self._retry.append((window_start, batch))
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.flush()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="latency-summaries", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Sends the summaries of every window not sent yet, the current one included.
+        """
+        if self._thread is None:
+            return
+        self._stopped.set()
+        self._thread.join()
+        self._thread = None
+        self.flush(include_open=True)
+
+
+_flusher: LatencySummaryFlusher = None
+
+
+def start_latency_summaries():
+    global _flusher
+    if not LATENCY_SUMMARY_ENABLED or _flusher is not None:
+        return
+    _flusher = LatencySummaryFlusher(inference_latency)
+    _flusher.start()
+
+
+def stop_latency_summaries():
+    global _flusher
+    if _flusher is not None:
+        _flusher.stop()
+        _flusher = None
@@ -1,6 +1,6 @@
 import uuid
 import enum
-from pydantic import BaseModel
+from pydantic import BaseModel, model_serializer
 from typing import Optional
 
 class Metadata(BaseModel):
@@ -27,10 +27,59 @@ class InferenceLatencyBenchmark(BaseModel):
 class InferenceLatencyBenchmarkExport(BaseExport):
     export_value: InferenceLatencyBenchmark
 
+class LatencySummary(BaseModel):
+    """
+    Inference latencies (ms) of a sensor and inference layer over a window, sketch being the mergeable
+    app.core.latency.LatencySketch they were estimated from
+    """
+
+    inference_layer: InferenceLayer
+    count: int
+    min: Optional[float] = None
+    max: Optional[float] = None
+    mean: Optional[float] = None
+    p50: Optional[float] = None
+    p90: Optional[float] = None
+    p99: Optional[float] = None
+    sketch: dict
+
+class InferenceLatencySummary(BaseModel):
+    window_start: int
+    window_end: int
+    layers: list[LatencySummary]
+
+class InferenceLatencySummaryExport(BaseExport):
+    export_value: InferenceLatencySummary
+
 # --- Export: SensorData ---
+class PackedValues(BaseModel):
+    """
+    Reading values packed as a base64 encoded array, see app.subscriber.export.encoding
+    """
+
+    encoding: str
+    dtype: str
+    shape: list[int]
+    data: str
+    scales: Optional[list[float]] = None
+
 class SensorReading(BaseModel):
     uuid: str = str(uuid.uuid4())
-    values: list[list[float]]
+    values: Optional[list[list[float]]] = None
+    packed_values: Optional[PackedValues] = None
+    # per-axis features of the reading, see app.subscriber.export.features; values then holds the
+    # reading averaged over blocks of downsample samples, if any
+    features: Optional[dict[str, list[float]]] = None
+    downsample: Optional[int] = None
+
+    @model_serializer(mode="wrap")
+    def _serialize_used_values(self, handler):
+        # only the fields actually carrying the reading are exported
+        data = handler(self)
+        for field in ("values", "packed_values", "features", "downsample"):
+            if data.get(field) is None:
+                data.pop(field, None)
+        return data
 
 
 class InferenceDescriptor(BaseModel):
@@ -44,5 +93,14 @@ class SensorData(BaseModel):
     low_battery: bool
     inference_descriptor: InferenceDescriptor
 
+class SensorDataPayload(BaseModel):
+    """
+    sensor-data export message as published by the sensor, validated in strict mode
+    """
+
+    reading: str
+    low_battery: bool
+    inference_descriptor: InferenceDescriptor
+
 class SensorDataExport(BaseExport):
     export_value: SensorData
\ No newline at end of file
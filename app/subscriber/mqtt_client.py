@@ -1,42 +1,140 @@
+import time
 import logging
 import paho.mqtt.client as mqtt
-from app.core.config import (
-    DEVICE_EXPORT_TOPIC,
-    DEVICE_RESPONSE_TOPIC,
+from app.subscriber.router import Route
+from app.subscriber.routes import topic_router
+from app.subscriber.dispatcher import Dispatcher, dispatcher
+from app.subscriber.utils import close_gateway_client
+from app.subscriber.export.batcher import export_batcher
+from app.subscriber.export.inference import inference_batcher
+from app.subscriber.dedup import dedup_index
+from app.subscriber.export.latency import start_latency_summaries, stop_latency_summaries
+from app.core.latency import inference_latency
+from app.subscriber.spool import export_spool, open_export_spool, close_export_spool
+from app.core.log import get_logger, setup_logging, logging_stats
+from app.core.metrics import (
+    metrics,
+    topic_type,
+    start_metrics_writer,
+    stop_metrics_writer,
+    STAGE_SECONDS,
+    MESSAGES_TOTAL,
+    ERRORS_TOTAL,
+    DROPPED_TOTAL,
 )
-from app.subscriber.export import export_handler
-from app.subscriber.response import response_handler
 
 
 logging.basicConfig(level=logging.INFO)
+log = get_logger(__name__)
+
+def shared_topic(topic: str, shared_group: str = None) -> str:
+    """
+    Returns the shared subscription ($share/<group>/<topic>) of topic, or topic itself if no group is given.
+    """
+    return f"$share/{shared_group}/{topic}" if shared_group else topic
+
+def handle_message(route: Route, params: dict, payload: bytes):
+    """
+    Handles a message of a route, recording its total time and its failures.
+    """
+    started_at = time.perf_counter()
+    try:
+        route.handle(params, payload)
+    except Exception:
+        metrics.inc(ERRORS_TOTAL, (route.label,))
+        raise
+    finally:
+        metrics.observe(STAGE_SECONDS, (route.label, "total"), time.perf_counter() - started_at)
+
+def count_dropped(func, args):
+    # Dispatcher.on_drop hook, args are the handle_message arguments
+    metrics.inc(DROPPED_TOTAL, (args[0].label,))
+
+def dispatch_message(topic: str, payload: bytes, target: Dispatcher = dispatcher):
+    match = topic_router.match(topic)
+    if match is None:
+        metrics.inc(MESSAGES_TOTAL, (topic_type(topic),))
+        log.info("message.unrouted", topic=topic)
+        return
+    route, params = match
+    metrics.inc(MESSAGES_TOTAL, (route.label,))
+    log.info("message.received", params.get("device_name"), topic=topic, bytes=len(payload))
+    target.submit(handle_message, route, params, payload, lane=route.concurrency, key=params.get("device_name"))
+
+def subscribe_routes(client, shared_group: str = None):
+    """
+    Subscribes a client to the topic filter of every route, at the QoS of the route.
+    """
+    for topic_filter, qos in topic_router.subscriptions():
+        client.subscribe(shared_topic(topic_filter, shared_group), qos=qos)
+
+dispatcher.on_drop = count_dropped
 
 # --- MQTT callback functions ---
 def on_connect(client, userdata, flags, rc):
     logging.info(f"[MQTT Subscriber] Connected to broker with result code {rc}")
-    
-    # subscribe to topics
-    client.subscribe(DEVICE_EXPORT_TOPIC, qos=0)
-    client.subscribe(DEVICE_RESPONSE_TOPIC, qos=1)
+
+    # subscribe to topics, userdata holds the shared subscription group if any
+    subscribe_routes(client, userdata)
 
 def on_message(client, userdata, msg):
-    logging.info(f"[MQTT Subscriber] Received message on topic {msg.topic}")
-    
-    if msg.topic.startswith(DEVICE_EXPORT_TOPIC[:-1]): # removes the wildcard
-        export_handler.handle(msg.topic, msg.payload)
-    elif msg.topic.startswith(DEVICE_RESPONSE_TOPIC[:-1]): # removes the wildcard
-        response_handler.handle(msg.topic, msg.payload)
-    else:
-        logging.info(f"[MQTT Subscriber] Unknown topic {msg.topic}")
+    dispatch_message(msg.topic, msg.payload)
 
 
-def launch_mqtt_client(mqtt_broker_host, mqtt_broker_port, mqtt_client_id):
-    logging.info("[MQTT Subscriber] Starting MQTT Subscriber")
+def create_mqtt_client(mqtt_client_id, shared_group=None, on_message=on_message):
     client = mqtt.Client(
         client_id=mqtt_client_id,
         protocol=mqtt.MQTTv311,
         clean_session=True,
+        userdata=shared_group,
     )
     client.on_connect = on_connect
     client.on_message = on_message
+    return client
+
+
+def start_subscriber(name: str = None):
+    """
+    Sets logging up, opens the export spool and starts writing metrics snapshots. name identifies the subscriber
+    process when several of them run side by side.
+    """
+    setup_logging()
+    open_export_spool(name)
+    metrics.register_collector("dispatcher", dispatcher.stats)
+    metrics.register_collector("logging", logging_stats)
+    if export_spool is not None:
+        metrics.register_collector("spool", export_spool.stats)
+    if inference_batcher is not None:
+        metrics.register_collector("inference", inference_batcher.stats)
+    if dedup_index is not None:
+        metrics.register_collector("dedup", dedup_index.stats)
+    metrics.register_section("inference_latency", inference_latency.snapshot_json)
+    start_metrics_writer(name or "subscriber")
+    start_latency_summaries()
+
+
+def shutdown_subscriber():
+    """
+    Drains the dispatcher, sends the exports waiting for a prediction, flushes pending export batches, closes the
+    export spool and the Gateway API client.
+    """
+    dispatcher.stop()
+    stop_latency_summaries()
+    if inference_batcher is not None:
+        inference_batcher.close()
+    export_batcher.close()
+    close_export_spool()
+    close_gateway_client()
+    stop_metrics_writer()
+
+
+def launch_mqtt_client(mqtt_broker_host, mqtt_broker_port, mqtt_client_id, shared_group=None):
+    logging.info("[MQTT Subscriber] Starting MQTT Subscriber")
+    client = create_mqtt_client(mqtt_client_id, shared_group)
     client.connect(mqtt_broker_host, mqtt_broker_port)
-    client.loop_forever()
+    start_subscriber()
+    dispatcher.start()
+    try:
+        client.loop_forever()
+    finally:
+        shutdown_subscriber()
@@ -1,8 +1,11 @@
-import json
-import logging
+from pydantic import BaseModel
+from pydantic_core import to_json
 
 from app.subscriber.response import schemas
-from app.subscriber.utils import post_to_gateway_api
+from app.core.metrics import StageTimer
+from app.subscriber.utils import post_to_gateway_api, JSON_HEADERS
+from app.subscriber.dedup import command_key, IDEMPOTENCY_HEADER
+from app.subscriber.router import TopicRouter, json_property_decoder, CONCURRENCY_CONTROL
 from app.core.config import (
     GATEWAY_NAME,
     SENSOR_INFERENCE_LAYER,
@@ -11,65 +14,86 @@ from app.core.config import (
 )
 
 class ResponseHandler:
-    def _handle_mqtt_sensor_config(self, sensor_name: str, payload: schemas.SensorConfig):
+    def _handle_mqtt_sensor_config(self, sensor_name: str, command_uuid: str, payload: schemas.SensorConfig):
         """
         This method handles the MQTT sensor-config response message.
         As any other response, this message is received when a GET command is sent to a sensor.
         """
 
-        metadata = schemas.Metadata(gateway_name=GATEWAY_NAME, sensor_name=sensor_name)
-        sensor_config = schemas.SensorConfigResponse(
+        metadata = schemas.Metadata.model_construct(sender=sensor_name, command_uuid=command_uuid)
+        sensor_config = schemas.SensorConfigResponse.model_construct(
             metadata=metadata,
             property_value=payload
         )
-        post_to_gateway_api("/store/sensor/response/get/sensor-config", sensor_config.model_dump())
+        return "/store/sensor/response/get/sensor-config", sensor_config
 
-    def _handle_mqtt_sensor_state(self, sensor_name: str, payload: schemas.SensorConfig):
+    def _handle_mqtt_sensor_state(self, sensor_name: str, command_uuid: str, payload: schemas.SensorState):
         """
         This method handles the MQTT sensor-state response message.
         As any other response, this message is received when a GET command is sent to a sensor.
         """
 
-        metadata = schemas.Metadata(gateway_name=GATEWAY_NAME, sensor_name=sensor_name)
-        sensor_state = schemas.SensorStateResponse(
+        metadata = schemas.Metadata.model_construct(sender=sensor_name, command_uuid=command_uuid)
+        sensor_state = schemas.SensorStateResponse.model_construct(
             metadata=metadata,
             property_value=payload
         )
-        post_to_gateway_api("/store/sensor/response/get/sensor-state", sensor_state.model_dump())
+        return "/store/sensor/response/get/sensor-state", sensor_state
 
-    def _handle_mqtt_inference_layer(self, sensor_name: str, payload: schemas.SensorConfig):
+    def _handle_mqtt_inference_layer(self, sensor_name: str, command_uuid: str, payload: schemas.InferenceLayer):
         """
         This method handles the MQTT inference-layer response message.
         As any other response, this message is received when a GET command is sent to a sensor.
         """
 
-        metadata = schemas.Metadata(gateway_name=GATEWAY_NAME, sensor_name=sensor_name)
-        inference_layer = schemas.InferenceLayerResponse(
+        metadata = schemas.Metadata.model_construct(sender=sensor_name, command_uuid=command_uuid)
+        inference_layer = schemas.InferenceLayerResponse.model_construct(
             metadata=metadata,
             property_value=payload
         )
-        post_to_gateway_api("/store/sensor/response/get/inference-layer", inference_layer.model_dump())
+        return "/store/sensor/response/get/inference-layer", inference_layer
 
-    def handle(self, topic: str, payload: str):
-        # response_topic: response/<device_name>/<property_name>/<method>/<uuid>
-        _, device_name, property_name, method, command_uuid = topic.split("/")
-        payload = json.loads(payload)
-        logging.info(f"[MQTT Subscriber] Response from {device_name} for {property_name}")
+    # --- Routes: handler(params, message, timer) -> [(endpoint, response)] ---
 
-        if method != "get":
-            logging.info(f"[MQTT Subscriber] Unknown method {method}")
-            return
+    def sensor_config(self, params: dict, payload: schemas.SensorConfig, timer: StageTimer) -> list[tuple[str, BaseModel]]:
+        return [self._handle_mqtt_sensor_config(params["device_name"], params["command_uuid"], payload)]
 
-        if property_name == "sensor-config":
-            sensor_config = schemas.SensorConfig(
-                sleep_interval_ms=payload["sensor-config"]["sleep_interval_ms"]
+    def sensor_state(self, params: dict, payload: schemas.SensorState, timer: StageTimer) -> list[tuple[str, BaseModel]]:
+        return [self._handle_mqtt_sensor_state(params["device_name"], params["command_uuid"], payload)]
+
+    def inference_layer(self, params: dict, payload: schemas.InferenceLayer, timer: StageTimer) -> list[tuple[str, BaseModel]]:
+        return [self._handle_mqtt_inference_layer(params["device_name"], params["command_uuid"], payload)]
+
+    def register_routes(self, router: TopicRouter, prefix: str):
+        """
+        Registers the routes of the responses to GET commands, response/<device_name>/<property_name>/get/<uuid>.
+        Responses redelivered by the broker are skipped by command UUID, see app.subscriber.dedup.
+        """
+        routes = (
+            ("sensor-config", self.sensor_config, lambda value: schemas.SensorConfig.model_validate(value, strict=True)),
+            ("sensor-state", self.sensor_state, schemas.SensorState),
+            ("inference-layer", self.inference_layer, schemas.InferenceLayer),
+        )
+        for property_name, handler, parse in routes:
+            router.add(
+                f"{prefix}/{{device_name}}/{property_name}/get/{{command_uuid}}",
+                handler,
+                decoder=json_property_decoder(property_name, parse),
+                sink=self,
+                qos=1,
+                concurrency=CONCURRENCY_CONTROL,
+                label="response",
+                dedup=command_key,
             )
-            self._handle_sensor_config_response(device_name, command_uuid, sensor_config)
-        elif property_name == "inference-layer":
-            inference_layer = schemas.InferenceLayer(payload["inference-layer"])
-            self._handle_inference_layer_response(device_name, command_uuid, inference_layer)
-        elif property_name == "sensor-state":
-            sensor_state = schemas.SensorState(payload["sensor-state"])
-            self._handle_sensor_state_response(device_name, command_uuid, sensor_state)
-
-response_handler = ResponseHandler()
\ No newline at end of file
+
+    # --- Sink ---
+
+    def send(self, endpoint: str, response: BaseModel):
+        content, headers, _ = self.serialize(endpoint, response)
+        post_to_gateway_api(endpoint, content=content, headers=headers)
+
+    def serialize(self, endpoint: str, response: BaseModel) -> tuple[bytes, dict, bool]:
+        # the command UUID identifies the response upstream as well
+        return to_json(response), {**JSON_HEADERS, IDEMPOTENCY_HEADER: response.metadata.command_uuid}, False
+
+response_handler = ResponseHandler()
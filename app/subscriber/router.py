@@ -0,0 +1,248 @@
+"""
+Topic router of the subscriber.
+
+Routes are registered with a topic template whose levels in braces are named parameters, e.g.
+export/{device_name}/sensor-data. The templates are compiled once into a matcher and a topic is split
+a single time. Routes with the same number of levels usually have their literal levels at the same
+positions (export/+/<export_name>, response/+/<property_name>/<method>/+): those are compiled into a
+table keyed by the literal levels, so a topic is matched with one tuple lookup and its parameters are
+picked by position. Other routes are matched by walking a tree of topic levels, literal levels taking
+precedence over parameters. Each route carries:
+
+    - a decoder turning the raw payload into the message given to the handler (validation included);
+    - a handler, called as handler(params, message, timer), returning the (endpoint, model) uploads
+      of the message;
+    - the sink its uploads are delivered through (ExportHandler, ResponseHandler);
+    - the QoS of its subscription and its concurrency class;
+    - optionally a dedup key function, key(params, payload), whose messages are only handled the first
+      time their key is seen, see app.subscriber.dedup.
+"""
+import json
+from operator import itemgetter
+from typing import Callable, Optional
+from pydantic import BaseModel
+from app.core.log import get_logger
+from app.core.metrics import metrics, StageTimer, DUPLICATES_TOTAL
+from app.subscriber.dedup import dedup_index
+
+log = get_logger(__name__)
+
+# --- Concurrency classes ---
+# bulk: high-volume messages (sensor-data), may be dropped when the subscriber is overloaded
+# control: low-volume messages that are never dropped
+CONCURRENCY_BULK = "bulk"
+CONCURRENCY_CONTROL = "control"
+CONCURRENCY_CLASSES = (CONCURRENCY_BULK, CONCURRENCY_CONTROL)
+
+
+def topic_prefix(topic_filter: str) -> str:
+    """
+    Returns the topic filter of a subscription without its multi-level wildcard, export/# -> export.
+    """
+    return topic_filter[:-2] if topic_filter.endswith("/#") else topic_filter
+
+
+def json_decoder(model: type[BaseModel]) -> Callable[[bytes], BaseModel]:
+    """
+    Returns a decoder parsing and validating a JSON payload in a single strict pass.
+    """
+    def decode(payload: bytes) -> BaseModel:
+        return model.model_validate_json(payload, strict=True)
+    return decode
+
+
+def json_property_decoder(property_name: str, parse: Callable) -> Callable:
+    """
+    Returns a decoder of {"<property_name>": value} JSON payloads, value being converted by parse.
+    """
+    def decode(payload: bytes):
+        return parse(json.loads(payload)[property_name])
+    return decode
+
+
+class Route:
+    __slots__ = ("template", "handler", "decoder", "sink", "qos", "concurrency", "label", "dedup", "params", "levels", "pick_params")
+
+    def __init__(self, template: str, handler: Callable, decoder: Callable, sink, qos: int, concurrency: str, label: str, dedup: Callable = None):
+        if concurrency not in CONCURRENCY_CLASSES:
+            raise ValueError(f"Unknown concurrency class {concurrency}, expected one of {CONCURRENCY_CLASSES}")
+        self.template = template
+        self.handler = handler
+        self.decoder = decoder
+        self.sink = sink
+        self.qos = qos
+        self.concurrency = concurrency
+        # metrics label of the messages of this route
+        self.label = label
+        # dedup key function, None if every copy of a message is handled
+        self.dedup = dedup if dedup_index is not None else None
+        self.levels = tuple(template.split("/"))
+        self.params = tuple(level[1:-1] for level in self.levels if _is_param(level))
+        self.pick_params = _params_picker(self.params, [i for i, level in enumerate(self.levels) if _is_param(level)])
+
+    @property
+    def topic_filter(self) -> str:
+        return "/".join("+" if _is_param(level) else level for level in self.levels)
+
+    @property
+    def droppable(self) -> bool:
+        return self.concurrency == CONCURRENCY_BULK
+
+    def build(self, params: dict, payload: bytes, timer: StageTimer = None) -> list[tuple[str, BaseModel]]:
+        """
+        Decodes a message of this route into its uploads. This is the CPU-bound part of handling a message, it does no I/O.
+        """
+        if self.dedup is not None and not dedup_index.first(self.dedup(params, payload)):
+            metrics.inc(DUPLICATES_TOTAL, (self.label,))
+            log.debug("message.duplicate", params.get("device_name"), route=self.template)
+            return []
+        timer = timer or metrics.stage_timer(self.label)
+        message = self.decoder(payload) if self.decoder is not None else payload
+        timer.lap("validate")
+        return self.handler(params, message, timer)
+
+    def handle(self, params: dict, payload: bytes):
+        for endpoint, model in self.build(params, payload):
+            self.sink.send(endpoint, model)
+
+    def __repr__(self) -> str:
+        return f"Route({self.template!r}, qos={self.qos}, concurrency={self.concurrency!r})"
+
+
+def _is_param(level: str) -> bool:
+    return level.startswith("{") and level.endswith("}")
+
+
+class _Node:
+    __slots__ = ("literals", "param", "route")
+
+    def __init__(self):
+        self.literals: dict[str, _Node] = {}
+        self.param: _Node = None
+        self.route: Route = None
+
+
+def _params_picker(names: tuple[str], positions: list[int]) -> Callable[[list[str]], dict]:
+    """
+    Returns a function building the parameters of a route from the levels of a topic.
+    """
+    if len(names) == 1:
+        name, position = names[0], positions[0]
+        return lambda levels: {name: levels[position]}
+    if len(names) == 2:
+        (name_0, name_1), (position_0, position_1) = names, positions
+        return lambda levels: {name_0: levels[position_0], name_1: levels[position_1]}
+    pairs = tuple(zip(names, positions))
+    return lambda levels: {name: levels[position] for name, position in pairs}
+
+
+def _literals_picker(positions: tuple[int]) -> Callable[[list[str]], tuple]:
+    """
+    Returns a function picking the levels at positions as a tuple.
+    """
+    if len(positions) == 1:
+        position = positions[0]
+        return lambda levels: (levels[position],)
+    if not positions:
+        return lambda levels: ()
+    return itemgetter(*positions)
+
+
+class TopicRouter:
+    def __init__(self):
+        self._routes: list[Route] = []
+        self._root = _Node()
+        # number of levels -> (literal levels picker, literal levels -> route)
+        self._tables: dict[int, tuple] = None
+
+    @property
+    def routes(self) -> list[Route]:
+        return list(self._routes)
+
+    def add(
+        self,
+        template: str,
+        handler: Callable,
+        decoder: Callable = None,
+        sink=None,
+        qos: int = 0,
+        concurrency: str = CONCURRENCY_CONTROL,
+        label: str = None,
+        dedup: Callable = None,
+    ) -> Route:
+        """
+        Registers a route and compiles its template into the matcher.
+        """
+        route = Route(template, handler, decoder, sink, qos, concurrency, label or template.split("/")[0], dedup)
+        node = self._root
+        for level in template.split("/"):
+            if _is_param(level):
+                if node.param is None:
+                    node.param = _Node()
+                node = node.param
+            else:
+                node = node.literals.setdefault(level, _Node())
+        if node.route is not None:
+            raise ValueError(f"Route {template} conflicts with {node.route.template}")
+        node.route = route
+        self._routes.append(route)
+        self._tables = None
+        return route
+
+    def compile(self):
+        """
+        Compiles the lookup tables of the routes, done on the first match after routes are added.
+        """
+        by_length: dict[int, list[Route]] = {}
+        for route in self._routes:
+            by_length.setdefault(len(route.levels), []).append(route)
+        tables = {}
+        for length, routes in by_length.items():
+            shapes = {tuple(i for i, level in enumerate(route.levels) if not _is_param(level)) for route in routes}
+            if len(shapes) != 1:
+                continue  # matched by walking the tree
+            literals = shapes.pop()
+            table = {tuple(route.levels[i] for i in literals): route for route in routes}
+            tables[length] = (_literals_picker(literals), table)
+        self._tables = tables
+
+    def match(self, topic: str) -> Optional[tuple[Route, dict]]:
+        """
+        Returns the route of a topic and its named parameters, or None if no route matches it.
+        """
+        if self._tables is None:
+            self.compile()
+        levels = topic.split("/")
+        # parameters match a single non-empty level, literal levels are never empty
+        if "" in levels:
+            return None
+        table = self._tables.get(len(levels))
+        if table is not None:
+            literals, routes = table
+            route = routes.get(literals(levels))
+        else:
+            route = self._match(self._root, levels, 0)
+        if route is None:
+            return None
+        return route, route.pick_params(levels)
+
+    def _match(self, node: _Node, levels: list[str], index: int) -> Optional[Route]:
+        if index == len(levels):
+            return node.route
+        literal = node.literals.get(levels[index])
+        if literal is not None:
+            route = self._match(literal, levels, index + 1)
+            if route is not None:
+                return route
+        if node.param is not None:
+            return self._match(node.param, levels, index + 1)
+        return None
+
+    def subscriptions(self) -> list[tuple[str, int]]:
+        """
+        Returns the (topic filter, QoS) subscriptions covering every route.
+        """
+        subscriptions = {}
+        for route in self._routes:
+            subscriptions[route.topic_filter] = max(route.qos, subscriptions.get(route.topic_filter, 0))
+        return list(subscriptions.items())
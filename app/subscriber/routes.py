@@ -0,0 +1,12 @@
+from app.subscriber.router import TopicRouter, topic_prefix
+from app.subscriber.export import export_handler
+from app.subscriber.response import response_handler
+from app.core.config import (
+    DEVICE_EXPORT_TOPIC,
+    DEVICE_RESPONSE_TOPIC,
+)
+
+# --- Init Topic Router ---
+topic_router = TopicRouter()
+export_handler.register_routes(topic_router, topic_prefix(DEVICE_EXPORT_TOPIC))
+response_handler.register_routes(topic_router, topic_prefix(DEVICE_RESPONSE_TOPIC))
@@ -1,5 +1,18 @@
 from app.subscriber import mqtt_client
+from app.subscriber.dispatcher import dispatcher
+from app.subscriber.mqtt_client import start_subscriber, shutdown_subscriber
+from app.core.config import MQTT_SUBSCRIBER_CLIENT_ID, SUBSCRIBER_ENGINE
 
 def run_subscriber_process(mqtt_broker_host, mqtt_broker_port):
+    if SUBSCRIBER_ENGINE == "asyncio":
+        from app.subscriber.aio import run_async_subscriber
+        run_async_subscriber(mqtt_broker_host, mqtt_broker_port, MQTT_SUBSCRIBER_CLIENT_ID)
+        return
+
     mqtt_client.connect(mqtt_broker_host, mqtt_broker_port)
-    mqtt_client.loop_forever()
+    start_subscriber()
+    dispatcher.start()
+    try:
+        mqtt_client.loop_forever()
+    finally:
+        shutdown_subscriber()
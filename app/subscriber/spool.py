@@ -0,0 +1,447 @@
+"""
+Durable on-disk spool for exports the Gateway API could not take.
+
+Exports are appended to segment files (<SPOOL_DIR>/<sequence>.seg) of at most SPOOL_SEGMENT_BYTES.
+Each record is a fixed header (metadata length, body length, creation timestamp) followed by a JSON
+metadata block (endpoint and headers) and the serialized request body. A replay thread sends the
+records to the Gateway API in the order they were written, at up to SPOOL_REPLAY_RATE records per
+second, and deletes each segment once it has been fully replayed. The replay position is kept in
+<SPOOL_DIR>/cursor so a restarted subscriber resumes where it left off.
+
+When an export fails, the Gateway API is considered down and every new export is deferred to the
+spool, behind the failed one, until the replay catches up. This keeps exports in order and bounds
+the memory held during an outage. When the spool grows past SPOOL_MAX_BYTES the oldest segments are
+discarded. Records that cannot be read back are logged and skipped, the replay never stops on them.
+"""
+import os
+import json
+import mmap
+import time
+import struct
+import logging
+import threading
+from app.subscriber.utils import post_to_gateway_api, GatewayAPIError
+from app.core.config import (
+    SPOOL_ENABLED,
+    SPOOL_DIR,
+    SPOOL_SEGMENT_BYTES,
+    SPOOL_MAX_BYTES,
+    SPOOL_REPLAY_RATE,
+    SPOOL_RETRY_INTERVAL,
+    SPOOL_MMAP,
+    SUBSCRIBER_STATS_INTERVAL,
+)
+
+logging.basicConfig(level=logging.INFO)
+
+# record header: metadata length, body length, creation timestamp
+RECORD_HEADER = struct.Struct(">IId")
+SEGMENT_SUFFIX = ".seg"
+CURSOR_FILE = "cursor"
+
+
+def is_permanent_failure(error: GatewayAPIError) -> bool:
+    """
+    Client errors other than timeouts and rate limits will not succeed on a later attempt.
+    """
+    if error.response is None:
+        return False
+    status_code = error.response.status_code
+    return 400 <= status_code < 500 and status_code not in (408, 429)
+
+
+class ExportSpool:
+    def __init__(
+        self,
+        directory: str,
+        segment_bytes: int,
+        max_bytes: int,
+        replay_rate: float,
+        retry_interval: float,
+        use_mmap: bool = True,
+    ):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.replay_rate = replay_rate
+        self.retry_interval = retry_interval
+        self.use_mmap = use_mmap
+
+        self._lock = threading.Lock()
+        self._has_records = threading.Event()
+        self._stopped = threading.Event()
+        self._thread: threading.Thread = None
+        self._opened = False
+
+        self._segments: list[int] = []
+        self._segment_sizes: dict[int, int] = {}
+        self._writer = None
+        self._writer_sequence = 0
+        self._reader = None
+        self._cursor = (0, 0)
+        self._pending_records = 0
+        self._healthy = True
+
+        # --- Stats ---
+        self._spooled = 0
+        self._replayed = 0
+        self._discarded = 0
+        self._oldest_timestamp: float = None
+
+    # --- Segments ---
+
+    def _segment_path(self, sequence: int) -> str:
+        return os.path.join(self.directory, f"{sequence:012d}{SEGMENT_SUFFIX}")
+
+    def _cursor_path(self) -> str:
+        return os.path.join(self.directory, CURSOR_FILE)
+
+    def open(self):
+        """
+        Loads the segments left by a previous run and starts the replay thread.
+        """
+        with self._lock:
+            if self._opened:
+                return
+            os.makedirs(self.directory, exist_ok=True)
+            self._segments = sorted(
+                int(name[:-len(SEGMENT_SUFFIX)])
+                for name in os.listdir(self.directory)
+                if name.endswith(SEGMENT_SUFFIX)
+            )
+            for sequence in self._segments:
+                self._segment_sizes[sequence] = self._recover_segment(sequence)
+
+            try:
+                with open(self._cursor_path()) as f:
+                    sequence, offset = json.load(f)
+                self._cursor = (sequence, offset)
+            except (OSError, ValueError):
+                self._cursor = (self._segments[0], 0) if self._segments else (0, 0)
+            if self._segments and self._cursor[0] < self._segments[0]:
+                self._cursor = (self._segments[0], 0)
+
+            self._pending_records = self._count_pending()
+            if self._pending_records:
+                self._healthy = False
+                self._has_records.set()
+                logging.info(f"[Spool] Recovered {self._pending_records} spooled exports from {self.directory}")
+            self._open_writer(self._segments[-1] if self._segments else 0)
+            self._opened = True
+
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._replay, name="spool-replay", daemon=True)
+        self._thread.start()
+
+    def _recover_segment(self, sequence: int) -> int:
+        """
+        Returns the size of the valid records of a segment, truncating a record left incomplete by a crash.
+        """
+        path = self._segment_path(sequence)
+        size = os.path.getsize(path)
+        offset = 0
+        with open(path, "rb") as f:
+            while offset + RECORD_HEADER.size <= size:
+                f.seek(offset)
+                meta_len, body_len, _ = RECORD_HEADER.unpack(f.read(RECORD_HEADER.size))
+                end = offset + RECORD_HEADER.size + meta_len + body_len
+                if end > size:
+                    break
+                offset = end
+        if offset != size:
+            logging.warning(f"[Spool] Truncating incomplete record at {path}:{offset}")
+            with open(path, "r+b") as f:
+                f.truncate(offset)
+        return offset
+
+    def _count_pending(self) -> int:
+        count = 0
+        for sequence in self._segments:
+            if sequence < self._cursor[0]:
+                continue
+            offset = self._cursor[1] if sequence == self._cursor[0] else 0
+            with open(self._segment_path(sequence), "rb") as f:
+                while offset < self._segment_sizes[sequence]:
+                    f.seek(offset)
+                    meta_len, body_len, created_at = RECORD_HEADER.unpack(f.read(RECORD_HEADER.size))
+                    if self._oldest_timestamp is None:
+                        self._oldest_timestamp = created_at
+                    offset += RECORD_HEADER.size + meta_len + body_len
+                    count += 1
+        return count
+
+    def _open_writer(self, sequence: int):
+        # must be called with self._lock held
+        if self._writer is not None:
+            self._writer.close()
+        if sequence not in self._segment_sizes:
+            self._segments.append(sequence)
+            self._segment_sizes[sequence] = 0
+        self._writer = open(self._segment_path(sequence), "ab")
+        self._writer_sequence = sequence
+
+    def _delete_segment(self, sequence: int):
+        # must be called with self._lock held
+        if self._reader is not None and self._reader[0] == sequence:
+            self._close_reader()
+        self._segments.remove(sequence)
+        self._segment_sizes.pop(sequence)
+        try:
+            os.remove(self._segment_path(sequence))
+        except FileNotFoundError:
+            pass
+
+    def _enforce_size_cap(self):
+        # must be called with self._lock held, never discards the segment being written
+        while sum(self._segment_sizes.values()) > self.max_bytes and len(self._segments) > 1:
+            sequence = self._segments[0]
+            if sequence < self._cursor[0]:
+                discarded = 0
+            else:
+                discarded = self._count_records(sequence, self._cursor[1] if sequence == self._cursor[0] else 0)
+            self._delete_segment(sequence)
+            if self._cursor[0] <= sequence:
+                self._cursor = (self._segments[0], 0)
+                self._oldest_timestamp = None
+            self._pending_records -= discarded
+            self._discarded += discarded
+            logging.warning(f"[Spool] Size cap of {self.max_bytes} bytes reached, discarded {discarded} spooled exports")
+
+    def _count_records(self, sequence: int, offset: int) -> int:
+        count = 0
+        with open(self._segment_path(sequence), "rb") as f:
+            while offset < self._segment_sizes[sequence]:
+                f.seek(offset)
+                meta_len, body_len, _ = RECORD_HEADER.unpack(f.read(RECORD_HEADER.size))
+                offset += RECORD_HEADER.size + meta_len + body_len
+                count += 1
+        return count
+
+    # --- Producer side ---
+
+    def should_defer(self) -> bool:
+        """
+        True while the Gateway API is considered down, new exports must then be appended to the spool.
+        """
+        return not self._healthy
+
+    def append(self, endpoint: str, content: bytes, headers: dict = None):
+        """
+        Appends a serialized export to the spool.
+        """
+        if not self._opened:
+            self.open()
+        meta = json.dumps({"endpoint": endpoint, "headers": headers or {}}).encode()
+        created_at = time.time()
+        record = RECORD_HEADER.pack(len(meta), len(content), created_at) + meta + content
+
+        with self._lock:
+            if self._segment_sizes[self._writer_sequence] + len(record) > self.segment_bytes \
+                    and self._segment_sizes[self._writer_sequence] > 0:
+                self._open_writer(self._writer_sequence + 1)
+            self._writer.write(record)
+            self._writer.flush()
+            self._segment_sizes[self._writer_sequence] += len(record)
+            self._pending_records += 1
+            self._spooled += 1
+            self._healthy = False
+            if self._oldest_timestamp is None:
+                self._oldest_timestamp = created_at
+            self._enforce_size_cap()
+        self._has_records.set()
+
+    def send(self, endpoint: str, content: bytes, headers: dict = None):
+        """
+        POSTs a serialized export to the Gateway API, spooling it if the Gateway API is down or the POST fails.
+        Permanent client errors are raised, they would fail again on replay.
+        """
+        if self.should_defer():
+            self.append(endpoint, content, headers)
+            return
+        try:
+            post_to_gateway_api(endpoint, content=content, headers=headers)
+        except GatewayAPIError as e:
+            if is_permanent_failure(e):
+                raise
+            logging.warning(f"[Spool] Spooling export to {endpoint}: {e}")
+            self.append(endpoint, content, headers)
+
+    # --- Replay ---
+
+    def _read_record(self, sequence: int, offset: int):
+        if self.use_mmap and sequence != self._writer_sequence:
+            # fully written segments are memory-mapped once and read without copying the whole file
+            if self._reader is None or self._reader[0] != sequence:
+                self._close_reader()
+                with open(self._segment_path(sequence), "rb") as f:
+                    self._reader = (sequence, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+            mm = self._reader[1]
+            meta_len, body_len, created_at = RECORD_HEADER.unpack_from(mm, offset)
+            start = offset + RECORD_HEADER.size
+            meta = mm[start:start + meta_len]
+            content = mm[start + meta_len:start + meta_len + body_len]
+        else:
+            with open(self._segment_path(sequence), "rb") as f:
+                f.seek(offset)
+                meta_len, body_len, created_at = RECORD_HEADER.unpack(f.read(RECORD_HEADER.size))
+                meta = f.read(meta_len)
+                content = f.read(body_len)
+        return meta, content, created_at, RECORD_HEADER.size + meta_len + body_len
+
+    def _close_reader(self):
+        if self._reader is not None:
+            self._reader[1].close()
+            self._reader = None
+
+    def _next_record(self):
+        """
+        Returns the record at the cursor, moving past fully replayed segments, or None if the spool is empty.
+        The record is read with the lock held, so the size cap cannot delete its segment in the meantime.
+        """
+        with self._lock:
+            while True:
+                sequence, offset = self._cursor
+                if sequence not in self._segment_sizes:
+                    if not self._segments:
+                        return None
+                    self._cursor = (self._segments[0], 0)
+                    continue
+                if offset < self._segment_sizes[sequence]:
+                    try:
+                        meta, content, created_at, size = self._read_record(sequence, offset)
+                        if offset + size > self._segment_sizes[sequence]:
+                            raise ValueError(f"record of {size} bytes runs past the end of the segment")
+                    except (OSError, ValueError, struct.error) as e:
+                        # a missing segment or a corrupt header leaves no way to find the next record
+                        logging.error(f"[Spool] Skipping unreadable records of {self._segment_path(sequence)} from offset {offset}: {e}")
+                        self._close_reader()
+                        self._cursor = (sequence, self._segment_sizes[sequence])
+                        continue
+                    try:
+                        meta = json.loads(meta)
+                        if not isinstance(meta, dict) or "endpoint" not in meta or "headers" not in meta:
+                            raise ValueError("no endpoint or headers")
+                        return (sequence, offset), (meta, content, created_at, size)
+                    except ValueError as e:
+                        logging.error(f"[Spool] Skipping spooled export with corrupt metadata at {self._segment_path(sequence)}:{offset}: {e}")
+                        self._cursor = (sequence, offset + size)
+                        self._pending_records -= 1
+                        self._discarded += 1
+                        continue
+                if sequence == self._writer_sequence:
+                    # everything was replayed, new exports can go straight to the Gateway API again
+                    self._healthy = True
+                    self._oldest_timestamp = None
+                    self._has_records.clear()
+                    self._save_cursor()
+                    return None
+                self._delete_segment(sequence)
+                self._cursor = (self._segments[0], 0)
+                self._save_cursor()
+
+    def _save_cursor(self):
+        tmp_path = self._cursor_path() + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(list(self._cursor), f)
+        os.replace(tmp_path, self._cursor_path())
+
+    def _replay(self):
+        interval = 1.0 / self.replay_rate if self.replay_rate > 0 else 0
+        last_report = time.monotonic()
+        while not self._stopped.is_set():
+            if time.monotonic() - last_report >= SUBSCRIBER_STATS_INTERVAL > 0:
+                last_report = time.monotonic()
+                if self._pending_records:
+                    logging.info(f"[Spool] Stats: {self.stats()}")
+
+            try:
+                self._replay_next(interval)
+            except Exception as e:
+                # the replay thread must outlive any failure, or exports would be spooled forever
+                logging.exception(f"[Spool] Replay failed, retrying in {self.retry_interval}s: {e}")
+                self._stopped.wait(self.retry_interval)
+
+    def _replay_next(self, interval: float):
+        if not self._has_records.wait(1):
+            return
+        record = self._next_record()
+        if record is None:
+            return
+        (sequence, offset), (meta, content, created_at, size) = record
+        self._oldest_timestamp = created_at
+
+        started_at = time.monotonic()
+        try:
+            post_to_gateway_api(meta["endpoint"], content=content, headers=meta["headers"])
+        except GatewayAPIError as e:
+            if not is_permanent_failure(e):
+                logging.warning(f"[Spool] Replay to {meta['endpoint']} failed, retrying in {self.retry_interval}s")
+                self._stopped.wait(self.retry_interval)
+                return
+            logging.error(f"[Spool] Dropping spooled export to {meta['endpoint']}: {e}")
+
+        with self._lock:
+            if self._cursor == (sequence, offset):
+                self._cursor = (sequence, offset + size)
+                self._pending_records -= 1
+                self._replayed += 1
+                if self._replayed % 100 == 0:
+                    self._save_cursor()
+        self._stopped.wait(max(0, interval - (time.monotonic() - started_at)))
+
+    # --- Lifecycle ---
+
+    def close(self):
+        if not self._opened:
+            return
+        self._stopped.set()
+        self._thread.join()
+        self._close_reader()
+        with self._lock:
+            self._save_cursor()
+            self._writer.close()
+            self._writer = None
+            self._opened = False
+
+    # --- Stats ---
+
+    def stats(self) -> dict:
+        with self._lock:
+            oldest = self._oldest_timestamp
+            return {
+                "size_bytes": sum(self._segment_sizes.values()),
+                "segments": len(self._segments),
+                "pending": self._pending_records,
+                "spooled": self._spooled,
+                "replayed": self._replayed,
+                "discarded": self._discarded,
+                "replay_lag_s": (time.time() - oldest) if oldest is not None and self._pending_records else 0.0,
+                "upstream_healthy": self._healthy,
+            }
+
+
+def open_export_spool(name: str = None):
+    """
+    Opens the export spool, if enabled. Processes running side by side must each use their own
+    spool, name selects a subdirectory of SPOOL_DIR for it.
+    """
+    if export_spool is None:
+        return
+    if name is not None:
+        export_spool.directory = os.path.join(SPOOL_DIR, name)
+    export_spool.open()
+
+
+def close_export_spool():
+    if export_spool is not None:
+        export_spool.close()
+
+
+export_spool = ExportSpool(
+    directory=SPOOL_DIR,
+    segment_bytes=SPOOL_SEGMENT_BYTES,
+    max_bytes=SPOOL_MAX_BYTES,
+    replay_rate=SPOOL_REPLAY_RATE,
+    retry_interval=SPOOL_RETRY_INTERVAL,
+    use_mmap=SPOOL_MMAP,
+) if SPOOL_ENABLED else None
@@ -0,0 +1,182 @@
+"""
+Multi-process subscriber.
+
+Runs N subscriber worker processes, each with its own MQTT client ID (<MQTT_SUBSCRIBER_CLIENT_ID>-<i>),
+and restarts any of them that exits. Messages are shared among the workers in one of two ways:
+
+    - shared: every worker subscribes to $share/<MQTT_SHARED_SUBSCRIPTION_GROUP>/<topic> and the broker
+      balances messages among them.
+    - local: for brokers without shared subscriptions. A receiver process holds the only subscription
+      and forwards each message to the worker owning its device (crc32(device_name) % N), so the
+      messages of a sensor always reach the same worker in the order they were received. Inside a
+      worker, messages of a device are handled by the same thread, keeping them in order.
+"""
+import sys
+import time
+import zlib
+import signal
+import logging
+import multiprocessing
+from app.core.log import setup_logging
+from app.core.config import (
+    MQTT_SUBSCRIBER_CLIENT_ID,
+    MQTT_SHARED_SUBSCRIPTION_GROUP,
+    SUBSCRIBER_QUEUE_SIZE,
+    SUBSCRIBER_RESTART_BACKOFF,
+    SUBSCRIBER_WORKERS,
+    SUBSCRIBER_ENGINE,
+)
+
+logging.basicConfig(level=logging.INFO)
+
+SHARDING_SHARED = "shared"
+SHARDING_LOCAL = "local"
+SHARDINGS = (SHARDING_SHARED, SHARDING_LOCAL)
+
+
+def shard_of(topic: str, shards: int) -> int:
+    """
+    Returns the shard of a device topic (<prefix>/<device_name>/...), stable across processes and restarts.
+    """
+    parts = topic.split("/", 2)
+    device_name = parts[1] if len(parts) > 1 else topic
+    return zlib.crc32(device_name.encode()) % shards
+
+
+# --- Worker process targets ---
+
+def _init_worker_signals():
+    # the supervisor handles SIGINT, SIGTERM exits the worker through its cleanup path
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+
+
+def _run_shared_worker(mqtt_broker_host, mqtt_broker_port, mqtt_client_id, name):
+    _init_worker_signals()
+    # each worker replays its own spool and writes its own metrics, a restarted worker picks up where it left off
+    if SUBSCRIBER_ENGINE == "asyncio":
+        from app.subscriber.aio import run_async_subscriber
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        run_async_subscriber(mqtt_broker_host, mqtt_broker_port, mqtt_client_id, MQTT_SHARED_SUBSCRIPTION_GROUP, name)
+        return
+    from app.subscriber.mqtt_client import start_subscriber, launch_mqtt_client
+    start_subscriber(name)
+    launch_mqtt_client(mqtt_broker_host, mqtt_broker_port, mqtt_client_id, MQTT_SHARED_SUBSCRIPTION_GROUP)
+
+
+def _run_local_receiver(mqtt_broker_host, mqtt_broker_port, mqtt_client_id, queues):
+    _init_worker_signals()
+    setup_logging()
+    from app.subscriber.mqtt_client import create_mqtt_client
+
+    def on_message(client, userdata, msg):
+        # blocks the network loop while the worker queue is full
+        queues[shard_of(msg.topic, len(queues))].put((msg.topic, msg.payload))
+
+    logging.info("[MQTT Subscriber] Starting MQTT Subscriber fan-out receiver")
+    client = create_mqtt_client(mqtt_client_id, on_message=on_message)
+    client.connect(mqtt_broker_host, mqtt_broker_port)
+    client.loop_forever()
+
+
+def _run_local_worker(queue, name):
+    _init_worker_signals()
+    from app.subscriber.dispatcher import Dispatcher
+    from app.subscriber.mqtt_client import dispatch_message, start_subscriber, shutdown_subscriber
+    start_subscriber(name)
+
+    # one single-threaded dispatcher per device shard keeps the messages of a device in order
+    lanes = [
+        Dispatcher(workers=1, queue_size=SUBSCRIBER_QUEUE_SIZE, overflow_policy="block", control_workers=0)
+        for _ in range(max(1, SUBSCRIBER_WORKERS))
+    ]
+    for lane in lanes:
+        lane.start()
+    try:
+        while True:
+            item = queue.get()
+            if item is None:
+                break
+            topic, payload = item
+            dispatch_message(topic, payload, lanes[shard_of(topic, len(lanes))])
+    finally:
+        for lane in lanes:
+            lane.stop()
+        shutdown_subscriber()
+
+
+# --- Supervisor ---
+
+class SubscriberSupervisor:
+    def __init__(self, mqtt_broker_host, mqtt_broker_port, workers: int, sharding: str):
+        if sharding not in SHARDINGS:
+            raise ValueError(f"Unknown sharding {sharding}, expected one of {SHARDINGS}")
+        self.workers = max(1, workers)
+        self.sharding = sharding
+        self._stopping = False
+        self._processes: dict[str, multiprocessing.Process] = {}
+        self._targets: dict[str, tuple] = {}
+
+        if sharding == SHARDING_SHARED:
+            for i in range(self.workers):
+                self._targets[f"subscriber-{i}"] = (
+                    _run_shared_worker,
+                    (mqtt_broker_host, mqtt_broker_port, f"{MQTT_SUBSCRIBER_CLIENT_ID}-{i}", f"subscriber-{i}"),
+                )
+        else:
+            # queues outlive worker restarts, so messages queued for a crashed worker are not lost
+            self._queues = [multiprocessing.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE) for _ in range(self.workers)]
+            for i, queue in enumerate(self._queues):
+                self._targets[f"subscriber-{i}"] = (_run_local_worker, (queue, f"subscriber-{i}"))
+            self._targets["subscriber-receiver"] = (
+                _run_local_receiver,
+                (mqtt_broker_host, mqtt_broker_port, MQTT_SUBSCRIBER_CLIENT_ID, self._queues),
+            )
+
+    def _start(self, name: str):
+        target, args = self._targets[name]
+        process = multiprocessing.Process(target=target, args=args, name=name)
+        process.start()
+        self._processes[name] = process
+        logging.info(f"[MQTT Subscriber] Started {name} (pid {process.pid})")
+
+    def _stop(self, *_):
+        self._stopping = True
+
+    def run(self):
+        """
+        Starts every worker and restarts the ones that exit until SIGTERM/SIGINT is received.
+        """
+        setup_logging()
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        for name in self._targets:
+            self._start(name)
+
+        while not self._stopping:
+            time.sleep(SUBSCRIBER_RESTART_BACKOFF)
+            for name, process in list(self._processes.items()):
+                if not process.is_alive() and not self._stopping:
+                    logging.warning(f"[MQTT Subscriber] {name} exited with code {process.exitcode}, restarting")
+                    self._start(name)
+
+        self.shutdown()
+
+    def shutdown(self):
+        logging.info("[MQTT Subscriber] Stopping subscriber workers")
+        receiver = self._processes.pop("subscriber-receiver", None)
+        if receiver is not None:
+            receiver.terminate()
+            receiver.join()
+            # let the local workers drain their queues before exiting
+            for queue in self._queues:
+                queue.put(None)
+        else:
+            for process in self._processes.values():
+                process.terminate()
+        for process in self._processes.values():
+            process.join()
+
+
+def run_sharded_subscriber(mqtt_broker_host, mqtt_broker_port, workers: int, sharding: str):
+    SubscriberSupervisor(mqtt_broker_host, mqtt_broker_port, workers, sharding).run()
@@ -1,5 +1,184 @@
+import time
+import asyncio
+import logging
+import threading
 import httpx
-from app.core.config import GATEWAY_API_URL
+from pydantic_core import to_json
+from app.core.log import get_logger
+from app.core.metrics import metrics, UPSTREAM_SECONDS, UPSTREAM_ERRORS_TOTAL
+from app.core.config import (
+    GATEWAY_API_URL,
+    GATEWAY_API_HTTP2,
+    GATEWAY_API_MAX_CONNECTIONS,
+    GATEWAY_API_MAX_KEEPALIVE_CONNECTIONS,
+    GATEWAY_API_KEEPALIVE_EXPIRY,
+    GATEWAY_API_TIMEOUT,
+    GATEWAY_API_CONNECT_TIMEOUT,
+    GATEWAY_API_RETRIES,
+    GATEWAY_API_RETRY_BACKOFF,
+)
 
-def post_to_gateway_api(endpoint: str, json_data: dict):
-    httpx.post(f"{GATEWAY_API_URL}{endpoint}", json=json_data)
\ No newline at end of file
+log = get_logger(__name__)
+
+JSON_HEADERS = {"Content-Type": "application/json"}
+
+# status codes worth retrying, any other non-2xx response is surfaced right away
+RETRY_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+
+class GatewayAPIError(Exception):
+    """
+    Raised when the Gateway API could not be reached or answered with a non-2xx status code.
+    """
+
+    def __init__(self, message: str, response: httpx.Response = None):
+        super().__init__(message)
+        self.response = response
+
+
+_client: httpx.Client = None
+_client_lock = threading.Lock()
+
+
+def _gateway_client_options() -> dict:
+    http2 = GATEWAY_API_HTTP2
+    if http2:
+        try:
+            import h2  # noqa: F401
+        except ImportError:
+            logging.warning("[Gateway API] HTTP/2 requested but h2 is not installed, using HTTP/1.1")
+            http2 = False
+
+    return dict(
+        http2=http2,
+        limits=httpx.Limits(
+            max_connections=GATEWAY_API_MAX_CONNECTIONS,
+            max_keepalive_connections=GATEWAY_API_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=GATEWAY_API_KEEPALIVE_EXPIRY,
+        ),
+        timeout=httpx.Timeout(GATEWAY_API_TIMEOUT, connect=GATEWAY_API_CONNECT_TIMEOUT),
+    )
+
+
+def create_async_gateway_client() -> httpx.AsyncClient:
+    """
+    Returns a new asyncio Gateway API client with the same pool, timeout and HTTP/2 settings as the threaded one.
+    """
+    return httpx.AsyncClient(**_gateway_client_options())
+
+
+def get_gateway_client() -> httpx.Client:
+    """
+    Returns the process-wide Gateway API client, creating it on first use.
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = httpx.Client(**_gateway_client_options())
+    return _client
+
+
+def close_gateway_client():
+    """
+    Closes the process-wide Gateway API client and its pooled connections.
+    """
+    global _client
+    with _client_lock:
+        if _client is not None:
+            _client.close()
+            _client = None
+
+
+def post_to_gateway_api(
+    endpoint: str,
+    json_data: dict = None,
+    content: bytes = None,
+    headers: dict = None,
+) -> httpx.Response:
+    """
+    POSTs json_data, or an already serialized content body, to the Gateway API endpoint through the pooled client.
+    Transport errors and retryable status codes are retried with exponential backoff,
+    a GatewayAPIError is raised once the retries are exhausted or on any other non-2xx response.
+    """
+    url = f"{GATEWAY_API_URL}{endpoint}"
+    client = get_gateway_client()
+
+    started_at = time.perf_counter()
+    try:
+        for attempt in range(GATEWAY_API_RETRIES + 1):
+            try:
+                response = client.post(url, json=json_data, content=content, headers=headers)
+            except httpx.TransportError as e:
+                _check_attempt(url, attempt, error=e)
+            else:
+                if _check_attempt(url, attempt, response=response):
+                    return response
+            time.sleep(_retry_delay(attempt))
+    except GatewayAPIError:
+        metrics.inc(UPSTREAM_ERRORS_TOTAL, (endpoint,))
+        raise
+    finally:
+        metrics.observe(UPSTREAM_SECONDS, (endpoint,), time.perf_counter() - started_at)
+
+
+async def async_post_to_gateway_api(
+    client: httpx.AsyncClient,
+    endpoint: str,
+    content: bytes,
+    headers: dict = None,
+) -> httpx.Response:
+    """
+    Asyncio counterpart of post_to_gateway_api, with the same retry policy.
+    """
+    url = f"{GATEWAY_API_URL}{endpoint}"
+
+    started_at = time.perf_counter()
+    try:
+        for attempt in range(GATEWAY_API_RETRIES + 1):
+            try:
+                response = await client.post(url, content=content, headers=headers)
+            except httpx.TransportError as e:
+                _check_attempt(url, attempt, error=e)
+            else:
+                if _check_attempt(url, attempt, response=response):
+                    return response
+            await asyncio.sleep(_retry_delay(attempt))
+    except GatewayAPIError:
+        metrics.inc(UPSTREAM_ERRORS_TOTAL, (endpoint,))
+        raise
+    finally:
+        metrics.observe(UPSTREAM_SECONDS, (endpoint,), time.perf_counter() - started_at)
+
+
+def _retry_delay(attempt: int) -> float:
+    return GATEWAY_API_RETRY_BACKOFF * (2 ** attempt)
+
+
+def _check_attempt(url: str, attempt: int, response: httpx.Response = None, error: Exception = None) -> bool:
+    """
+    Returns True if the attempt succeeded and False if it should be retried,
+    raises GatewayAPIError if it failed for good.
+    """
+    last_attempt = attempt == GATEWAY_API_RETRIES
+    if error is not None:
+        if last_attempt:
+            raise GatewayAPIError(f"POST {url} failed: {error!r}") from error
+        log.warning("gateway_api.retry", url=url, error=repr(error))
+        return False
+
+    if response.is_success:
+        return True
+    if last_attempt or response.status_code not in RETRY_STATUS_CODES:
+        log.error("gateway_api.failed", url=url, status=response.status_code, body=response.text)
+        raise GatewayAPIError(f"POST {url} returned {response.status_code}", response)
+    log.warning("gateway_api.retry", url=url, status=response.status_code)
+    return False
+
+
+def post_json_to_gateway_api(endpoint: str, data) -> httpx.Response:
+    """
+    POSTs data, a pydantic model or a dict/list that may contain pydantic models, to the Gateway API
+    endpoint. The body is serialized straight into JSON bytes in a single pass.
+    """
+    return post_to_gateway_api(endpoint, content=to_json(data), headers=JSON_HEADERS)
@@ -0,0 +1,81 @@
+"""
+Microbenchmark of the sensor-data message codecs.
+
+Compares, on synthetic readings (see benchmarks.bench_ingest.make_reading), the size on the wire and the
+per-message decode cost of the JSON sensor-data messages and of the binary sensor-data-bin messages with
+each reading codec. Decoding covers validating the message and restoring the reading words; parsing and
+converting the words, the same for every codec, are excluded. The preset dictionary is built from
+readings other than the measured ones, --write-dictionary saves it for SENSOR_ZLIB_DICTIONARY.
+
+Usage: python -m benchmarks.bench_codecs [--readings N] [--write-dictionary FILE]
+"""
+import zlib
+import base64
+import timeit
+import argparse
+
+import numpy as np
+
+from app.subscriber.export import schemas
+from app.subscriber.export.codecs import create_codec_registry, build_zlib_dictionary, encode_binary_payload, decode_binary_payload
+from app.subscriber.router import json_decoder
+from benchmarks.bench_ingest import make_reading, sensor_data_payload
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--readings", type=int, default=200, help="measured readings")
+    parser.add_argument("--training-readings", type=int, default=200, help="readings the preset dictionary is built from")
+    parser.add_argument("--dictionary-size", type=int, default=4096, help="size of the preset dictionary in bytes")
+    parser.add_argument("--number", type=int, default=5, help="passes over the readings per measurement")
+    parser.add_argument("--write-dictionary", help="file receiving the preset dictionary")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(1)
+    training = [make_reading(rng) for _ in range(args.training_readings)]
+    readings = [make_reading(rng) for _ in range(args.readings)]
+    zdict = build_zlib_dictionary(training, args.dictionary_size)
+    if args.write_dictionary:
+        with open(args.write_dictionary, "wb") as f:
+            f.write(zdict)
+    registry = create_codec_registry(zdict)
+
+    # --- JSON messages ---
+    decode_json = json_decoder(schemas.SensorDataPayload)
+    json_payloads = [
+        sensor_data_payload(base64.b64encode(zlib.compress(raw)).decode()) for raw in readings
+    ]
+
+    def run_json():
+        for payload in json_payloads:
+            zlib.decompress(base64.b64decode(decode_json(payload).reading))
+
+    formats = [("json", json_payloads, run_json)]
+
+    # --- Binary messages ---
+    for name in registry.names():
+        codec = registry.get(registry.by_name(name).codec_id)
+        payloads = [
+            encode_binary_payload(raw, codec, low_battery=False, inference_layer=0, send_timestamp=1_700_000_000_000, prediction=1)
+            for raw in readings
+        ]
+        assert all(codec.decode(decode_binary_payload(p, registry).reading) == raw for p, raw in zip(payloads, readings))
+
+        def run_binary(payloads=payloads):
+            for payload in payloads:
+                frame = decode_binary_payload(payload, registry)
+                frame.codec.decode(frame.reading)
+
+        formats.append((f"bin/{name}", payloads, run_binary))
+
+    print(f"{'format':>20} {'bytes/msg':>10} {'vs json':>8} {'decode us/msg':>14}")
+    json_size = None
+    for name, payloads, run in formats:
+        size = sum(len(p) for p in payloads) / len(payloads)
+        json_size = json_size or size
+        best = min(timeit.repeat(run, number=args.number, repeat=5)) / (args.number * len(payloads)) * 1e6
+        print(f"{name:>20} {size:10.0f} {size / json_size:7.2f}x {best:14.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+"""
+Microbenchmark of gateway-layer inference.
+
+Builds a random numpy-mlp model (see app.subscriber.export.inference.NumpyMLP) and measures the
+per-reading cost of predicting batches of synthetic readings of increasing size, showing what batching
+readings across sensors saves over one model call per reading. --write-model saves the model for
+INFERENCE_MODEL_PATH.
+
+Usage: python -m benchmarks.bench_inference [--hidden 64,32] [--classes 4] [--write-model FILE]
+"""
+import timeit
+import argparse
+
+import numpy as np
+
+from app.subscriber.export.decoder import SEQUENCE_LENGTH, SAMPLE_SIZE, parse_reading, convert_reading
+from app.subscriber.export.inference import NumpyMLP
+from benchmarks.bench_ingest import make_reading
+
+
+def random_model(hidden: list[int], classes: int, rng: np.random.Generator) -> NumpyMLP:
+    sizes = [SEQUENCE_LENGTH * SAMPLE_SIZE, *hidden, classes]
+    weights = [rng.normal(0, 1 / np.sqrt(n_in), (n_in, n_out)) for n_in, n_out in zip(sizes, sizes[1:])]
+    biases = [np.zeros(n_out) for n_out in sizes[1:]]
+    return NumpyMLP(weights, biases, input_std=np.tile([9.81] * 3 + [1.0] * (SAMPLE_SIZE - 3), SEQUENCE_LENGTH))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--hidden", default="64,32", help="sizes of the hidden layers")
+    parser.add_argument("--classes", type=int, default=4, help="outputs of the model")
+    parser.add_argument("--batch-sizes", default="1,4,16,64,256", help="batch sizes measured")
+    parser.add_argument("--readings", type=int, default=256, help="readings predicted per measurement")
+    parser.add_argument("--write-model", help="file receiving the model (.npz)")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    model = random_model([int(size) for size in args.hidden.split(",") if size], args.classes, rng)
+    if args.write_model:
+        model.save(args.write_model)
+    readings = np.stack([convert_reading(parse_reading(make_reading(rng))) for _ in range(args.readings)])
+
+    print(f"{'batch':>6} {'us/reading':>11} {'speedup':>8}")
+    baseline = None
+    for batch_size in (int(size) for size in args.batch_sizes.split(",")):
+        batches = [readings[i:i + batch_size] for i in range(0, len(readings), batch_size)]
+
+        def run():
+            for batch in batches:
+                model.predict(batch)
+
+        per_reading = min(timeit.repeat(run, number=3, repeat=5)) / (3 * len(readings)) * 1e6
+        baseline = baseline or per_reading
+        print(f"{batch_size:>6} {per_reading:11.1f} {baseline / per_reading:7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,484 @@
+"""
+End-to-end ingest benchmark.
+
+Runs entirely on localhost: an MQTT broker (the benchmarks.broker stand-in, the bundled
+mosquitto/config with --mosquitto, or an existing broker with --broker), a stand-in Gateway API that
+records when each export arrives, the real subscriber (run as the service runs it, in its own process
+with the configuration of this environment) and N simulated sensors publishing
+export/<device>/sensor-data messages with zlib-compressed, base64-encoded SEQUENCE_LENGTH x SAMPLE_SIZE
+int16 readings. With --codec <reading codec>, binary export/<device>/sensor-data-bin messages are
+published instead, see app.subscriber.export.codecs.
+
+After a warm-up, messages are published for --duration seconds at --rate messages per second per
+sensor. End-to-end latency is measured from the send_timestamp of the inference descriptor to the
+arrival of the export at the stand-in Gateway API. Subscriber CPU and RSS are sampled from /proc,
+summed over the subscriber process and its children. Results are written as JSON.
+
+Usage: python -m benchmarks.bench_ingest [--sensors N] [--rate R] [--duration S] [--output FILE]
+"""
+import os
+import sys
+import json
+import gzip
+import time
+import zlib
+import base64
+import shutil
+import signal
+import socket
+import argparse
+import threading
+import subprocess
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import numpy as np
+import paho.mqtt.client as mqtt
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover - msgpack is optional
+    msgpack = None
+
+from app.core.config import SEQUENCE_LENGTH, SAMPLE_SIZE
+from app.subscriber.export.codecs import reading_codecs, binary_header
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MOSQUITTO_CONFIG = os.path.join(ROOT_DIR, "mosquitto", "config", "mosquitto.conf")
+MOSQUITTO_PORT = 1883
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+SUBSCRIBER_SCRIPT = """
+import sys
+from app.subscriber import mqtt_client
+from app.subscriber.run import run_subscriber_process
+from app.subscriber.supervisor import run_sharded_subscriber
+host, port, workers, sharding = sys.argv[1], int(sys.argv[2]), int(sys.argv[3]), sys.argv[4]
+try:
+    if workers > 1:
+        run_sharded_subscriber(host, port, workers, sharding)
+    else:
+        run_subscriber_process(host, port)
+except KeyboardInterrupt:
+    pass
+"""
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(port: int, timeout: float = 10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.5).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"Nothing listening on port {port} after {timeout}s")
+
+
+def percentile(sorted_values: list[float], q: float) -> float:
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(q / 100 * len(sorted_values)))]
+
+
+# --- Synthetic sensors ---
+
+def make_reading(rng: np.random.Generator) -> bytes:
+    """
+    Returns the big-endian int16 words of a reading of a sensor at rest with some motion:
+    accelerometer axes around 1 g on z (8 g range, 4096 counts per g), gyroscope axes around 0.
+    """
+    samples = np.arange(SEQUENCE_LENGTH)[:, None]
+    phase = rng.uniform(0, 2 * np.pi, SAMPLE_SIZE)
+    reading = np.zeros((SEQUENCE_LENGTH, SAMPLE_SIZE))
+    reading += 400 * np.sin(2 * np.pi * samples / rng.uniform(20, 120) + phase)
+    reading += rng.normal(0, 60, (SEQUENCE_LENGTH, SAMPLE_SIZE))
+    reading[:, min(2, SAMPLE_SIZE - 1)] += 4096
+    return np.clip(reading, -32768, 32767).astype(">i2").tobytes()
+
+
+def sensor_data_payload(reading: str, inference_layer: int = 0) -> bytes:
+    send_timestamp = time.time_ns() // 1_000_000
+    # sensors relying on gateway or cloud inference send no prediction
+    prediction = ',"prediction":1' if inference_layer == 0 else ""
+    return (
+        '{"reading":"' + reading + '","low_battery":false,"inference_descriptor":'
+        '{"inference_layer":' + str(inference_layer) + ',"send_timestamp":' + str(send_timestamp) + prediction + '}}'
+    ).encode()
+
+
+def payload_factory(codec: str, inference_layer: int = 0):
+    """
+    Returns the export name of the messages of a codec (json or a reading codec) and a function turning
+    a reading into a function building a message, the reading is only encoded once.
+    """
+    if codec == "json":
+        def make_json_payload(raw: bytes):
+            reading = base64.b64encode(zlib.compress(raw)).decode()
+            return lambda: sensor_data_payload(reading, inference_layer)
+        return "sensor-data", make_json_payload
+
+    reading_codec = reading_codecs.by_name(codec)
+
+    def make_binary_payload(raw: bytes):
+        reading = reading_codec.encode(raw)
+        return lambda: binary_header(
+            reading_codec, low_battery=False, inference_layer=inference_layer,
+            send_timestamp=time.time_ns() // 1_000_000, prediction=1 if inference_layer == 0 else None,
+        ) + reading
+    return "sensor-data-bin", make_binary_payload
+
+
+class SensorFleet:
+    """
+    Publishes sensor-data messages for sensors sensor_<i> over a few MQTT connections, each paced
+    to its share of the total rate.
+    """
+
+    def __init__(self, host: str, port: int, sensors: int, rate: float, connections: int, readings: int, qos: int, codec: str = "json", inference_layer: int = 0):
+        self.host = host
+        self.port = port
+        self.sensors = sensors
+        self.rate = rate
+        self.connections = max(1, min(connections, sensors))
+        self.qos = qos
+        rng = np.random.default_rng(0)
+        self.export_name, make_payload = payload_factory(codec, inference_layer)
+        self.payloads = [make_payload(make_reading(rng)) for _ in range(max(1, readings))]
+        self.sent = [0] * self.connections
+        self.late = [0.0] * self.connections
+        self._stopped = threading.Event()
+        self._threads = []
+
+    def _publish(self, index: int):
+        # no callbacks are used, the callback API version only silences the paho 2.x deprecation warning
+        options = {"callback_api_version": mqtt.CallbackAPIVersion.VERSION2} if hasattr(mqtt, "CallbackAPIVersion") else {}
+        client = mqtt.Client(client_id=f"bench-sensors-{index}", protocol=mqtt.MQTTv311, clean_session=True, **options)
+        client.connect(self.host, self.port)
+        client.loop_start()
+        devices = [f"sensor_{i}" for i in range(index, self.sensors, self.connections)]
+        interval = 1.0 / (self.rate * len(devices))
+        next_at = time.monotonic()
+        i = 0
+        while not self._stopped.is_set():
+            delay = next_at - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                self.late[index] = max(self.late[index], -delay)
+            device = devices[i % len(devices)]
+            payload = self.payloads[i % len(self.payloads)]()
+            client.publish(f"export/{device}/{self.export_name}", payload, qos=self.qos)
+            self.sent[index] += 1
+            i += 1
+            next_at += interval
+        client.loop_stop()
+        client.disconnect()
+
+    def start(self):
+        for index in range(self.connections):
+            thread = threading.Thread(target=self._publish, args=(index,), daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        self._stopped.set()
+        for thread in self._threads:
+            thread.join()
+
+    def total_sent(self) -> int:
+        return sum(self.sent)
+
+
+# --- Stand-in Gateway API ---
+
+class GatewayStandIn:
+    """
+    Accepts every export (single or batched, JSON, msgpack or gzip) and records the
+    (arrival time, send_timestamp) of each sensor-data export.
+    """
+
+    def __init__(self):
+        self.arrivals: list[tuple[float, int]] = []
+        self.requests = 0
+        gateway = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                arrived_at = time.time()
+                if self.headers.get("Content-Encoding") == "gzip":
+                    body = gzip.decompress(body)
+                if self.headers.get("Content-Type") == "application/msgpack" and msgpack is not None:
+                    data = msgpack.unpackb(body)
+                else:
+                    data = json.loads(body)
+                exports = data["exports"] if self.path.endswith("/batch") else [data]
+                for export in exports:
+                    descriptor = export.get("export_value", {}).get("inference_descriptor")
+                    if descriptor and descriptor.get("send_timestamp") is not None:
+                        gateway.arrivals.append((arrived_at, descriptor["send_timestamp"]))
+                gateway.requests += 1
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", "2")
+                self.end_headers()
+                self.wfile.write(b"{}")
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_port
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+# --- Resource usage ---
+
+def process_tree(pid: int) -> list[int]:
+    children: dict[int, list[int]] = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+    tree, stack = [], [pid]
+    while stack:
+        current = stack.pop()
+        tree.append(current)
+        stack.extend(children.get(current, []))
+    return tree
+
+
+def tree_usage(pid: int) -> tuple[float, int]:
+    """
+    Returns the CPU seconds and the resident memory in bytes of a process and its children.
+    """
+    cpu_seconds, rss = 0.0, 0
+    for member in process_tree(pid):
+        try:
+            with open(f"/proc/{member}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            with open(f"/proc/{member}/statm") as f:
+                rss += int(f.read().split()[1]) * PAGE_SIZE
+        except (OSError, IndexError, ValueError):
+            continue
+        cpu_seconds += (int(fields[11]) + int(fields[12])) / CLOCK_TICKS  # utime + stime
+    return cpu_seconds, rss
+
+
+class UsageSampler:
+    def __init__(self, pid: int, interval: float = 0.5):
+        self.pid = pid
+        self.interval = interval
+        self.rss_samples: list[int] = []
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.rss_samples.append(tree_usage(self.pid)[1])
+
+    def start(self):
+        self.cpu_start, _ = tree_usage(self.pid)
+        self.started_at = time.monotonic()
+        self._thread.start()
+
+    def stop(self) -> dict:
+        self._stopped.set()
+        self._thread.join()
+        cpu_end, rss = tree_usage(self.pid)
+        elapsed = time.monotonic() - self.started_at
+        samples = self.rss_samples or [rss]
+        return {
+            "cpu_percent": (cpu_end - self.cpu_start) / elapsed * 100,
+            "rss_mb_avg": sum(samples) / len(samples) / 2**20,
+            "rss_mb_max": max(samples) / 2**20,
+        }
+
+
+# --- Benchmark ---
+
+def start_broker(args) -> tuple[str, int, subprocess.Popen]:
+    if args.broker:
+        host, _, port = args.broker.partition(":")
+        return host, int(port or 1883), None
+    if args.mosquitto:
+        mosquitto = shutil.which("mosquitto")
+        if mosquitto is None:
+            raise RuntimeError("mosquitto not found in PATH")
+        process = subprocess.Popen([mosquitto, "-c", MOSQUITTO_CONFIG], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        wait_for_port(MOSQUITTO_PORT)
+        return "127.0.0.1", MOSQUITTO_PORT, process
+    port = free_port()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "benchmarks.broker", "--port", str(port)],
+        cwd=ROOT_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    wait_for_port(port)
+    return "127.0.0.1", port, process
+
+
+def start_subscriber(args, broker_host: str, broker_port: int, gateway_port: int) -> subprocess.Popen:
+    env = dict(os.environ, GATEWAY_API_URL=f"http://127.0.0.1:{gateway_port}")
+    log = open(args.subscriber_log, "ab") if args.subscriber_log else subprocess.DEVNULL
+    return subprocess.Popen(
+        [sys.executable, "-c", SUBSCRIBER_SCRIPT, broker_host, str(broker_port), str(args.workers), args.sharding],
+        cwd=ROOT_DIR, env=env, stdout=log, stderr=log,
+    )
+
+
+def stop_process(process: subprocess.Popen, sig=signal.SIGINT, timeout: float = 10.0):
+    if process is None or process.poll() is not None:
+        return
+    process.send_signal(sig)
+    try:
+        process.wait(timeout)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def run(args) -> dict:
+    broker_host, broker_port, broker = start_broker(args)
+    gateway = GatewayStandIn()
+    gateway.start()
+    subscriber = start_subscriber(args, broker_host, broker_port, gateway.port)
+    fleet = SensorFleet(broker_host, broker_port, args.sensors, args.rate, args.connections, args.readings, args.qos, args.codec, args.inference_layer)
+    try:
+        time.sleep(args.startup)
+        if subscriber.poll() is not None:
+            raise RuntimeError(f"Subscriber exited with code {subscriber.returncode}, see --subscriber-log")
+
+        fleet.start()
+        time.sleep(args.warmup)
+
+        # --- Measurement window ---
+        sampler = UsageSampler(subscriber.pid)
+        sent_before = fleet.total_sent()
+        arrivals_before = len(gateway.arrivals)
+        window_start = time.time()
+        sampler.start()
+        time.sleep(args.duration)
+        usage = sampler.stop()
+        window_end = time.time()
+        sent = fleet.total_sent() - sent_before
+        arrived = len(gateway.arrivals) - arrivals_before
+        fleet.stop()
+
+        # let the subscriber deliver what is still in flight
+        deadline = time.monotonic() + args.drain
+        total_sent = fleet.total_sent()
+        while len(gateway.arrivals) < total_sent and time.monotonic() < deadline:
+            time.sleep(0.1)
+    finally:
+        fleet.stop()
+        stop_process(subscriber)
+        gateway.stop()
+        stop_process(broker, signal.SIGTERM)
+
+    window_start_ms, window_end_ms = window_start * 1000, window_end * 1000
+    latencies = sorted(
+        arrived_at * 1000 - send_timestamp
+        for arrived_at, send_timestamp in gateway.arrivals
+        if window_start_ms <= send_timestamp < window_end_ms
+    )
+    delivered = len(latencies)
+    return {
+        "config": {
+            "sensors": args.sensors,
+            "rate_per_sensor": args.rate,
+            "offered_msgs_per_s": args.sensors * args.rate,
+            "duration_s": args.duration,
+            "connections": fleet.connections,
+            "qos": args.qos,
+            "codec": args.codec,
+            "inference_layer": args.inference_layer,
+            "broker": "external" if args.broker else "mosquitto" if args.mosquitto else "stand-in",
+            "subscriber_workers": args.workers,
+            "subscriber_sharding": args.sharding,
+            "environment": {
+                name: value for name, value in os.environ.items()
+                if name.startswith(("SUBSCRIBER_", "ASYNC_SUBSCRIBER_", "EXPORT_", "GATEWAY_API_", "SPOOL_", "SENSOR_", "INFERENCE_"))
+            },
+        },
+        "results": {
+            "published": sent,
+            "published_msgs_per_s": sent / args.duration,
+            "received_msgs_per_s": arrived / args.duration,
+            "delivered": delivered,
+            "lost": max(0, sent - delivered),
+            "publisher_max_lag_s": max(fleet.late),
+            "gateway_requests": gateway.requests,
+            "latency_ms": {
+                "p50": percentile(latencies, 50),
+                "p95": percentile(latencies, 95),
+                "p99": percentile(latencies, 99),
+                "max": latencies[-1] if latencies else None,
+            },
+            "subscriber": usage,
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sensors", type=int, default=50, help="number of simulated sensors")
+    parser.add_argument("--rate", type=float, default=1.0, help="messages per second per sensor")
+    parser.add_argument("--duration", type=float, default=30.0, help="measurement window in seconds")
+    parser.add_argument("--warmup", type=float, default=5.0, help="seconds of traffic before measuring")
+    parser.add_argument("--drain", type=float, default=10.0, help="seconds to wait for in-flight messages after publishing stops")
+    parser.add_argument("--startup", type=float, default=2.0, help="seconds given to the subscriber to connect")
+    parser.add_argument("--connections", type=int, default=8, help="MQTT connections used by the simulated sensors")
+    parser.add_argument("--readings", type=int, default=32, help="distinct readings cycled through by the sensors")
+    parser.add_argument("--codec", default="json", help="json, or the reading codec of binary messages (raw, zlib, zlib-delta, zlib-dict, zlib-dict-delta)")
+    parser.add_argument("--inference-layer", type=int, choices=(0, 1, 2), default=0, help="inference layer of the sensors, 1 (gateway) requires INFERENCE_MODEL_PATH")
+    parser.add_argument("--qos", type=int, choices=(0, 1), default=0, help="QoS of the sensor-data messages")
+    parser.add_argument("--broker", help="host:port of an existing broker")
+    parser.add_argument("--mosquitto", action="store_true", help="run mosquitto with mosquitto/config/mosquitto.conf")
+    parser.add_argument("--workers", type=int, default=1, help="subscriber processes, see run_service.py --subscriber-workers")
+    parser.add_argument("--sharding", choices=("shared", "local"), default="shared", help="see run_service.py --subscriber-sharding")
+    parser.add_argument("--subscriber-log", help="file receiving the subscriber output, discarded by default")
+    parser.add_argument("--output", help="file receiving the JSON results, stdout by default")
+    args = parser.parse_args()
+
+    results = run(args)
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+    summary = results["results"]
+    latency = summary["latency_ms"]
+    print(
+        f"{summary['received_msgs_per_s']:.1f} msgs/s, p50 {latency['p50'] or 0:.1f} ms, p95 {latency['p95'] or 0:.1f} ms, "
+        f"p99 {latency['p99'] or 0:.1f} ms, lost {summary['lost']}, CPU {summary['subscriber']['cpu_percent']:.0f}%, "
+        f"RSS {summary['subscriber']['rss_mb_max']:.0f} MB",
+        file=sys.stderr,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""
+Microbenchmark of topic dispatch in the subscriber.
+
+Compares the per-message cost of finding the handler of a topic, its parameters and its metrics
+label with the compiled topic router (app.subscriber.routes.topic_router) and with the previous
+dispatch: prefix checks against the subscription filters, the topic split once for the metrics label
+when the message is received and once more when it is handled, then split again by the handler and
+if/elif chains on the export or property name. Decoding and handling the payload are excluded.
+
+Usage: python -m benchmarks.bench_router [--number N]
+"""
+import timeit
+import argparse
+
+from app.core.metrics import topic_type
+from app.subscriber.routes import topic_router
+from app.core.config import DEVICE_EXPORT_TOPIC, DEVICE_RESPONSE_TOPIC
+
+
+def make_topics(devices: int) -> list[str]:
+    topics = []
+    for i in range(devices):
+        topics += [f"export/sensor_{i}/sensor-data"] * 8
+        topics.append(f"export/sensor_{i}/inf-latency-bench")
+        topics.append(f"response/sensor_{i}/sensor-state/get/9b1deb4d-3b7d-4bad-9bdd-2b0d7b3dcb6d")
+    return topics
+
+
+def legacy_dispatch(topic: str):
+    topic_type(topic)  # received
+    topic_type(topic)  # handled
+    if topic.startswith(DEVICE_EXPORT_TOPIC[:-1]):
+        _, device_name, export_name = topic.split("/")
+        if export_name == "sensor-data":
+            return "sensor-data", device_name
+        elif export_name == "inf-latency-bench":
+            return "inf-latency-bench", device_name
+        return None
+    elif topic.startswith(DEVICE_RESPONSE_TOPIC[:-1]):
+        _, device_name, property_name, method, command_uuid = topic.split("/")
+        if method != "get":
+            return None
+        if property_name == "sensor-config":
+            return "sensor-config", device_name, command_uuid
+        elif property_name == "inference-layer":
+            return "inference-layer", device_name, command_uuid
+        elif property_name == "sensor-state":
+            return "sensor-state", device_name, command_uuid
+        return None
+    return None
+
+
+def router_dispatch(topic: str):
+    match = topic_router.match(topic)
+    if match is not None:
+        match[0].label
+    return match
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--number", type=int, default=20, help="passes over the topics per measurement")
+    parser.add_argument("--repeat", type=int, default=5, help="measurements per dispatch, the best one is reported")
+    parser.add_argument("--devices", type=int, default=1000, help="devices, each sends 8 sensor-data, 1 benchmark and 1 response message")
+    args = parser.parse_args()
+
+    topics = make_topics(args.devices)
+    assert all(router_dispatch(topic) is not None for topic in topics)
+
+    results = {}
+    for name, dispatch in (("legacy", legacy_dispatch), ("router", router_dispatch)):
+        def run():
+            for topic in topics:
+                dispatch(topic)
+        best = min(timeit.repeat(run, number=args.number, repeat=args.repeat))
+        results[name] = best / (args.number * len(topics)) * 1e9
+        print(f"{name:>10}: {results[name]:9.0f} ns/message")
+    print(f"{'ratio':>10}: {results['router'] / results['legacy']:9.2f}x")
+
+
+if __name__ == "__main__":
+    main()
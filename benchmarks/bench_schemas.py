@@ -0,0 +1,74 @@
+"""
+Microbenchmark of the sensor-data export schema path.
+
+Compares the validated path (json.loads, nested model validation, model_dump, json.dumps) with the
+fast path used by ExportHandler (strict validation of the sensor payload only, model_construct of the
+export models, cached Metadata and single-pass serialization with pydantic_core.to_json).
+Reading decode is excluded, both paths start from the same physical values.
+
+Usage: python -m benchmarks.bench_schemas [--number N]
+"""
+import json
+import uuid
+import random
+import timeit
+import argparse
+
+from pydantic_core import to_json
+from app.subscriber.export import schemas, get_metadata
+from app.core.config import GATEWAY_NAME, SEQUENCE_LENGTH, SAMPLE_SIZE
+
+
+def make_message() -> tuple[bytes, list[list[float]]]:
+    payload = json.dumps({
+        "reading": "eJw=",
+        "low_battery": False,
+        "inference_descriptor": {"inference_layer": 0, "send_timestamp": 1700000000000, "prediction": 1},
+    }).encode()
+    values = [[random.uniform(-20, 20) for _ in range(SAMPLE_SIZE)] for _ in range(SEQUENCE_LENGTH)]
+    return payload, values
+
+
+def validated_path(payload: bytes, values: list[list[float]]) -> bytes:
+    _payload = json.loads(payload)
+    sensor_data = schemas.SensorData(
+        reading=schemas.SensorReading(uuid=str(uuid.uuid4()), values=values),
+        low_battery=_payload["low_battery"],
+        inference_descriptor=schemas.InferenceDescriptor(**_payload["inference_descriptor"]),
+    )
+    metadata = schemas.Metadata(gateway_name=GATEWAY_NAME, sensor_name="sensor_1")
+    export = schemas.SensorDataExport(metadata=metadata, export_value=sensor_data)
+    return json.dumps(export.model_dump()).encode()
+
+
+def fast_path(payload: bytes, values: list[list[float]]) -> bytes:
+    _payload = schemas.SensorDataPayload.model_validate_json(payload, strict=True)
+    sensor_data = schemas.SensorData.model_construct(
+        reading=schemas.SensorReading.model_construct(uuid=str(uuid.uuid4()), values=values),
+        low_battery=_payload.low_battery,
+        inference_descriptor=_payload.inference_descriptor,
+    )
+    export = schemas.SensorDataExport.model_construct(metadata=get_metadata("sensor_1"), export_value=sensor_data)
+    return to_json(export)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--number", type=int, default=500, help="messages per measurement")
+    parser.add_argument("--repeat", type=int, default=5, help="measurements per path, the best one is reported")
+    args = parser.parse_args()
+
+    payload, values = make_message()
+    assert json.loads(validated_path(payload, values))["export_value"]["reading"]["values"] == \
+        json.loads(fast_path(payload, values))["export_value"]["reading"]["values"]
+
+    results = {}
+    for name, path in (("validated", validated_path), ("fast", fast_path)):
+        best = min(timeit.repeat(lambda: path(payload, values), number=args.number, repeat=args.repeat))
+        results[name] = best / args.number * 1e6
+        print(f"{name:>10}: {results[name]:9.1f} us/message")
+    print(f"{'speedup':>10}: {results['validated'] / results['fast']:9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
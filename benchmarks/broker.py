@@ -0,0 +1,184 @@
+"""
+Minimal MQTT 3.1.1 broker stand-in for local benchmarks.
+
+Supports what the microservice and the benchmark sensors use: CONNECT, PUBLISH (QoS 0 and 1),
+SUBSCRIBE/UNSUBSCRIBE with + and # wildcards, shared subscriptions ($share/<group>/<filter>, messages
+are handed round-robin to the members of a group), PINGREQ and DISCONNECT. There are no sessions,
+retained messages, wills or retransmissions. Use mosquitto (mosquitto/config) for anything else.
+
+Usage: python -m benchmarks.broker [--host HOST] [--port PORT]
+"""
+import asyncio
+import argparse
+import itertools
+import logging
+
+logging.basicConfig(level=logging.INFO)
+
+CONNECT, CONNACK, PUBLISH, PUBACK = 1, 2, 3, 4
+SUBSCRIBE, SUBACK, UNSUBSCRIBE, UNSUBACK = 8, 9, 10, 11
+PINGREQ, PINGRESP, DISCONNECT = 12, 13, 14
+
+
+def topic_matches(topic_filter: str, topic: str) -> bool:
+    filter_levels = topic_filter.split("/")
+    topic_levels = topic.split("/")
+    for i, level in enumerate(filter_levels):
+        if level == "#":
+            return True
+        if i >= len(topic_levels) or (level != "+" and level != topic_levels[i]):
+            return False
+    return len(filter_levels) == len(topic_levels)
+
+
+def encode_remaining_length(length: int) -> bytes:
+    encoded = bytearray()
+    while True:
+        byte, length = length % 128, length // 128
+        encoded.append(byte | 0x80 if length else byte)
+        if not length:
+            return bytes(encoded)
+
+
+def packet(packet_type: int, flags: int, body: bytes) -> bytes:
+    return bytes([packet_type << 4 | flags]) + encode_remaining_length(len(body)) + body
+
+
+def utf8_string(data: bytes, offset: int) -> tuple[str, int]:
+    length = int.from_bytes(data[offset:offset + 2], "big")
+    return data[offset + 2:offset + 2 + length].decode(), offset + 2 + length
+
+
+class Session:
+    def __init__(self, writer: asyncio.StreamWriter):
+        self.writer = writer
+        self.client_id = None
+        self.packet_ids = itertools.cycle(range(1, 65536))
+
+    def publish(self, topic: str, payload: bytes, qos: int):
+        topic_bytes = topic.encode()
+        body = len(topic_bytes).to_bytes(2, "big") + topic_bytes
+        if qos:
+            body += next(self.packet_ids).to_bytes(2, "big")
+        self.writer.write(packet(PUBLISH, qos << 1, body + payload))
+
+
+class Broker:
+    def __init__(self):
+        # subscriptions: topic filter -> {session: qos}, shared: (group, topic filter) -> {session: qos}
+        self.subscriptions: dict[str, dict[Session, int]] = {}
+        self.shared: dict[tuple[str, str], dict[Session, int]] = {}
+        self._round_robin: dict[tuple[str, str], int] = {}
+
+    def subscribe(self, session: Session, topic_filter: str, qos: int):
+        if topic_filter.startswith("$share/"):
+            _, group, shared_filter = topic_filter.split("/", 2)
+            self.shared.setdefault((group, shared_filter), {})[session] = qos
+        else:
+            self.subscriptions.setdefault(topic_filter, {})[session] = qos
+
+    def unsubscribe(self, session: Session, topic_filter: str):
+        if topic_filter.startswith("$share/"):
+            _, group, shared_filter = topic_filter.split("/", 2)
+            self.shared.get((group, shared_filter), {}).pop(session, None)
+        else:
+            self.subscriptions.get(topic_filter, {}).pop(session, None)
+
+    def drop(self, session: Session):
+        for subscribers in itertools.chain(self.subscriptions.values(), self.shared.values()):
+            subscribers.pop(session, None)
+
+    def route(self, topic: str, payload: bytes, qos: int) -> set[Session]:
+        receivers = set()
+        for topic_filter, subscribers in self.subscriptions.items():
+            if subscribers and topic_matches(topic_filter, topic):
+                for session, granted_qos in subscribers.items():
+                    session.publish(topic, payload, min(qos, granted_qos))
+                    receivers.add(session)
+        for key, subscribers in self.shared.items():
+            if subscribers and topic_matches(key[1], topic):
+                members = list(subscribers.items())
+                index = self._round_robin.get(key, 0) % len(members)
+                self._round_robin[key] = index + 1
+                session, granted_qos = members[index]
+                session.publish(topic, payload, min(qos, granted_qos))
+                receivers.add(session)
+        return receivers
+
+    async def _read_packet(self, reader: asyncio.StreamReader) -> tuple[int, int, bytes]:
+        header = (await reader.readexactly(1))[0]
+        length, multiplier = 0, 1
+        while True:
+            byte = (await reader.readexactly(1))[0]
+            length += (byte & 0x7F) * multiplier
+            multiplier *= 128
+            if not byte & 0x80:
+                break
+        return header >> 4, header & 0x0F, await reader.readexactly(length)
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        session = Session(writer)
+        try:
+            while True:
+                packet_type, flags, body = await self._read_packet(reader)
+                if packet_type == CONNECT:
+                    _, offset = utf8_string(body, 0)  # protocol name
+                    session.client_id, _ = utf8_string(body, offset + 4)
+                    writer.write(packet(CONNACK, 0, b"\x00\x00"))
+                elif packet_type == PUBLISH:
+                    qos = (flags >> 1) & 0x03
+                    topic, offset = utf8_string(body, 0)
+                    if qos:
+                        packet_id, offset = body[offset:offset + 2], offset + 2
+                        writer.write(packet(PUBACK, 0, packet_id))
+                    # waiting for slow subscribers pushes back on the publishers
+                    for receiver in self.route(topic, body[offset:], qos):
+                        await receiver.writer.drain()
+                elif packet_type == SUBSCRIBE:
+                    packet_id, offset, granted = body[:2], 2, bytearray()
+                    while offset < len(body):
+                        topic_filter, offset = utf8_string(body, offset)
+                        qos = min(body[offset], 1)
+                        offset += 1
+                        self.subscribe(session, topic_filter, qos)
+                        granted.append(qos)
+                    writer.write(packet(SUBACK, 0, packet_id + bytes(granted)))
+                elif packet_type == UNSUBSCRIBE:
+                    offset = 2
+                    while offset < len(body):
+                        topic_filter, offset = utf8_string(body, offset)
+                        self.unsubscribe(session, topic_filter)
+                    writer.write(packet(UNSUBACK, 0, body[:2]))
+                elif packet_type == PINGREQ:
+                    writer.write(packet(PINGRESP, 0, b""))
+                elif packet_type == DISCONNECT:
+                    break
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.drop(session)
+            writer.close()
+
+
+async def serve(host: str, port: int):
+    broker = Broker()
+    server = await asyncio.start_server(broker.handle, host, port)
+    logging.info(f"[Broker] Listening on {host}:{port}")
+    async with server:
+        await server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=1883)
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
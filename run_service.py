@@ -1,27 +1,44 @@
 """
 Script that runs both publisher and subscriber
 on two separate processes.
+
+With --subscriber-workers N (N > 1) the subscriber process supervises
+N subscriber worker processes, see app/subscriber/supervisor.py.
+With --publisher-workers N (N > 1) the publisher runs N uvicorn worker
+processes, see app/publisher/api/workers.py.
 """
 
+import argparse
 import multiprocessing
-from app.core.config import (MQTT_SENSOR_MICROSERVICE_HOST, MQTT_SENSOR_MICROSERVICE_PORT, MQTT_BROKER_HOST, MQTT_BROKER_PORT, MQTT_SUBSCRIBER_CLIENT_ID)
+from app.core.config import (MQTT_SENSOR_MICROSERVICE_HOST, MQTT_SENSOR_MICROSERVICE_PORT, MQTT_BROKER_HOST, MQTT_BROKER_PORT, MQTT_SUBSCRIBER_CLIENT_ID, SUBSCRIBER_PROCESSES, SUBSCRIBER_SHARDING, PUBLISHER_WORKERS)
 from app.publisher.run import run_publisher_process
 from app.subscriber.run import run_subscriber_process
+from app.subscriber.supervisor import SHARDINGS, run_sharded_subscriber
+
 
+def run_publisher(workers):
+	run_publisher_process(MQTT_SENSOR_MICROSERVICE_HOST, MQTT_SENSOR_MICROSERVICE_PORT, workers)
 
-def run_publisher():
-	run_publisher_process(MQTT_SENSOR_MICROSERVICE_HOST, MQTT_SENSOR_MICROSERVICE_PORT)
+def run_subscriber(workers, sharding):
+	if workers > 1:
+		run_sharded_subscriber(MQTT_BROKER_HOST, MQTT_BROKER_PORT, workers, sharding)
+	else:
+		run_subscriber_process(MQTT_BROKER_HOST, MQTT_BROKER_PORT)
 
-def run_subscriber():
-	run_subscriber_process(MQTT_BROKER_HOST, MQTT_BROKER_PORT)
+def parse_args():
+	parser = argparse.ArgumentParser(description="Runs the MQTT sensor microservice publisher and subscriber.")
+	parser.add_argument("--publisher-workers", type=int, default=PUBLISHER_WORKERS, help="number of publisher worker processes")
+	parser.add_argument("--subscriber-workers", type=int, default=SUBSCRIBER_PROCESSES, help="number of subscriber processes")
+	parser.add_argument("--subscriber-sharding", choices=SHARDINGS, default=SUBSCRIBER_SHARDING, help="how messages are shared among subscriber processes")
+	return parser.parse_args()
 
 if __name__ == "__main__":
-	publisher_process = multiprocessing.Process(target=run_publisher)
-	subscriber_process = multiprocessing.Process(target=run_subscriber)
+	args = parse_args()
+	publisher_process = multiprocessing.Process(target=run_publisher, args=(args.publisher_workers,))
+	subscriber_process = multiprocessing.Process(target=run_subscriber, args=(args.subscriber_workers, args.subscriber_sharding))
 
 	publisher_process.start()
 	subscriber_process.start()
 
 	publisher_process.join()
 	subscriber_process.join()
-